@@ -1,5 +1,6 @@
 """语音助手后端服务"""
 import asyncio
+import queue
 import re
 import subprocess
 from io import BytesIO
@@ -18,6 +19,7 @@ from tts.tts_factory import TTSFactory
 from audio.player import AudioPlayer
 from utils.config_loader import config
 from utils.session import SessionManager
+from utils.resource_planner import ResourcePlanner, apply_process_plan
 
 app = FastAPI(title="语音助手API")
 
@@ -28,6 +30,13 @@ app.mount("/static", StaticFiles(directory="static"), name="static")
 session_manager = SessionManager(config.get("output.dir", "output"))
 audio_player = AudioPlayer()
 
+# CPU线程与绑核规划，需在加载模型前应用到主进程
+resource_planner = ResourcePlanner(config.get("resources", {}),
+                                   num_tts_workers=config.get("tts.models.cosyvoice.num_workers", 0))
+if resource_planner.enable:
+    apply_process_plan(resource_planner.plan("main"))
+    print(f"CPU线程规划:\n{resource_planner.summary()}")
+
 # 句子分隔符
 SENTENCE_DELIMITERS = config.get("sentence_delimiters", ["。", "！", "？", ".", "!", "?"])
 
@@ -55,6 +64,8 @@ class VoiceAssistant:
         if asr_type not in self.asr_models:
             asr_config = config.get(f"asr.models.{asr_type}", {})
             asr_config["device"] = "cpu"
+            if resource_planner.enable:
+                asr_config.update(resource_planner.asr_kwargs())
             # 将相对路径转换为绝对路径
             if "model_path" in asr_config:
                 asr_config["model_path"] = config.get_abs_path(asr_config["model_path"])
@@ -66,6 +77,8 @@ class VoiceAssistant:
             tts_config = config.get(f"tts.models.{tts_type}", {})
             if tts_type == "cosyvoice":
                 tts_config["device"] = "cpu"
+                if resource_planner.enable:
+                    tts_config.update(resource_planner.tts_kwargs())
             # 将相对路径转换为绝对路径
             if "model_path" in tts_config:
                 tts_config["model_path"] = config.get_abs_path(tts_config["model_path"])
@@ -99,7 +112,9 @@ class VoiceAssistant:
             yield {"type": "error", "message": "ASR模型未初始化"}
             return
         
-        user_text = asr_model.transcribe(audio_path)
+        # 在线程池中识别，不阻塞事件循环，开启ASR批处理时并发请求才能合并
+        loop = asyncio.get_event_loop()
+        user_text = await loop.run_in_executor(None, asr_model.transcribe, audio_path)
         if not user_text:
             yield {"type": "error", "message": "语音识别失败"}
             return
@@ -117,6 +132,12 @@ class VoiceAssistant:
     
     async def _stream_llm_response(self, user_text: str, tts_type: str):
         """流式处理大模型响应"""
+        tts_model = self.tts_models.get(tts_type)
+        if tts_model is not None and tts_model.supports_bistream():
+            async for chunk in self._stream_llm_response_bistream(user_text, tts_model):
+                yield chunk
+            return
+        
         full_response = ""
         
         # 使用 asyncio 运行同步生成器，避免阻塞
@@ -162,6 +183,47 @@ class VoiceAssistant:
         
         yield {"type": "llm_complete", "text": full_response}
     
+    async def _stream_llm_response_bistream(self, user_text: str, tts_model):
+        """双向流式处理大模型响应：整轮回答只做一次合成，文本片段边生成边送入TTS"""
+        full_response = ""
+        text_queue = queue.Queue()
+        
+        def text_generator():
+            while True:
+                text = text_queue.get()
+                if text is None:
+                    return
+                yield text
+        
+        def get_output_path(index: int) -> str:
+            self.sentence_counter = index
+            return str(session_manager.get_audio_path(self.current_session, f"response_{index:03d}.wav"))
+        
+        def on_tts_done(future):
+            if future.exception() is not None:
+                print(f"双向流式TTS错误: {future.exception()}")
+        
+        loop = asyncio.get_event_loop()
+        tts_future = loop.run_in_executor(None, tts_model.synthesize_bistream_sync,
+                                          text_generator(), get_output_path, audio_player.add_to_queue)
+        tts_future.add_done_callback(on_tts_done)
+        
+        try:
+            for chunk in self.llm_client.simple_chat(user_text):
+                full_response += chunk
+                text_queue.put(chunk)
+                
+                # 发送LLM片段
+                yield {"type": "llm_chunk", "text": chunk}
+                
+                # 释放事件循环，允许其他异步任务运行
+                await asyncio.sleep(0)
+        finally:
+            # 结束文本输入，TTS合成剩余文本
+            text_queue.put(None)
+        
+        yield {"type": "llm_complete", "text": full_response}
+    
     async def _convert_to_speech(self, text: str, tts_type: str, index: int):
         """将文本转换为语音
         
@@ -219,6 +281,10 @@ async def startup_event():
 async def shutdown_event():
     """关闭事件"""
     audio_player.stop()
+    # 关闭TTS合成池等后台进程
+    for tts_model in assistant.tts_models.values():
+        if hasattr(tts_model, "close"):
+            tts_model.close()
     print("语音助手服务已关闭")
 
 
@@ -256,6 +322,12 @@ async def initialize(asr_type: str = Form(...), tts_type: str = Form(...)):
         }, status_code=500)
 
 
+@app.get("/api/asr_stats")
+async def asr_stats():
+    """ASR统计：批大小分布及排队等待、识别总耗时分布，VAD去除的静音时长及预计节省的识别耗时"""
+    return JSONResponse({asr_type: asr_model.get_stats() for asr_type, asr_model in assistant.asr_models.items()})
+
+
 @app.post("/api/process_audio")
 async def process_audio_file(
     audio: UploadFile = File(...),
@@ -1,7 +1,8 @@
 """ASR基类"""
 from abc import ABC, abstractmethod
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
-from typing import Optional
+from typing import Any, Dict, List, Optional
 
 
 class BaseASR(ABC):
@@ -10,6 +11,9 @@ class BaseASR(ABC):
     def __init__(self, model_path: str, **kwargs):
         self.model_path = Path(model_path)
         self.model = None
+        # 跨请求批处理器(asr.batcher.ASRBatcher)和识别前的VAD分段(asr.vad.SpeechSegmenter)，由子类按配置创建
+        self.batcher = None
+        self.segmenter = None
         self.kwargs = kwargs
     
     @abstractmethod
@@ -17,6 +21,42 @@ class BaseASR(ABC):
         """加载模型"""
         pass
     
+    @abstractmethod
+    def generate(self, audio_paths: List[str]) -> List[str]:
+        """一次识别多个音频文件
+        
+        Args:
+            audio_paths: 音频文件路径列表
+            
+        Returns:
+            按输入顺序的识别结果文本
+        """
+        pass
+    
+    def recognize(self, audio_paths: List[str]) -> List[str]:
+        """识别多个音频文件，开启批处理时各文件分别提交给批处理器，与其它请求合并识别"""
+        if self.batcher is None:
+            return self.generate(audio_paths)
+        if len(audio_paths) == 1:
+            return [self.batcher.transcribe(audio_paths[0])]
+        with ThreadPoolExecutor(len(audio_paths)) as executor:
+            return list(executor.map(self.batcher.transcribe, audio_paths))
+    
+    def recognize_file(self, audio_path: str) -> str:
+        """识别一个音频文件，开启VAD时先裁剪静音并分段并行识别"""
+        if self.segmenter is not None:
+            return self.segmenter.transcribe(audio_path, self.recognize)
+        return self.recognize([audio_path])[0]
+    
+    def get_stats(self) -> Dict[str, Any]:
+        """批处理和VAD统计"""
+        stats = {}
+        if self.batcher is not None:
+            stats["batch"] = self.batcher.get_stats()
+        if self.segmenter is not None:
+            stats["vad"] = self.segmenter.get_stats()
+        return stats
+    
     @abstractmethod
     def transcribe(self, audio_path: str) -> str:
         """语音识别
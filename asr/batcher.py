@@ -0,0 +1,127 @@
+"""ASR跨请求动态批处理"""
+import threading
+import time
+from collections import defaultdict, deque
+from typing import Any, Callable, Dict, List
+
+
+def audio_duration(audio_path: str) -> float:
+    """音频时长(秒)，读取失败时为0"""
+    try:
+        import soundfile as sf
+        return sf.info(audio_path).duration
+    except Exception:
+        return 0.0
+
+
+def percentiles(values: List[float]) -> Dict[str, float]:
+    """p50/p90/p99/max分布"""
+    if len(values) == 0:
+        return {}
+    values = sorted(values)
+    result = {name: values[min(int(q * len(values)), len(values) - 1)] for name, q in (("p50", 0.5), ("p90", 0.9), ("p99", 0.99))}
+    result["max"] = values[-1]
+    return result
+
+
+class ASRBatcher:
+    """收集并发的识别请求，合并为一次批量generate
+
+    每个请求提交音频文件后阻塞等待。后台线程在收到第一个请求后最多再等待max_wait秒，
+    期间请求数达到max_batch_size或音频总时长达到max_batch_sec时立即开始识别，
+    按提交顺序把一批音频交给generate_fn，识别结果按顺序分发回各请求。
+    批量识别失败时逐条重试，避免一条坏音频导致整批失败。
+    """
+
+    def __init__(self, generate_fn: Callable[[List[str]], List[str]], max_wait: float = 0.01,
+                 max_batch_size: int = 8, max_batch_sec: float = 60.0, history: int = 1000):
+        self.generate_fn = generate_fn
+        self.max_wait = max_wait
+        self.max_batch_size = max_batch_size
+        self.max_batch_sec = max_batch_sec
+        self.condition = threading.Condition()
+        self.pending = []
+        # 批大小 -> 批次数；最近history个请求的排队等待和总耗时
+        self.batch_stats = defaultdict(int)
+        self.queue_waits = deque(maxlen=history)
+        self.latencies = deque(maxlen=history)
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def transcribe(self, audio_path: str) -> str:
+        """提交一个音频文件并等待识别结果"""
+        request = {"audio_path": audio_path, "duration": audio_duration(audio_path), "submit_time": time.time(),
+                   "text": None, "event": threading.Event()}
+        with self.condition:
+            self.pending.append(request)
+            self.condition.notify_all()
+        request["event"].wait()
+        if isinstance(request["text"], Exception):
+            raise request["text"]
+        return request["text"]
+
+    def run(self):
+        while True:
+            with self.condition:
+                while len(self.pending) == 0:
+                    self.condition.wait()
+                deadline = self.pending[0]["submit_time"] + self.max_wait
+                while not self.full() and time.time() < deadline:
+                    self.condition.wait(deadline - time.time())
+                batch = self.select()
+            self.forward(batch)
+
+    def full(self) -> bool:
+        return len(self.pending) >= self.max_batch_size or \
+            sum(i["duration"] for i in self.pending) >= self.max_batch_sec
+
+    def select(self) -> List[Dict[str, Any]]:
+        """按提交顺序取一批，音频总时长不超过max_batch_sec(至少取一个)"""
+        batch, batch_sec = [], 0.0
+        for request in self.pending[:self.max_batch_size]:
+            if len(batch) > 0 and batch_sec + request["duration"] > self.max_batch_sec:
+                break
+            batch.append(request)
+            batch_sec += request["duration"]
+        self.pending = self.pending[len(batch):]
+        return batch
+
+    def forward(self, batch: List[Dict[str, Any]]):
+        start_time = time.time()
+        try:
+            texts = self.generate_fn([i["audio_path"] for i in batch])
+            assert len(texts) == len(batch), f"批量识别结果数{len(texts)}与请求数{len(batch)}不一致"
+        except Exception as e:
+            if len(batch) == 1:
+                texts = [e]
+            else:
+                print(f"批量语音识别失败，逐条重试: {e}")
+                texts = self.forward_one_by_one(batch)
+        end_time = time.time()
+        with self.condition:
+            self.batch_stats[len(batch)] += 1
+            for request in batch:
+                self.queue_waits.append(start_time - request["submit_time"])
+                self.latencies.append(end_time - request["submit_time"])
+        for request, text in zip(batch, texts):
+            request["text"] = text
+            request["event"].set()
+
+    def forward_one_by_one(self, batch: List[Dict[str, Any]]) -> List[Any]:
+        texts = []
+        for request in batch:
+            try:
+                texts.append(self.generate_fn([request["audio_path"]])[0])
+            except Exception as e:
+                texts.append(e)
+        return texts
+
+    def get_stats(self) -> Dict[str, Any]:
+        """批大小分布及最近请求的排队等待、总耗时分布(秒)"""
+        with self.condition:
+            batch_stats = dict(sorted(self.batch_stats.items()))
+            queue_waits, latencies = list(self.queue_waits), list(self.latencies)
+        batches = sum(batch_stats.values())
+        requests = sum(k * v for k, v in batch_stats.items())
+        return {"batches": batches, "mean_batch_size": requests / max(batches, 1), "batch_size_hist": batch_stats,
+                "queue_wait": percentiles(queue_waits), "latency": percentiles(latencies)}
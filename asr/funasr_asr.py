@@ -1,16 +1,26 @@
 """FunASR实现"""
 from pathlib import Path
-from typing import Optional
+from typing import List, Optional
 from .base_asr import BaseASR
+from .batcher import ASRBatcher
+from .vad import SpeechSegmenter
 
 
 class FunASR(BaseASR):
     """FunASR语音识别"""
     
-    def __init__(self, model_path: str, language: str = "zh", device: str = "cpu", **kwargs):
+    def __init__(self, model_path: str, language: str = "zh", device: str = "cpu", ncpu: int = 4,
+                 batch: bool = False, batch_max_wait: float = 0.01, batch_max_size: int = 8, batch_max_sec: float = 60.0,
+                 vad: bool = False, vad_model: str = "", vad_max_segment_sec: float = 30.0, **kwargs):
         super().__init__(model_path, **kwargs)
         self.language = language
         self.device = device
+        # FunASR加载模型时按ncpu全局设置torch线程数
+        self.ncpu = ncpu
+        # batch为True时并发请求在batch_max_wait秒内合并为一次批量识别，每批最多batch_max_size条、音频总长batch_max_sec秒
+        self.batcher = ASRBatcher(self.generate, batch_max_wait, batch_max_size, batch_max_sec) if batch else None
+        # vad为True时识别前裁掉静音，长录音按vad_max_segment_sec切段后并行识别再拼接；vad_model为空时使用能量/过零率VAD
+        self.segmenter = SpeechSegmenter(vad_model, vad_max_segment_sec, device=device) if vad else None
         self.load_model()
     
     def load_model(self):
@@ -26,6 +36,7 @@ class FunASR(BaseASR):
                 self.model = AutoModel(
                     model=str(self.model_path),
                     device=self.device,
+                    ncpu=self.ncpu,
                     disable_pbar=True,
                     disable_log=True
                 )
@@ -36,6 +47,7 @@ class FunASR(BaseASR):
                 self.model = AutoModel(
                     model=model_name,
                     device=self.device,
+                    ncpu=self.ncpu,
                     disable_pbar=True,
                     disable_log=True,
                     hub="ms"
@@ -54,19 +66,23 @@ class FunASR(BaseASR):
             raise RuntimeError("模型未加载")
         
         try:
-            result = self.model.generate(
-                input=audio_path,
-                batch_size_s=300
-            )
-            
-            if result and len(result) > 0:
-                text = result[0].get("text", "")
-                return text.strip()
-            return ""
+            return self.recognize_file(audio_path)
         except Exception as e:
             print(f"语音识别失败: {e}")
             return ""
     
+    def generate(self, audio_paths: List[str]) -> List[str]:
+        """一次generate识别多个音频文件，按输入顺序返回识别结果"""
+        result = self.model.generate(
+            input=audio_paths if len(audio_paths) > 1 else audio_paths[0],
+            batch_size=len(audio_paths),
+            batch_size_s=300
+        )
+        texts = [i.get("text", "").strip() for i in result or []]
+        if len(audio_paths) == 1 and len(texts) == 0:
+            return [""]
+        return texts
+    
     def transcribe_stream(self, audio_data: bytes) -> str:
         """流式语音识别"""
         import tempfile, soundfile as sf, numpy as np
@@ -0,0 +1,150 @@
+"""识别前的VAD静音裁剪与分段"""
+import os
+import re
+import tempfile
+import threading
+import time
+from typing import Callable, Dict, List, Tuple
+
+import numpy as np
+import soundfile as sf
+
+
+def frame_features(speech: np.ndarray, sample_rate: int, frame_shift: float = 0.01, frame_len: float = 0.025) -> Tuple[np.ndarray, np.ndarray]:
+    """每帧的对数能量(dB)和过零率"""
+    shift, length = int(sample_rate * frame_shift), int(sample_rate * frame_len)
+    if len(speech) < length:
+        speech = np.pad(speech, (0, length - len(speech)))
+    frames = np.lib.stride_tricks.sliding_window_view(speech, length)[::shift]
+    energy = 10 * np.log10(np.mean(frames ** 2, axis=1) + 1e-10)
+    zcr = np.mean(np.abs(np.diff(np.sign(frames), axis=1)) > 0, axis=1)
+    return energy, zcr
+
+
+def energy_zcr_vad(energy: np.ndarray, zcr: np.ndarray, frame_shift: float = 0.01, silence_db: float = -50.0,
+                   dynamic_range: float = 35.0, noise_margin: float = 10.0, zcr_threshold: float = 0.3) -> List[Tuple[float, float]]:
+    """有声区间[开始秒, 结束秒)
+
+    能量高于噪声底(10%分位)noise_margin且在峰值(99%分位)dynamic_range以内的帧为有声；
+    能量稍低(噪声底以上noise_margin/2)但过零率高的帧视为清辅音，也算有声。峰值低于silence_db时整段为静音。
+    """
+    noise_floor, peak = np.percentile(energy, 10), np.percentile(energy, 99)
+    if peak < silence_db:
+        return []
+    threshold = max(noise_floor + noise_margin, peak - dynamic_range)
+    voiced = (energy > threshold) | ((energy > noise_floor + noise_margin / 2) & (zcr > zcr_threshold))
+    edges = np.diff(np.concatenate([[0], voiced.astype(np.int8), [0]]))
+    starts, ends = np.nonzero(edges == 1)[0], np.nonzero(edges == -1)[0]
+    return [(s * frame_shift, e * frame_shift) for s, e in zip(starts, ends)]
+
+
+def join_texts(texts: List[str]) -> str:
+    """拼接各段识别结果，英文单词之间补空格"""
+    result = ""
+    for text in texts:
+        if re.search(r"[A-Za-z0-9]$", result) and re.match(r"[A-Za-z0-9]", text):
+            result += " "
+        result += text
+    return result
+
+
+class SpeechSegmenter:
+    """识别前裁掉首尾和段间的长静音，并把长录音切成可并行识别的语音段
+
+    默认使用向量化的能量/过零率VAD；vad_model不为空时使用FunASR的fsmn-vad等VAD模型，加载失败时回退到能量VAD。
+    间隔小于max_gap秒的有声区间合并为一段，每段两侧保留pad秒，短于min_speech秒的区间丢弃，
+    长于max_segment_sec秒的段在后半段能量最低处切开，切剩的尾段短于max(min_speech, max_segment_sec/4)秒时并入前一段。
+    """
+
+    def __init__(self, vad_model: str = "", max_segment_sec: float = 30.0, max_gap: float = 0.5,
+                 pad: float = 0.2, min_speech: float = 0.1, device: str = "cpu"):
+        self.max_segment_sec = max_segment_sec
+        self.max_gap = max_gap
+        self.pad = pad
+        self.min_speech = min_speech
+        self.model = None
+        if vad_model:
+            try:
+                from funasr import AutoModel
+                self.model = AutoModel(model=vad_model, device=device, disable_pbar=True, disable_log=True, disable_update=True)
+                print(f"VAD模型加载成功: {vad_model}")
+            except Exception as e:
+                print(f"VAD模型加载失败，使用能量VAD: {e}")
+        self.lock = threading.Lock()
+        self.stats = {"requests": 0, "segments": 0, "audio_sec": 0.0, "removed_sec": 0.0, "asr_time": 0.0, "saved_time": 0.0}
+
+    def detect(self, audio_path: str, energy: np.ndarray, zcr: np.ndarray) -> List[Tuple[float, float]]:
+        if self.model is not None:
+            try:
+                result = self.model.generate(input=audio_path)
+                return [(beg / 1000, end / 1000) for beg, end in result[0]["value"]]
+            except Exception as e:
+                print(f"VAD模型检测失败，使用能量VAD: {e}")
+        return energy_zcr_vad(energy, zcr)
+
+    def split(self, speech: np.ndarray, sample_rate: int, audio_path: str, frame_shift: float = 0.01) -> List[Tuple[float, float]]:
+        """语音段[开始秒, 结束秒)"""
+        duration = len(speech) / sample_rate
+        energy, zcr = frame_features(speech, sample_rate, frame_shift)
+        segments = []
+        for start, end in self.detect(audio_path, energy, zcr):
+            if len(segments) != 0 and start - segments[-1][1] < self.max_gap:
+                segments[-1][1] = end
+            else:
+                segments.append([start, end])
+        segments = [(max(s - self.pad, 0.0), min(e + self.pad, duration)) for s, e in segments if e - s >= self.min_speech]
+        min_tail = max(self.min_speech, self.max_segment_sec / 4)
+        result = []
+        for start, end in segments:
+            pieces = []
+            while end - start > self.max_segment_sec:
+                # 在[max_segment_sec/2, max_segment_sec]内能量最低的帧处切开，尽量切在词间停顿
+                first = int((start + self.max_segment_sec / 2) / frame_shift)
+                last = int((start + self.max_segment_sec) / frame_shift)
+                cut = (first + int(np.argmin(energy[first: last]))) * frame_shift
+                pieces.append((start, cut))
+                start = cut
+            if len(pieces) != 0 and end - start < min_tail:
+                # 过短的尾段缺少上下文，单独识别容易出错，并入前一段(前一段最长约1.25倍max_segment_sec)
+                start = pieces.pop()[0]
+            pieces.append((start, end))
+            result += pieces
+        return result
+
+    def transcribe(self, audio_path: str, recognize: Callable[[List[str]], List[str]]) -> str:
+        """裁剪静音并分段，recognize一次识别所有语音段，返回拼接后的文本"""
+        speech, sample_rate = sf.read(audio_path, dtype="float32", always_2d=True)
+        speech = speech.mean(axis=1)
+        segments = self.split(speech, sample_rate, audio_path)
+        audio_sec = len(speech) / sample_rate
+        speech_sec = sum(e - s for s, e in segments)
+        texts, asr_time = [], 0.0
+        if len(segments) != 0:
+            with tempfile.TemporaryDirectory() as tmp_dir:
+                segment_paths = []
+                for i, (start, end) in enumerate(segments):
+                    segment_path = os.path.join(tmp_dir, f"segment_{i}.wav")
+                    sf.write(segment_path, speech[int(start * sample_rate): int(end * sample_rate)], sample_rate, subtype="PCM_16")
+                    segment_paths.append(segment_path)
+                start_time = time.time()
+                texts = recognize(segment_paths)
+                asr_time = time.time() - start_time
+        # 识别耗时近似与音频时长成正比，按本次每秒音频的识别耗时估算裁掉的静音节省的时间
+        saved_time = asr_time / speech_sec * (audio_sec - speech_sec) if speech_sec > 0 else 0.0
+        print(f"VAD: 音频{audio_sec:.2f}s，去除静音{audio_sec - speech_sec:.2f}s，{len(segments)}段，"
+              f"识别耗时{asr_time:.3f}s，预计节省{saved_time:.3f}s")
+        with self.lock:
+            self.stats["requests"] += 1
+            self.stats["segments"] += len(segments)
+            self.stats["audio_sec"] += audio_sec
+            self.stats["removed_sec"] += audio_sec - speech_sec
+            self.stats["asr_time"] += asr_time
+            self.stats["saved_time"] += saved_time
+        return join_texts([i for i in texts if i])
+
+    def get_stats(self) -> Dict[str, float]:
+        """累计的音频时长、去除的静音时长、识别耗时及预计节省的识别耗时(秒)"""
+        with self.lock:
+            stats = dict(self.stats)
+        stats["removed_ratio"] = stats["removed_sec"] / stats["audio_sec"] if stats["audio_sec"] > 0 else 0.0
+        return stats
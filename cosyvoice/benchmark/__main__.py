@@ -0,0 +1,130 @@
+from __future__ import print_function
+
+import argparse
+import json
+import logging
+logging.getLogger('matplotlib').setLevel(logging.WARNING)
+import os
+import platform
+import sys
+import time
+import torch
+ROOT_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.append('{}/../..'.format(ROOT_DIR))
+sys.path.append('{}/../../third_party/Matcha-TTS'.format(ROOT_DIR))
+from cosyvoice.benchmark.models import TINY_MODELS, build_tiny_model, build_pretrained_model
+from cosyvoice.benchmark.suite import measure, run_suite, compare
+from cosyvoice.utils.file_utils import logging
+
+
+def get_args():
+    parser = argparse.ArgumentParser(description='micro benchmark llm/flow/hift and end to end tts of tiny random initialized and pretrained models, '
+                                                 'usage: python -m cosyvoice.benchmark --output result.json --baseline baseline.json')
+    parser.add_argument('--models',
+                        type=str,
+                        default=','.join(TINY_MODELS),
+                        help='comma separated tiny models, choose from {}, empty for none'.format('/'.join(TINY_MODELS)))
+    parser.add_argument('--model_dir',
+                        type=str,
+                        default='',
+                        help='comma separated local paths of pretrained models, benchmarked when they exist')
+    parser.add_argument('--variants',
+                        type=str,
+                        default='',
+                        help='json dict of variant name -> AutoModel kwargs, every pretrained model is benchmarked once per variant, '
+                             'e.g. \'{"eager": {}, "int8": {"quantize": "int8"}, "mmap": {"load_mmap": true}}\'')
+    parser.add_argument('--text_len',
+                        type=str,
+                        default='8,16,32',
+                        help='comma separated text token lengths')
+    parser.add_argument('--concurrency',
+                        type=str,
+                        default='1,2',
+                        help='comma separated concurrency levels of end to end tts')
+    parser.add_argument('--num_runs',
+                        type=int,
+                        default=3,
+                        help='runs per case after warmup, metrics are averaged')
+    parser.add_argument('--num_threads',
+                        type=int,
+                        default=0,
+                        help='torch intra op threads, 0 keeps torch default')
+    parser.add_argument('--seed',
+                        type=int,
+                        default=0,
+                        help='random seed of every run')
+    parser.add_argument('--output',
+                        type=str,
+                        default='',
+                        help='json file of the results')
+    parser.add_argument('--baseline',
+                        type=str,
+                        default='',
+                        help='json file of baseline results, e.g. the output of a previous run')
+    parser.add_argument('--tolerance',
+                        type=float,
+                        default=0.1,
+                        help='relative change of a metric against baseline reported as regression')
+    args = parser.parse_args()
+    print(args)
+    return args
+
+
+def main():
+    args = get_args()
+    logging.basicConfig(level=logging.DEBUG,
+                        format='%(asctime)s %(levelname)s %(message)s')
+
+    if args.num_threads > 0:
+        torch.set_num_threads(args.num_threads)
+    text_lens = [int(i) for i in args.text_len.split(',')]
+    concurrency = [int(i) for i in args.concurrency.split(',') if i != '']
+    variants = json.loads(args.variants) if args.variants != '' else {}
+    builders = [(i, lambda name=i: build_tiny_model(name)) for i in args.models.split(',') if i != '']
+    for model_dir in [i for i in args.model_dir.split(',') if i != '']:
+        if not os.path.exists(model_dir):
+            logging.warning('{} not found, skip it'.format(model_dir))
+            continue
+        if len(variants) == 0:
+            builders.append((model_dir, lambda model_dir=model_dir: build_pretrained_model(model_dir)))
+        for variant, kwargs in variants.items():
+            name = '{}/{}'.format(os.path.basename(os.path.normpath(model_dir)), variant)
+            builders.append((name, lambda model_dir=model_dir, name=name, kwargs=kwargs: build_pretrained_model(model_dir, name, **kwargs)))
+
+    results = []
+    for name, builder in builders:
+        start_time = time.time()
+        bm, peak_rss_delta = measure(builder)
+        load = {'name': '{}/load'.format(bm.name), 'latency': time.time() - start_time}
+        if peak_rss_delta is not None:
+            load['peak_rss_delta_mb'] = peak_rss_delta
+        logging.info('benchmark {}'.format(load))
+        results.append(load)
+        results += run_suite(bm, text_lens, concurrency, args.num_runs, args.seed)
+        del bm
+
+    columns = ['tokens_per_second', 'first_token_latency', 'first_chunk_latency', 'latency', 'rtf', 'peak_rss_delta_mb']
+    print('name\t{}'.format('\t'.join(columns)))
+    for result in results:
+        print('{}\t{}'.format(result['name'], '\t'.join(['{:.3f}'.format(result[i]) if i in result else '-' for i in columns])))
+    if args.output != '':
+        meta = {'time': time.strftime('%Y-%m-%d %H:%M:%S'), 'torch': torch.__version__, 'platform': platform.platform(),
+                'cpu_count': os.cpu_count(), 'num_threads': torch.get_num_threads(), 'cuda': torch.cuda.is_available(),
+                'text_len': text_lens, 'concurrency': concurrency, 'num_runs': args.num_runs, 'seed': args.seed}
+        with open(args.output, 'w') as f:
+            json.dump({'meta': meta, 'results': results}, f, indent=2)
+    if args.baseline != '':
+        with open(args.baseline, 'r') as f:
+            baseline = json.load(f)['results']
+        rows = compare(results, baseline, args.tolerance)
+        print('name\tmetric\tbaseline\tcurrent\tchange\tregression')
+        for row in rows:
+            print('{}\t{}\t{:.3f}\t{:.3f}\t{:+.1%}\t{}'.format(*row[:5], 'REGRESSION' if row[5] else ''))
+        regressions = [i for i in rows if i[5]]
+        logging.info('{} of {} metrics regress by more than {:.0%} against {}'.format(len(regressions), len(rows), args.tolerance, args.baseline))
+        if len(regressions) != 0:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,87 @@
+import os
+import tempfile
+import torch
+from hyperpyyaml import load_hyperpyyaml
+from cosyvoice.cli.model import CosyVoiceModel, CosyVoice2Model, CosyVoice3Model
+from cosyvoice.utils.file_utils import logging
+
+CONF_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'conf')
+# model name -> tiny config and model class
+TINY_MODELS = {'v1_tiny': ('tiny_cosyvoice.yaml', CosyVoiceModel),
+               'v2_tiny': ('tiny_cosyvoice2.yaml', CosyVoice2Model),
+               'v3_tiny': ('tiny_cosyvoice3.yaml', CosyVoice3Model)}
+# text of pretrained models, tokenized and cut to the benchmarked text lengths
+BENCHMARK_TEXT = '收到好友从远方寄来的生日礼物，那份意外的惊喜与深深的祝福让我心中充满了甜蜜的快乐，笑容如花儿般绽放。' \
+                 '八百标兵奔北坡，北坡炮兵并排跑，炮兵怕把标兵碰，标兵怕碰炮兵炮。' \
+                 '在他讲述那个荒诞故事的过程中，他突然停下来，因为他自己也被逗笑了。'
+
+
+class BenchmarkModel:
+    """a CosyVoiceModel/CosyVoice2Model/CosyVoice3Model and its benchmark inputs
+
+    text_token is a (1, N) text token sequence, benchmarked sentences are its prefixes.
+    embedding is the (1, spk_embed_dim) speaker embedding of llm and flow.
+    """
+
+    def __init__(self, name, model, sample_rate, text_token, embedding):
+        self.name = name
+        self.model = model
+        self.sample_rate = sample_rate
+        self.text_token = text_token
+        self.embedding = embedding
+
+    def text(self, text_len):
+        assert text_len <= self.text_token.shape[1], 'text_len {} is longer than the benchmark text {}'.format(text_len, self.text_token.shape[1])
+        return self.text_token[:, :text_len]
+
+
+def save_tiny_qwen2(path, hidden_size=128, vocab_size=4096, seed=1986):
+    """save a random initialized 2 layer Qwen2ForCausalLM, the pretrain_path of Qwen2Encoder in tiny configs"""
+    from transformers import Qwen2Config, Qwen2ForCausalLM
+    torch.manual_seed(seed)
+    config = Qwen2Config(vocab_size=vocab_size, hidden_size=hidden_size, intermediate_size=2 * hidden_size, num_hidden_layers=2,
+                         num_attention_heads=2, num_key_value_heads=1, max_position_embeddings=4096, tie_word_embeddings=True)
+    Qwen2ForCausalLM(config).save_pretrained(path)
+
+
+def text_vocab_size(llm):
+    if hasattr(llm, 'text_embedding'):
+        return llm.text_embedding.num_embeddings
+    return llm.llm.model.model.embed_tokens.num_embeddings
+
+
+def build_tiny_model(name, max_text_len=256, seed=1986):
+    """build a random initialized tiny model from its hyperpyyaml config"""
+    assert name in TINY_MODELS, 'unsupported tiny model {}, choose from {}'.format(name, '/'.join(TINY_MODELS))
+    conf, model_class = TINY_MODELS[name]
+    with tempfile.TemporaryDirectory() as qwen_dir:
+        overrides = {}
+        if model_class is not CosyVoiceModel:
+            save_tiny_qwen2(qwen_dir, seed=seed)
+            overrides['qwen_pretrain_path'] = qwen_dir
+        with open(os.path.join(CONF_DIR, conf), 'r') as f:
+            configs = load_hyperpyyaml(f, overrides=overrides)
+    model = model_class(configs['llm'], configs['flow'], configs['hift'])
+    for module in [model.llm, model.flow, model.hift]:
+        module.to(model.device).eval()
+    generator = torch.Generator().manual_seed(seed)
+    text_token = torch.randint(0, text_vocab_size(model.llm), (1, max_text_len), dtype=torch.int32, generator=generator)
+    embedding = torch.randn(1, configs['spk_embed_dim'], generator=generator)
+    return BenchmarkModel(name, model, configs['sample_rate'], text_token, embedding)
+
+
+def build_pretrained_model(model_dir, name=None, **kwargs):
+    """load a pretrained model by AutoModel with kwargs, the benchmark text is the repeated BENCHMARK_TEXT
+
+    name defaults to the base name of model_dir.
+    """
+    from cosyvoice.cli.cosyvoice import AutoModel
+    cosyvoice = AutoModel(model_dir=model_dir, **kwargs)
+    text_token, _ = cosyvoice.frontend._extract_text_token(BENCHMARK_TEXT * 4)
+    spks = cosyvoice.list_available_spks()
+    if len(spks) != 0:
+        embedding = cosyvoice.frontend.spk2info[spks[0]]['llm_embedding' if 'llm_embedding' in cosyvoice.frontend.spk2info[spks[0]] else 'embedding']
+    else:
+        logging.warning('no speaker in spk2info of {}, use a random speaker embedding'.format(model_dir))
+        embedding = torch.randn(1, 192, generator=torch.Generator().manual_seed(1986))
+    return BenchmarkModel(name if name is not None else os.path.basename(os.path.normpath(model_dir)), cosyvoice.model, cosyvoice.sample_rate, text_token.cpu(), embedding.cpu())
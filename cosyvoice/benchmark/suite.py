@@ -0,0 +1,179 @@
+import threading
+import time
+import torch
+from cosyvoice.utils.common import set_all_random_seed
+from cosyvoice.utils.file_utils import logging
+
+# metric -> 1 if higher is better, -1 if lower is better, other metrics are informational
+METRIC_DIRECTIONS = {'tokens_per_second': 1, 'first_token_latency': -1, 'latency': -1, 'first_chunk_latency': -1, 'rtf': -1, 'peak_rss_delta_mb': -1}
+
+
+def rss_mb():
+    """current and peak rss of this process in MB, the peak is since the last reset_peak_rss, None where /proc is missing"""
+    try:
+        with open('/proc/self/status', 'r') as f:
+            status = dict([i.split(':', 1) for i in f])
+    except OSError:
+        return None
+    return int(status['VmRSS'].split()[0]) / 1024, int(status['VmHWM'].split()[0]) / 1024
+
+
+def reset_peak_rss():
+    """reset the peak rss to the current rss, return False if the platform does not support it"""
+    # NOTE ru_maxrss never goes down, writing 5 to clear_refs resets VmHWM instead (linux >= 4.0)
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+        return True
+    except OSError:
+        return False
+
+
+def measure(fn):
+    """run fn, return its output and the peak rss during fn minus the rss before it, None where the peak rss can not be reset"""
+    rss = rss_mb()
+    reset = rss is not None and reset_peak_rss()
+    output = fn()
+    return output, rss_mb()[1] - rss[0] if reset else None
+
+
+def average(records):
+    return {k: sum([i[k] for i in records]) / len(records) for k in records[0]}
+
+
+def repeat(fn, num_runs, seed):
+    """run fn once as warmup and num_runs times with the same seed, return the output of the last run and averaged metrics"""
+    set_all_random_seed(seed)
+    fn()
+    records = []
+    for _ in range(num_runs):
+        set_all_random_seed(seed)
+        output, metrics = fn()
+        records.append(metrics)
+    return output, average(records)
+
+
+def run_llm(bm, text):
+    device = bm.model.device
+    start_time, first_token_latency, tokens = time.time(), None, []
+    for token in bm.model.llm.inference(text=text.to(device),
+                                        text_len=torch.tensor([text.shape[1]], dtype=torch.int32).to(device),
+                                        prompt_text=torch.zeros(1, 0, dtype=torch.int32).to(device),
+                                        prompt_text_len=torch.tensor([0], dtype=torch.int32).to(device),
+                                        prompt_speech_token=torch.zeros(1, 0, dtype=torch.int32).to(device),
+                                        prompt_speech_token_len=torch.tensor([0], dtype=torch.int32).to(device),
+                                        embedding=bm.embedding.to(device),
+                                        uuid='benchmark'):
+        if first_token_latency is None:
+            first_token_latency = time.time() - start_time
+        tokens.append(token)
+    latency = time.time() - start_time
+    return tokens, {'tokens': len(tokens), 'tokens_per_second': len(tokens) / latency, 'first_token_latency': first_token_latency, 'latency': latency}
+
+
+def run_flow(bm, tokens):
+    flow, device = bm.model.flow, bm.model.device
+    kwargs = {'token': torch.tensor([tokens], dtype=torch.int32, device=device),
+              'token_len': torch.tensor([len(tokens)], dtype=torch.int32, device=device),
+              'prompt_token': torch.zeros(1, 0, dtype=torch.int32, device=device),
+              'prompt_token_len': torch.tensor([0], dtype=torch.int32, device=device),
+              'prompt_feat': torch.zeros(1, 0, 80, device=device),
+              'prompt_feat_len': torch.tensor([0], dtype=torch.int32, device=device),
+              'embedding': bm.embedding.to(device)}
+    if bm.model.__class__.__name__ == 'CosyVoiceModel':
+        kwargs['flow_cache'] = torch.zeros(1, 80, 0, 2, device=device)
+    else:
+        kwargs['streaming'], kwargs['finalize'] = False, True
+    start_time = time.time()
+    mel, _ = flow.inference(**kwargs)
+    latency = time.time() - start_time
+    return mel, {'mel_frames': mel.shape[2], 'latency': latency}
+
+
+def run_hift(bm, mel):
+    start_time = time.time()
+    speech, _ = bm.model.hift.inference(speech_feat=mel)
+    latency = time.time() - start_time
+    speech_len = speech.shape[1] / bm.sample_rate
+    return speech, {'speech_len': speech_len, 'latency': latency, 'rtf': latency / speech_len}
+
+
+def run_tts(bm, text, stream):
+    start_time, first_chunk_latency, speech_len = time.time(), None, 0
+    for output in bm.model.tts(text=text, flow_embedding=bm.embedding, llm_embedding=bm.embedding, stream=stream):
+        if first_chunk_latency is None:
+            first_chunk_latency = time.time() - start_time
+        speech_len += output['tts_speech'].shape[1] / bm.sample_rate
+    latency = time.time() - start_time
+    metrics = {'speech_len': speech_len, 'latency': latency, 'rtf': latency / speech_len}
+    if stream is True:
+        metrics['first_chunk_latency'] = first_chunk_latency
+    return None, metrics
+
+
+def run_concurrent_tts(bm, text, concurrency):
+    """concurrency threads synthesize the same text, rtf is the wall time over the total speech"""
+    records = [None] * concurrency
+
+    def job(index):
+        records[index] = run_tts(bm, text, False)[1]
+    threads = [threading.Thread(target=job, args=(i,)) for i in range(concurrency)]
+    start_time = time.time()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    wall_time = time.time() - start_time
+    speech_len = sum([i['speech_len'] for i in records])
+    return None, {'speech_len': speech_len, 'latency': sum([i['latency'] for i in records]) / concurrency, 'rtf': wall_time / speech_len}
+
+
+def run_suite(bm, text_lens, concurrency, num_runs=3, seed=0):
+    """benchmark the stages of bm in isolation and end to end, return a list of {'name': ..., metric: value} records
+
+    llm decodes the text prefixes of text_lens tokens, flow and hift run on the decoded tokens, so with the same
+    seed every stage sees the same input across runs. Concurrency levels synthesize the longest text.
+    peak_rss_delta_mb is the peak rss of a case minus the rss before it, so it does not depend on earlier cases,
+    it is left out where the peak rss can not be reset.
+    """
+    results = []
+
+    def record(name, fn):
+        (output, metrics), peak_rss_delta = measure(lambda: repeat(fn, num_runs, seed))
+        metrics = {'name': '{}/{}'.format(bm.name, name), **metrics}
+        if peak_rss_delta is not None:
+            metrics['peak_rss_delta_mb'] = peak_rss_delta
+        logging.info('benchmark {}'.format(metrics))
+        results.append(metrics)
+        return output
+
+    for text_len in text_lens:
+        text = bm.text(text_len)
+        tokens = record('llm/text_len={}'.format(text_len), lambda: run_llm(bm, text))
+        mel = record('flow/text_len={}'.format(text_len), lambda: run_flow(bm, tokens))
+        record('hift/text_len={}'.format(text_len), lambda: run_hift(bm, mel))
+        record('tts/text_len={}'.format(text_len), lambda: run_tts(bm, text, False))
+        record('tts_stream/text_len={}'.format(text_len), lambda: run_tts(bm, text, True))
+    for n in concurrency:
+        record('tts_concurrency={}/text_len={}'.format(n, max(text_lens)), lambda: run_concurrent_tts(bm, bm.text(max(text_lens)), n))
+    return results
+
+
+def compare(results, baseline, tolerance=0.1):
+    """compare results with baseline results of the same names
+
+    Returns rows of (name, metric, baseline value, current value, relative change, regression), a metric regresses
+    when it is worse than the baseline by more than tolerance.
+    """
+    baseline = {i['name']: i for i in baseline}
+    rows = []
+    for result in results:
+        if result['name'] not in baseline:
+            continue
+        for metric, direction in METRIC_DIRECTIONS.items():
+            if metric not in result or metric not in baseline[result['name']]:
+                continue
+            base, current = baseline[result['name']][metric], result[metric]
+            change = (current - base) / base if base != 0 else 0.0
+            rows.append((result['name'], metric, base, current, change, change * direction < -tolerance))
+    return rows
@@ -0,0 +1,151 @@
+from __future__ import print_function
+
+import argparse
+import logging
+logging.getLogger('matplotlib').setLevel(logging.WARNING)
+import os
+import sys
+import time
+import torch
+ROOT_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.append('{}/../..'.format(ROOT_DIR))
+sys.path.append('{}/../../third_party/Matcha-TTS'.format(ROOT_DIR))
+from cosyvoice.cli.cosyvoice import AutoModel
+from cosyvoice.flow.ode_solvers import ODE_SOLVER_NFE
+from cosyvoice.utils.common import set_all_random_seed
+from cosyvoice.utils.file_utils import logging
+
+
+def get_args():
+    parser = argparse.ArgumentParser(description='evaluate flow matching ode solvers and cfg schedules against the 10 step euler reference')
+    parser.add_argument('--model_dir',
+                        type=str,
+                        default='pretrained_models/CosyVoice2-0.5B',
+                        help='local path')
+    parser.add_argument('--text',
+                        type=str,
+                        default='收到好友从远方寄来的生日礼物，那份意外的惊喜与深深的祝福让我心中充满了甜蜜的快乐，笑容如花儿般绽放。',
+                        help='text to synthesize')
+    parser.add_argument('--prompt_text',
+                        type=str,
+                        default='',
+                        help='prompt text, use the first sft speaker when empty')
+    parser.add_argument('--prompt_wav',
+                        type=str,
+                        default='',
+                        help='prompt wav')
+    parser.add_argument('--solvers',
+                        type=str,
+                        default='euler,midpoint,heun,ab2',
+                        help='comma separated ode solvers')
+    parser.add_argument('--steps',
+                        type=str,
+                        default='2,4,6,8,10',
+                        help='comma separated n_timesteps')
+    parser.add_argument('--cfg_rate',
+                        type=float,
+                        default=None,
+                        help='classifier free guidance rate, use model default when not set')
+    parser.add_argument('--cfg_schedules',
+                        type=str,
+                        default='all',
+                        help='comma separated cfg schedules, all for every step, k for the first k steps, '
+                             'or slash separated per step rates like 0.7/0.7/0/0')
+    parser.add_argument('--num_runs',
+                        type=int,
+                        default=3,
+                        help='runs per setting, wall time is averaged')
+    parser.add_argument('--seed',
+                        type=int,
+                        default=0,
+                        help='random seed')
+    args = parser.parse_args()
+    print(args)
+    return args
+
+
+def parse_cfg_schedule(cfg_schedule):
+    if cfg_schedule == 'all':
+        return None
+    if '/' in cfg_schedule:
+        return [float(i) for i in cfg_schedule.split('/')]
+    return int(cfg_schedule)
+
+
+def get_speech_token(model, model_input, seed):
+    set_all_random_seed(seed)
+    device = model.model.device
+    token_generator = model.model.llm.inference(text=model_input['text'].to(device),
+                                                text_len=torch.tensor([model_input['text'].shape[1]], dtype=torch.int32).to(device),
+                                                prompt_text=model_input['prompt_text'].to(device),
+                                                prompt_text_len=torch.tensor([model_input['prompt_text'].shape[1]], dtype=torch.int32).to(device),
+                                                prompt_speech_token=model_input['llm_prompt_speech_token'].to(device),
+                                                prompt_speech_token_len=torch.tensor([model_input['llm_prompt_speech_token'].shape[1]], dtype=torch.int32).to(device),
+                                                embedding=model_input['llm_embedding'].to(device),
+                                                uuid='eval_flow_solver')
+    return torch.tensor([list(token_generator)], dtype=torch.int32)
+
+
+def flow_inference(model, model_input, token, flow_conf, seed):
+    # NOTE same seed for every setting, so all solvers start from the same noise
+    set_all_random_seed(seed)
+    device = model.model.device
+    kwargs = {'token': token.to(device),
+              'token_len': torch.tensor([token.shape[1]], dtype=torch.int32).to(device),
+              'prompt_token': model_input['flow_prompt_speech_token'].to(device),
+              'prompt_token_len': torch.tensor([model_input['flow_prompt_speech_token'].shape[1]], dtype=torch.int32).to(device),
+              'prompt_feat': model_input['prompt_speech_feat'].to(device),
+              'prompt_feat_len': torch.tensor([model_input['prompt_speech_feat'].shape[1]], dtype=torch.int32).to(device),
+              'embedding': model_input['flow_embedding'].to(device)}
+    if model.__class__.__name__ == 'CosyVoice':
+        kwargs['flow_cache'] = torch.zeros(1, 80, 0, 2, device=device)
+    else:
+        kwargs['streaming'], kwargs['finalize'] = False, True
+    start_time = time.time()
+    with torch.cuda.amp.autocast(model.model.fp16):
+        mel, _ = model.model.flow.inference(**kwargs, **flow_conf)
+    if torch.cuda.is_available():
+        torch.cuda.synchronize()
+    return mel.float().cpu(), time.time() - start_time
+
+
+def main():
+    args = get_args()
+    logging.basicConfig(level=logging.DEBUG,
+                        format='%(asctime)s %(levelname)s %(message)s')
+
+    model = AutoModel(model_dir=args.model_dir)
+    if args.prompt_wav != '':
+        model_input = model.frontend.frontend_zero_shot(args.text, args.prompt_text, args.prompt_wav, model.sample_rate, '')
+    else:
+        model_input = model.frontend.frontend_sft(args.text, model.list_available_spks()[0])
+    token = get_speech_token(model, model_input, args.seed)
+    logging.info('speech token len {}'.format(token.shape[1]))
+
+    # warmup and reference
+    flow_inference(model, model_input, token, {'n_timesteps': 10, 'solver': 'euler', 'cfg_rate': args.cfg_rate, 'cfg_schedule': None}, args.seed)
+    reference, reference_time = flow_inference(model, model_input, token, {'n_timesteps': 10, 'solver': 'euler', 'cfg_rate': args.cfg_rate, 'cfg_schedule': None}, args.seed)
+
+    decoder = model.model.flow.decoder
+    print('solver\tsteps\tcfg\tnfe\testimator batch\tmel l1\tmel mse\twall time\tspeedup')
+    for solver in args.solvers.split(','):
+        for n_timesteps in [int(i) for i in args.steps.split(',')]:
+            for cfg_schedule in args.cfg_schedules.split(','):
+                flow_conf = {'n_timesteps': n_timesteps, 'solver': solver, 'cfg_rate': args.cfg_rate, 'cfg_schedule': parse_cfg_schedule(cfg_schedule)}
+                if isinstance(flow_conf['cfg_schedule'], list) and len(flow_conf['cfg_schedule']) != n_timesteps:
+                    continue
+                # estimator batch rows summed over all calls, guided calls run batch 2, unguided ones batch 1
+                cfg_rates = decoder.get_cfg_schedule(n_timesteps, flow_conf['cfg_rate'], flow_conf['cfg_schedule'])
+                rows = ODE_SOLVER_NFE[solver] * sum([1 if i == 0 else 2 for i in cfg_rates])
+                durations = []
+                for _ in range(args.num_runs):
+                    mel, duration = flow_inference(model, model_input, token, flow_conf, args.seed)
+                    durations.append(duration)
+                duration = sum(durations) / len(durations)
+                l1, mse = (mel - reference).abs().mean().item(), (mel - reference).pow(2).mean().item()
+                print('{}\t{}\t{}\t{}\t{}\t{:.4f}\t{:.4f}\t{:.3f}\t{:.2f}'.format(solver, n_timesteps, cfg_schedule, n_timesteps * ODE_SOLVER_NFE[solver], rows,
+                                                                              l1, mse, duration, reference_time / duration))
+
+
+if __name__ == '__main__':
+    main()
@@ -22,12 +22,14 @@ import os
 import sys
 import onnxruntime
 import random
+import time
 import torch
 from tqdm import tqdm
 ROOT_DIR = os.path.dirname(os.path.abspath(__file__))
 sys.path.append('{}/../..'.format(ROOT_DIR))
 sys.path.append('{}/../../third_party/Matcha-TTS'.format(ROOT_DIR))
 from cosyvoice.cli.cosyvoice import AutoModel
+from cosyvoice.utils.common import OrtSessionWrapper, OrtEstimatorWrapper
 from cosyvoice.utils.file_utils import logging
 
 
@@ -41,12 +43,91 @@ def get_dummy_input(batch_size, seq_len, out_channels, device):
     return x, mask, mu, t, spks, cond
 
 
+def get_hift_dummy_input(hift, seq_len, device):
+    # NOTE causal hift takes conv_pre_look_right extra mel frames as lookahead
+    look_right = getattr(hift, 'conv_pre_look_right', 0)
+    stft_len = seq_len * int(hift.f0_upsamp.scale_factor) // hift.istft_params['hop_len'] + 1
+    x = torch.rand((1, 80, seq_len + look_right), dtype=torch.float32, device=device)
+    s_stft = torch.rand((1, hift.istft_params['n_fft'] + 2, stft_len), dtype=torch.float32, device=device)
+    return x, s_stft
+
+
+class EstimatorWrapper(torch.nn.Module):
+    def __init__(self, estimator, streaming):
+        super().__init__()
+        self.estimator = estimator
+        self.streaming = streaming
+
+    def forward(self, x, mask, mu, t, spks, cond):
+        return self.estimator(x, mask, mu, t, spks, cond, streaming=self.streaming)
+
+
+class HiFTDecodeWrapper(torch.nn.Module):
+    def __init__(self, hift):
+        super().__init__()
+        self.hift = hift
+
+    def forward(self, x, s_stft):
+        return self.hift.decode_spec(x, s_stft)
+
+
+def export_ort_estimator(estimator, out_channels, streaming, onnx_model, device):
+    x, mask, mu, t, spks, cond = get_dummy_input(2, 256, out_channels, device)
+    torch.onnx.export(
+        EstimatorWrapper(estimator, streaming),
+        (x, mask, mu, t, spks, cond),
+        onnx_model,
+        export_params=True,
+        opset_version=18,
+        do_constant_folding=True,
+        input_names=['x', 'mask', 'mu', 't', 'spks', 'cond'],
+        output_names=['estimator_out'],
+        dynamic_axes={
+            'x': {0: 'batch_size', 2: 'seq_len'},
+            'mask': {0: 'batch_size', 2: 'seq_len'},
+            'mu': {0: 'batch_size', 2: 'seq_len'},
+            't': {0: 'batch_size'},
+            'spks': {0: 'batch_size'},
+            'cond': {0: 'batch_size', 2: 'seq_len'},
+            'estimator_out': {0: 'batch_size', 2: 'seq_len'},
+        }
+    )
+
+
+def export_ort_hift(hift, onnx_model, device):
+    x, s_stft = get_hift_dummy_input(hift, 100, device)
+    torch.onnx.export(
+        HiFTDecodeWrapper(hift),
+        (x, s_stft),
+        onnx_model,
+        export_params=True,
+        opset_version=18,
+        do_constant_folding=True,
+        input_names=['x', 's_stft'],
+        output_names=['magnitude', 'phase'],
+        dynamic_axes={
+            'x': {2: 'seq_len'},
+            's_stft': {2: 'stft_len'},
+            'magnitude': {2: 'stft_len'},
+            'phase': {2: 'stft_len'},
+        }
+    )
+
+
 def get_args():
     parser = argparse.ArgumentParser(description='export your model for deployment')
     parser.add_argument('--model_dir',
                         type=str,
                         default='pretrained_models/CosyVoice-300M',
                         help='local path')
+    parser.add_argument('--ort_intra_op_num_threads',
+                        type=int,
+                        default=4,
+                        help='onnxruntime intra op threads used in the rtf comparison')
+    parser.add_argument('--rtf_seq_len',
+                        type=int,
+                        default=500,
+                        help='mel frames used in the rtf comparison')
     args = parser.parse_args()
     print(args)
     return args
@@ -109,6 +190,39 @@ def main():
         torch.testing.assert_allclose(output_pytorch, torch.from_numpy(output_onnx).to(device), rtol=1e-2, atol=1e-4)
     logging.info('successfully export estimator')
 
+    # 3. export onnxruntime cpu estimator and hift decode, batch size and time are dynamic
+    hift = model.model.hift
+    hift.eval()
+    streaming_list = [False] if estimator.__class__.__name__ == 'ConditionalDecoder' else [False, True]
+    for streaming in streaming_list:
+        export_ort_estimator(estimator, out_channels, streaming,
+                             '{}/flow.decoder.estimator.{}ort.onnx'.format(args.model_dir, 'streaming.' if streaming is True else ''), device)
+    export_ort_hift(hift, '{}/hift.decode.ort.onnx'.format(args.model_dir), device)
+
+    # NOTE onnxruntime parity against eager mode is tested in tests/test_export_onnx.py
+    estimator_ort = OrtEstimatorWrapper('{}/flow.decoder.estimator.ort.onnx'.format(args.model_dir),
+                                        '{}/flow.decoder.estimator.streaming.ort.onnx'.format(args.model_dir) if len(streaming_list) == 2 else None,
+                                        intra_op_num_threads=args.ort_intra_op_num_threads)
+    hift_ort = OrtSessionWrapper('{}/hift.decode.ort.onnx'.format(args.model_dir), intra_op_num_threads=args.ort_intra_op_num_threads)
+    logging.info('successfully export onnxruntime estimator and hift decode')
+
+    # 4. rtf comparison, estimator rtf counts the 10 steps of cfg batch 2 calls, hift rtf is the mean of 10 calls
+    audio_len = args.rtf_seq_len * int(hift.f0_upsamp.scale_factor) / model.sample_rate
+    x, mask, mu, t, spks, cond = get_dummy_input(2, args.rtf_seq_len, out_channels, device)
+    hift_x, s_stft = get_hift_dummy_input(hift, args.rtf_seq_len, device)
+    for name, estimator_fn, hift_fn in [['pytorch', estimator, hift.decode_spec], ['onnxruntime', estimator_ort, hift_ort]]:
+        estimator_fn(x, mask, mu, t, spks, cond)
+        start_time = time.time()
+        for _ in range(10):
+            estimator_fn(x, mask, mu, t, spks, cond)
+        estimator_rtf = (time.time() - start_time) / audio_len
+        hift_fn(hift_x, s_stft)
+        start_time = time.time()
+        for _ in range(10):
+            hift_fn(hift_x, s_stft)
+        hift_rtf = (time.time() - start_time) / 10 / audio_len
+        logging.info('{} estimator rtf {:.3f} hift decode rtf {:.3f}'.format(name, estimator_rtf, hift_rtf))
+
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,129 @@
+from __future__ import print_function
+
+import argparse
+import logging
+logging.getLogger('matplotlib').setLevel(logging.WARNING)
+import os
+import sys
+import time
+import torch
+ROOT_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.append('{}/../..'.format(ROOT_DIR))
+sys.path.append('{}/../../third_party/Matcha-TTS'.format(ROOT_DIR))
+from cosyvoice.cli.cosyvoice import AutoModel
+from cosyvoice.llm.ort_decoder import LLMStep, OrtLLMDecoder
+from cosyvoice.utils.file_utils import logging
+
+
+def get_args():
+    parser = argparse.ArgumentParser(description='export speech token llm prefill/decode graphs for onnxruntime cpu')
+    parser.add_argument('--model_dir',
+                        type=str,
+                        default='pretrained_models/CosyVoice2-0.5B',
+                        help='local path')
+    parser.add_argument('--ort_intra_op_num_threads',
+                        type=int,
+                        default=4,
+                        help='onnxruntime intra op threads used in the benchmark')
+    parser.add_argument('--text_len',
+                        type=int,
+                        default=20,
+                        help='random text tokens used in the benchmark')
+    parser.add_argument('--max_token_text_ratio',
+                        type=float,
+                        default=5,
+                        help='decoded speech tokens = text_len * max_token_text_ratio')
+    args = parser.parse_args()
+    print(args)
+    return args
+
+
+def run_llm(llm, text, max_token_text_ratio):
+    device = text.device
+    token_generator = llm.inference(text=text,
+                                    text_len=torch.tensor([text.shape[1]], dtype=torch.int32).to(device),
+                                    prompt_text=torch.zeros(1, 0, dtype=torch.int32).to(device),
+                                    prompt_text_len=torch.tensor([0], dtype=torch.int32).to(device),
+                                    prompt_speech_token=torch.zeros(1, 0, dtype=torch.int32).to(device),
+                                    prompt_speech_token_len=torch.tensor([0], dtype=torch.int32).to(device),
+                                    embedding=torch.zeros(0, 192).to(device),
+                                    max_token_text_ratio=max_token_text_ratio,
+                                    min_token_text_ratio=0)
+    start_time = time.time()
+    tokens = list(token_generator)
+    return tokens, len(tokens) / (time.time() - start_time)
+
+
+def greedy_sampling(llm):
+    # NOTE greedy over speech tokens so decoding always reaches max_len
+    return lambda weighted_scores, decoded_tokens, sampling: weighted_scores[:llm.speech_token_size].argmax().item()
+
+
+def export_ort_llm(llm, prefill_model, decode_model, device):
+    """export the prefill graph and the decode graph of llm, seq_len of decode is dynamic so several tokens could be appended in one step"""
+    step = LLMStep(llm)
+    step.eval()
+    cache_axis = 3 if step.is_qwen2 is True else 2
+    xs = torch.rand((1, 16, llm.llm_input_size), dtype=torch.float32, device=device)
+    torch.onnx.export(
+        step,
+        (xs,),
+        prefill_model,
+        export_params=True,
+        opset_version=18,
+        do_constant_folding=True,
+        input_names=['xs'],
+        output_names=['logp', 'cache'],
+        dynamic_axes={
+            'xs': {1: 'seq_len'},
+            'cache': {cache_axis: 'cache_len'},
+        }
+    )
+    _, cache = step(xs)
+    xs = torch.rand((1, 1, llm.llm_input_size), dtype=torch.float32, device=device)
+    torch.onnx.export(
+        step,
+        (xs, cache),
+        decode_model,
+        export_params=True,
+        opset_version=18,
+        do_constant_folding=True,
+        input_names=['xs', 'cache'],
+        output_names=['logp', 'new_cache'],
+        dynamic_axes={
+            'xs': {1: 'seq_len'},
+            'cache': {cache_axis: 'cache_len'},
+            'new_cache': {cache_axis: 'new_cache_len'},
+        }
+    )
+
+
+@torch.no_grad()
+def main():
+    args = get_args()
+    logging.basicConfig(level=logging.DEBUG,
+                        format='%(asctime)s %(levelname)s %(message)s')
+
+    model = AutoModel(model_dir=args.model_dir)
+    llm, device = model.model.llm, model.model.device
+    llm.eval()
+    prefill_model, decode_model = '{}/llm.prefill.ort.onnx'.format(args.model_dir), '{}/llm.decode.ort.onnx'.format(args.model_dir)
+    export_ort_llm(llm, prefill_model, decode_model, device)
+
+    # greedy decoding tokens/s, parity is asserted on tiny models in tests/test_export_onnx_llm.py
+    llm.sampling = greedy_sampling(llm)
+    ort_decoder = OrtLLMDecoder(llm, prefill_model, decode_model, intra_op_num_threads=args.ort_intra_op_num_threads)
+    text = torch.randint(0, 1000, (1, args.text_len), dtype=torch.int32, device=device)
+    run_llm(llm, text, 1)
+    tokens_pytorch, speed_pytorch = run_llm(llm, text, args.max_token_text_ratio)
+    llm.ort_decoder = ort_decoder
+    run_llm(llm, text, 1)
+    tokens_onnx, speed_onnx = run_llm(llm, text, args.max_token_text_ratio)
+    del llm.ort_decoder
+    mismatch = [i for i, (j, k) in enumerate(zip(tokens_pytorch, tokens_onnx)) if j != k]
+    logging.info('successfully export llm, greedy decoding of {} tokens, {} tokens differ from pytorch'.format(len(tokens_onnx), len(mismatch)))
+    logging.info('pytorch {:.2f} tokens/s onnxruntime {:.2f} tokens/s'.format(speed_pytorch, speed_onnx))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,68 @@
+from __future__ import print_function
+
+import argparse
+import logging
+logging.getLogger('matplotlib').setLevel(logging.WARNING)
+import os
+import sys
+ROOT_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.append('{}/../..'.format(ROOT_DIR))
+sys.path.append('{}/../../third_party/Matcha-TTS'.format(ROOT_DIR))
+from cosyvoice.cli.cosyvoice import AutoModel
+from cosyvoice.utils.file_utils import logging
+
+
+def get_args():
+    parser = argparse.ArgumentParser(description='trim a long zero-shot prompt wav to its best voiced region and re-align the prompt text')
+    parser.add_argument('--model_dir',
+                        type=str,
+                        default='pretrained_models/CosyVoice2-0.5B',
+                        help='local path, used to measure the expected cost reduction')
+    parser.add_argument('--prompt_wav',
+                        type=str,
+                        required=True,
+                        help='prompt wav')
+    parser.add_argument('--prompt_text',
+                        type=str,
+                        default='',
+                        help='transcript of the prompt wav, empty for cross lingual prompt')
+    parser.add_argument('--output_wav',
+                        type=str,
+                        required=True,
+                        help='trimmed prompt wav')
+    parser.add_argument('--min_sec',
+                        type=float,
+                        default=3.0,
+                        help='min prompt duration')
+    parser.add_argument('--max_sec',
+                        type=float,
+                        default=8.0,
+                        help='max prompt duration')
+    parser.add_argument('--sentence_sec',
+                        type=float,
+                        default=5.0,
+                        help='duration of a typical synthesized sentence, the expected cost is reported per sentence')
+    args = parser.parse_args()
+    print(args)
+    return args
+
+
+def main():
+    args = get_args()
+    logging.basicConfig(level=logging.DEBUG,
+                        format='%(asctime)s %(levelname)s %(message)s')
+
+    model = AutoModel(model_dir=args.model_dir)
+    prompt_text, wav, report = model.trim_prompt(args.prompt_text, args.prompt_wav, args.min_sec, args.max_sec, args.sentence_sec)
+    with open(args.output_wav, 'wb') as f:
+        f.write(wav.getvalue())
+
+    print('prompt text\t{}'.format(prompt_text))
+    print('region\t{:.2f}s - {:.2f}s{}'.format(report['start'], report['end'], '' if report['aligned'] else ' (not aligned with prompt text)'))
+    print('prompt sec\ttrimmed sec\tvoiced sec\tllm context\tflow frames')
+    print('{:.2f}\t{:.2f}\t{:.2f}\t{:.1%}\t{:.1%}'.format(report['prompt_sec'], report['trimmed_sec'], report['voiced_sec'],
+                                                    report['llm_context_ratio'], report['flow_frames_ratio']))
+
+
+if __name__ == '__main__':
+    main()
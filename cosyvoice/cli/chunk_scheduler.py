@@ -0,0 +1,81 @@
+import time
+from cosyvoice.utils.file_utils import logging
+
+
+class ChunkScheduler:
+    """Hop length scheduling of CosyVoice2/CosyVoice3 stream inference.
+
+    Every hop is a multiple of token_hop_len, so non-final chunks always end on a static chunk
+    boundary of the flow. The first hop is token_min_hop_len, which can not be shorter than one static chunk:
+    the flow encoder and estimator are trained with static_chunk_size chunk masks, a chunk ending inside a static
+    chunk would be decoded from a partial chunk and changed by later chunks, and the incremental flow cache only
+    resumes at chunk boundaries. So the first chunk latency is the same as with the fixed hop, the scheduler
+    only makes later hops as long as the measured rtf allows, for fewer token2wav calls without underrun.
+    After each chunk the scheduler simulates playback of the yielded speech and measures the rtf of
+    producing it (llm waiting plus token2wav). The next hop is the largest one that is expected to be ready
+    before the playback buffer runs out, growing at most stream_scale_factor times per chunk.
+    """
+
+    def __init__(self, token_hop_len, token_min_hop_len, token_max_hop_len, token_frame_rate,
+                 stream_scale_factor=2, buffer_ratio=0.8, rtf_smooth=0.5):
+        assert token_min_hop_len % token_hop_len == 0 and token_max_hop_len % token_hop_len == 0, \
+            'token_min_hop_len and token_max_hop_len should be multiples of token_hop_len {}'.format(token_hop_len)
+        assert token_min_hop_len <= token_max_hop_len
+        self.token_hop_len = token_hop_len
+        self.token_min_hop_len = token_min_hop_len
+        self.token_max_hop_len = token_max_hop_len
+        self.token_frame_rate = token_frame_rate
+        self.stream_scale_factor = stream_scale_factor
+        # only plan on this ratio of the buffered speech, the rest absorbs rtf jitter
+        self.buffer_ratio = buffer_ratio
+        self.rtf_smooth = rtf_smooth
+        self.hop_len = token_min_hop_len
+        self.start_time = self.last_time = time.time()
+        self.playback_end = None
+        self.rtf = None
+        self.first_chunk_latency = None
+        self.underrun, self.underrun_time = 0, 0.0
+        self.hop_lens = []
+
+    def _record(self, speech_len):
+        now = time.time()
+        if self.playback_end is None:
+            self.first_chunk_latency = now - self.start_time
+            self.playback_end = now + speech_len
+        elif now > self.playback_end:
+            # NOTE playback ran out before this chunk arrived
+            self.underrun += 1
+            self.underrun_time += now - self.playback_end
+            self.playback_end = now + speech_len
+        else:
+            self.playback_end += speech_len
+        if speech_len > 0:
+            chunk_rtf = (now - self.last_time) / speech_len
+            self.rtf = chunk_rtf if self.rtf is None else self.rtf_smooth * self.rtf + (1 - self.rtf_smooth) * chunk_rtf
+        self.last_time = now
+        return now
+
+    def update(self, speech_len):
+        """record a yielded non-final chunk of speech_len seconds and schedule the next hop"""
+        now = self._record(speech_len)
+        self.hop_lens.append(self.hop_len)
+        if self.rtf is None:
+            return self.hop_len
+        # largest hop expected to be ready before the buffered speech is played
+        buffer_len = (self.playback_end - now) * self.buffer_ratio
+        hop_len = int(buffer_len * self.token_frame_rate / max(self.rtf, 1e-6)) // self.token_hop_len * self.token_hop_len
+        max_hop_len = max(self.token_min_hop_len, int(self.hop_len * self.stream_scale_factor) // self.token_hop_len * self.token_hop_len)
+        self.hop_len = min(max(hop_len, self.token_min_hop_len), self.token_max_hop_len, max_hop_len)
+        return self.hop_len
+
+    def stats(self):
+        return {'first_chunk_latency': self.first_chunk_latency, 'underrun': self.underrun, 'underrun_time': self.underrun_time,
+                'rtf': self.rtf, 'hop_lens': self.hop_lens}
+
+    def finish(self, speech_len):
+        """record the final chunk and return the stream stats"""
+        self._record(speech_len)
+        stats = self.stats()
+        logging.info('stream first chunk latency {:.3f}s, underrun {} times {:.3f}s, rtf {:.3f}, hop lens {}'.format(
+            stats['first_chunk_latency'], stats['underrun'], stats['underrun_time'], stats['rtf'] if stats['rtf'] is not None else 0.0, stats['hop_lens']))
+        return stats
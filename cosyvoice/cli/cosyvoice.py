@@ -11,46 +11,71 @@
 # WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 # See the License for the specific language governing permissions and
 # limitations under the License.
+import io
 import os
 import time
+from contextlib import nullcontext
 from typing import Generator
 from tqdm import tqdm
 from hyperpyyaml import load_hyperpyyaml
 from modelscope import snapshot_download
 import torch
+import torchaudio
 from cosyvoice.cli.frontend import CosyVoiceFrontEnd
 from cosyvoice.cli.model import CosyVoiceModel, CosyVoice2Model, CosyVoice3Model
+from cosyvoice.cli.segment_pipeline import SegmentPipeline
+from cosyvoice.utils.common import init_empty_weights
 from cosyvoice.utils.file_utils import logging
+from cosyvoice.utils.prompt_utils import trim_prompt_wav
 from cosyvoice.utils.class_utils import get_model_type
 
 
+# NOTE cpu inference options shared by CosyVoice/CosyVoice2/CosyVoice3, passed as keyword arguments, see get_options
+DEFAULT_OPTIONS = {'load_llm_batcher': False, 'llm_batch_size': 8, 'load_flow_batcher': False, 'flow_batch_size': 4, 'flow_conf': None,
+                   'load_ort': False, 'load_ort_llm': False, 'ort_intra_op_num_threads': 4, 'ort_inter_op_num_threads': 1,
+                   'frontend_intra_op_num_threads': 1, 'frontend_inter_op_num_threads': 1, 'prompt_cache_size': 16,
+                   'quantize': None, 'quantize_hift': False, 'load_incremental_flow': False, 'flow_estimator_cache': False,
+                   'load_mmap': False, 'safetensors_cache': False, 'load_static_cache': False, 'static_cache_len': 2048,
+                   'load_cpu_compile': False, 'pipeline_depth': 1}
+
+
+def get_options(kwargs):
+    """DEFAULT_OPTIONS updated by kwargs, options that conflict with each other or with cuda are turned off with a warning"""
+    unknown = [i for i in kwargs if i not in DEFAULT_OPTIONS]
+    if len(unknown) != 0:
+        raise TypeError('unexpected keyword arguments {}'.format(unknown))
+    options = dict(DEFAULT_OPTIONS, **kwargs)
+    if options['load_mmap'] is True and options['quantize'] == 'int8':
+        options['load_mmap'] = False
+        logging.warning('int8 quantized state dict could not be mmaped, set load_mmap to False')
+    if options['load_mmap'] is False and options['safetensors_cache'] is True:
+        options['safetensors_cache'] = False
+        logging.warning('safetensors cache is only used by load_mmap, set safetensors_cache to False')
+    assert options['quantize'] in [None, 'int8', 'bf16'], 'unsupported quantize {}, choose from None/int8/bf16'.format(options['quantize'])
+    if torch.cuda.is_available() is True and (options['quantize'] is not None or options['quantize_hift'] is True):
+        options['quantize'], options['quantize_hift'] = None, False
+        logging.warning('quantize only supports cpu inference, set quantize/quantize_hift to None/False')
+    if options['load_cpu_compile'] is True and (torch.cuda.is_available() is True or options['quantize'] is not None or
+                                                options['quantize_hift'] is True or options['load_ort'] is True):
+        options['load_cpu_compile'] = False
+        logging.warning('cpu compile traces fp32 pytorch modules on cpu, it does not support cuda/quantize/onnxruntime, set load_cpu_compile to False')
+    return options
+
+
 class CosyVoice:
 
-    def __init__(self, model_dir, load_jit=False, load_trt=False, fp16=False, trt_concurrent=1):
+    def __init__(self, model_dir, load_jit=False, load_trt=False, fp16=False, trt_concurrent=1, **kwargs):
         self.model_dir = model_dir
         self.fp16 = fp16
         if not os.path.exists(model_dir):
             model_dir = snapshot_download(model_dir)
-        hyper_yaml_path = '{}/cosyvoice.yaml'.format(model_dir)
-        if not os.path.exists(hyper_yaml_path):
-            raise ValueError('{} not found!'.format(hyper_yaml_path))
-        with open(hyper_yaml_path, 'r') as f:
-            configs = load_hyperpyyaml(f)
-        assert get_model_type(configs) == CosyVoiceModel, 'do not use {} for CosyVoice initialization!'.format(model_dir)
-        self.frontend = CosyVoiceFrontEnd(configs['get_tokenizer'],
-                                          configs['feat_extractor'],
-                                          '{}/campplus.onnx'.format(model_dir),
-                                          '{}/speech_tokenizer_v1.onnx'.format(model_dir),
-                                          '{}/spk2info.pt'.format(model_dir),
-                                          configs['allowed_special'])
-        self.sample_rate = configs['sample_rate']
+        options = get_options(kwargs)
+        configs = self.load_configs(model_dir, 'cosyvoice.yaml', 'speech_tokenizer_v1.onnx', CosyVoiceModel, options)
         if torch.cuda.is_available() is False and (load_jit is True or load_trt is True or fp16 is True):
             load_jit, load_trt, fp16 = False, False, False
             logging.warning('no cuda device, set load_jit/load_trt/fp16 to False')
         self.model = CosyVoiceModel(configs['llm'], configs['flow'], configs['hift'], fp16)
-        self.model.load('{}/llm.pt'.format(model_dir),
-                        '{}/flow.pt'.format(model_dir),
-                        '{}/hift.pt'.format(model_dir))
+        self.load_weights(model_dir, options)
         if load_jit:
             self.model.load_jit('{}/llm.text_encoder.{}.zip'.format(model_dir, 'fp16' if self.fp16 is True else 'fp32'),
                                 '{}/llm.llm.{}.zip'.format(model_dir, 'fp16' if self.fp16 is True else 'fp32'),
@@ -60,8 +85,118 @@ class CosyVoice:
                                 '{}/flow.decoder.estimator.fp32.onnx'.format(model_dir),
                                 trt_concurrent,
                                 self.fp16)
+        self.load_options(model_dir, options, load_jit=load_jit, load_trt=load_trt)
         del configs
 
+    def load_configs(self, model_dir, hyper_yaml, speech_tokenizer, model_type, options, overrides=None):
+        """load the hyperpyyaml configs of model_dir, build the frontend and the segment pipeline"""
+        hyper_yaml_path = '{}/{}'.format(model_dir, hyper_yaml)
+        if not os.path.exists(hyper_yaml_path):
+            raise ValueError('{} not found!'.format(hyper_yaml_path))
+        with open(hyper_yaml_path, 'r') as f, init_empty_weights() if options['load_mmap'] is True else nullcontext():
+            configs = load_hyperpyyaml(f, overrides=overrides)
+        assert get_model_type(configs) == model_type, 'do not use {} for {} initialization!'.format(model_dir, self.__class__.__name__)
+        self.frontend = CosyVoiceFrontEnd(configs['get_tokenizer'],
+                                          configs['feat_extractor'],
+                                          '{}/campplus.onnx'.format(model_dir),
+                                          '{}/{}'.format(model_dir, speech_tokenizer),
+                                          '{}/spk2info.pt'.format(model_dir),
+                                          configs['allowed_special'],
+                                          intra_op_num_threads=options['frontend_intra_op_num_threads'],
+                                          inter_op_num_threads=options['frontend_inter_op_num_threads'],
+                                          prompt_cache_size=options['prompt_cache_size'])
+        self.sample_rate = configs['sample_rate']
+        # NOTE pipeline_depth > 1 overlaps llm decoding of the next text segments with flow/hift of the current one
+        self.pipeline = SegmentPipeline(options['pipeline_depth'])
+        return configs
+
+    def load_weights(self, model_dir, options):
+        if options['quantize'] == 'int8':
+            self.model.load_int8('{}/llm.pt'.format(model_dir),
+                                 '{}/flow.pt'.format(model_dir),
+                                 '{}/hift.pt'.format(model_dir))
+        elif options['load_mmap']:
+            self.model.load_mmap('{}/llm.pt'.format(model_dir),
+                                 '{}/flow.pt'.format(model_dir),
+                                 '{}/hift.pt'.format(model_dir),
+                                 options['safetensors_cache'])
+        else:
+            self.model.load('{}/llm.pt'.format(model_dir),
+                            '{}/flow.pt'.format(model_dir),
+                            '{}/hift.pt'.format(model_dir))
+        # NOTE hift convolutions could not be dynamically quantized, quantize_hift runs hift in bf16 autocast instead
+        bf16_modules = (['llm', 'flow'] if options['quantize'] == 'bf16' else []) + (['hift'] if options['quantize_hift'] is True else [])
+        if len(bf16_modules) != 0:
+            self.model.load_bf16(bf16_modules)
+
+    def load_options(self, model_dir, options, load_jit=False, load_trt=False, load_vllm=False):
+        """load the cpu inference options after the weights and the cuda backends, turn off the ones the loaded model does not support"""
+        load_ort, load_ort_llm, load_llm_batcher, load_flow_batcher = options['load_ort'], options['load_ort_llm'], options['load_llm_batcher'], options['load_flow_batcher']
+        if load_vllm:
+            if load_llm_batcher:
+                logging.warning('vllm already batches llm decoding, set load_llm_batcher to False')
+                load_llm_batcher = False
+            if load_ort_llm:
+                logging.warning('vllm is loaded, set load_ort_llm to False')
+                load_ort_llm = False
+        if load_ort:
+            if load_trt:
+                logging.warning('tensorrt estimator is loaded, set load_ort to False')
+                load_ort = False
+            else:
+                self.model.load_ort('{}/flow.decoder.estimator.ort.onnx'.format(model_dir),
+                                    '{}/flow.decoder.estimator.streaming.ort.onnx'.format(model_dir),
+                                    '{}/hift.decode.ort.onnx'.format(model_dir),
+                                    options['ort_intra_op_num_threads'],
+                                    options['ort_inter_op_num_threads'])
+        if load_ort_llm:
+            if load_llm_batcher:
+                logging.warning('llm batcher is loaded, set load_ort_llm to False')
+                load_ort_llm = False
+            else:
+                self.model.load_ort_llm('{}/llm.prefill.ort.onnx'.format(model_dir),
+                                        '{}/llm.decode.ort.onnx'.format(model_dir),
+                                        options['ort_intra_op_num_threads'],
+                                        options['ort_inter_op_num_threads'])
+        if load_llm_batcher:
+            self.model.load_llm_batcher(options['llm_batch_size'])
+        if options['load_static_cache']:
+            if not isinstance(self.model, CosyVoice2Model):
+                logging.warning('static kv cache decoding only supports CosyVoice2/3, set load_static_cache to False')
+            elif load_vllm or load_llm_batcher or load_ort_llm:
+                logging.warning('llm is decoded by vllm/llm batcher/onnxruntime, set load_static_cache to False')
+            elif options['quantize'] == 'bf16':
+                logging.warning('static kv cache is allocated in the llm weight dtype, it does not support bf16 autocast, set load_static_cache to False')
+            else:
+                self.model.load_static_cache(options['static_cache_len'], compile=options['load_cpu_compile'])
+        if load_flow_batcher:
+            if load_trt or load_ort:
+                logging.warning('flow batcher does not support tensorrt/onnxruntime estimator, set load_flow_batcher to False')
+                load_flow_batcher = False
+            else:
+                self.model.load_flow_batcher(options['flow_batch_size'])
+        if options['load_cpu_compile']:
+            if not isinstance(self.model, CosyVoice2Model):
+                # NOTE GroupNorm in ConditionalDecoder normalizes over time, so the padded bucket inputs change its output
+                logging.warning('cpu compile pads estimator inputs, which ConditionalDecoder does not support, only compile hift')
+            elif load_flow_batcher:
+                logging.warning('flow batcher batches the pytorch estimator, only compile hift')
+            self.model.load_cpu_compile('{}/cpu_compile'.format(model_dir), '{}/flow.pt'.format(model_dir), '{}/hift.pt'.format(model_dir),
+                                        compile_estimator=isinstance(self.model, CosyVoice2Model) and not load_flow_batcher)
+        if options['load_incremental_flow']:
+            if not hasattr(self.model.flow, 'init_flow_cache'):
+                logging.warning('incremental flow only supports CosyVoice2, set load_incremental_flow to False')
+            elif load_jit:
+                logging.warning('jit flow encoder does not support incremental flow, set load_incremental_flow to False')
+            else:
+                flow_estimator_cache = options['flow_estimator_cache']
+                if flow_estimator_cache and (not isinstance(self.model.flow.decoder.estimator, torch.nn.Module) or hasattr(self.model.flow.decoder, 'batcher')):
+                    logging.warning('flow estimator cache only supports pytorch estimator without batcher, set flow_estimator_cache to False')
+                    flow_estimator_cache = False
+                self.model.load_incremental_flow(flow_estimator_cache)
+        if options['flow_conf'] is not None:
+            self.model.set_flow_conf(**options['flow_conf'])
+
     def list_available_spks(self):
         spks = list(self.frontend.spk2info.keys())
         return spks
@@ -77,61 +212,89 @@ class CosyVoice:
     def save_spkinfo(self):
         torch.save(self.frontend.spk2info, '{}/spk2info.pt'.format(self.model_dir))
 
-    def inference_sft(self, tts_text, spk_id, stream=False, speed=1.0, text_frontend=True):
-        for i in tqdm(self.frontend.text_normalize(tts_text, split=True, text_frontend=text_frontend)):
-            model_input = self.frontend.frontend_sft(i, spk_id)
+    def trim_prompt(self, prompt_text, prompt_wav, min_sec=3.0, max_sec=8.0, sentence_sec=5.0):
+        """trim a long zero-shot prompt to its best min_sec-max_sec voiced region and re-align prompt_text to it
+
+        The prompt speech tokens are in every llm prefill and the prompt mel in every flow call, so a long reference
+        inflates the cost of every sentence. Returns the trimmed prompt text, the trimmed wav as an in memory wav file
+        for inference_zero_shot/inference_cross_lingual/add_zero_shot_spk, and a report of the expected llm context
+        and flow frames of a sentence_sec seconds sentence relative to the untrimmed prompt.
+        """
+        trimmed_text, speech, sample_rate, region = trim_prompt_wav(prompt_text, prompt_wav, min_sec, max_sec)
+        if region['aligned'] is False:
+            logging.warning('no region of {}-{}s is aligned with the prompt text, only trim leading and trailing silence'.format(min_sec, max_sec))
+        wav, measure_wav = io.BytesIO(), io.BytesIO()
+        torchaudio.save(wav, speech, sample_rate, format='wav', backend='soundfile')
+        wav.seek(0)
+        prompt_sec, trimmed_sec = region['prompt_sec'], speech.shape[1] / sample_rate
+        # NOTE speech token rate differs between model versions, measure it on at most 30s of the trimmed prompt
+        torchaudio.save(measure_wav, speech[:, :30 * sample_rate], sample_rate, format='wav', backend='soundfile')
+        measure_wav.seek(0)
+        token_rate = self.frontend._extract_speech_token(measure_wav)[0].shape[1] / min(trimmed_sec, 30)
+        text_len = self.frontend._extract_text_token(prompt_text)[0].shape[1]
+        trimmed_text_len = self.frontend._extract_text_token(trimmed_text)[0].shape[1]
+        # assume the sentence is spoken at the speech rate of the prompt
+        sentence_len = (text_len / prompt_sec + token_rate) * sentence_sec
+        llm_context_ratio = (trimmed_text_len + token_rate * trimmed_sec + sentence_len) / (text_len + token_rate * prompt_sec + sentence_len)
+        flow_frames_ratio = (trimmed_sec + sentence_sec) / (prompt_sec + sentence_sec)
+        report = {'prompt_sec': prompt_sec, 'trimmed_sec': trimmed_sec, 'start': region['start'], 'end': region['end'],
+                  'voiced_sec': region['voiced_sec'], 'aligned': region['aligned'], 'speech_token_rate': token_rate,
+                  'llm_context_ratio': llm_context_ratio, 'flow_frames_ratio': flow_frames_ratio}
+        logging.info('trim prompt from {:.2f}s to {:.2f}s, llm context {:.1%} and flow frames {:.1%} of the untrimmed prompt per {}s sentence'.format(
+            prompt_sec, trimmed_sec, llm_context_ratio, flow_frames_ratio, sentence_sec))
+        return trimmed_text, wav, report
+
+    def synthesize_segments(self, segments, frontend, stream=False, speed=1.0, flow_conf=None, profiler=None):
+        """run frontend(segment) and model.tts of every text segment, segments are pipelined by self.pipeline
+
+        stats of the pipeline are recorded to profiler as a pipeline event after the last segment.
+        """
+        def job(i):
+            with profiler.span('frontend') if profiler is not None else nullcontext():
+                model_input = frontend(i)
             start_time = time.time()
             logging.info('synthesis text {}'.format(i))
-            for model_output in self.model.tts(**model_input, stream=stream, speed=speed):
+            for model_output in self.model.tts(**model_input, stream=stream, speed=speed, flow_conf=flow_conf, profiler=profiler):
                 speech_len = model_output['tts_speech'].shape[1] / self.sample_rate
                 logging.info('yield speech len {}, rtf {}'.format(speech_len, (time.time() - start_time) / speech_len))
                 yield model_output
                 start_time = time.time()
+        stats = {}
+        yield from self.pipeline.run(tqdm(segments), job, stats)
+        if profiler is not None:
+            profiler.record('pipeline', stats['wall_time'], depth=self.pipeline.depth, **stats)
 
-    def inference_zero_shot(self, tts_text, prompt_text, prompt_wav, zero_shot_spk_id='', stream=False, speed=1.0, text_frontend=True):
+    def inference_sft(self, tts_text, spk_id, stream=False, speed=1.0, text_frontend=True, flow_conf=None, profiler=None):
+        segments = self.frontend.text_normalize(tts_text, split=True, text_frontend=text_frontend)
+        yield from self.synthesize_segments(segments, lambda i: self.frontend.frontend_sft(i, spk_id), stream, speed, flow_conf, profiler)
+
+    def inference_zero_shot(self, tts_text, prompt_text, prompt_wav, zero_shot_spk_id='', stream=False, speed=1.0, text_frontend=True, flow_conf=None, profiler=None):
         if self.__class__.__name__ == 'CosyVoice3' and '<|endofprompt|>' not in prompt_text + tts_text:
             logging.warning('<|endofprompt|> not found in CosyVoice3 inference, check your input text')
         prompt_text = self.frontend.text_normalize(prompt_text, split=False, text_frontend=text_frontend)
-        for i in tqdm(self.frontend.text_normalize(tts_text, split=True, text_frontend=text_frontend)):
+
+        def frontend(i):
             if (not isinstance(i, Generator)) and len(i) < 0.5 * len(prompt_text):
                 logging.warning('synthesis text {} too short than prompt text {}, this may lead to bad performance'.format(i, prompt_text))
-            model_input = self.frontend.frontend_zero_shot(i, prompt_text, prompt_wav, self.sample_rate, zero_shot_spk_id)
-            start_time = time.time()
-            logging.info('synthesis text {}'.format(i))
-            for model_output in self.model.tts(**model_input, stream=stream, speed=speed):
-                speech_len = model_output['tts_speech'].shape[1] / self.sample_rate
-                logging.info('yield speech len {}, rtf {}'.format(speech_len, (time.time() - start_time) / speech_len))
-                yield model_output
-                start_time = time.time()
+            return self.frontend.frontend_zero_shot(i, prompt_text, prompt_wav, self.sample_rate, zero_shot_spk_id)
+        segments = self.frontend.text_normalize(tts_text, split=True, text_frontend=text_frontend)
+        yield from self.synthesize_segments(segments, frontend, stream, speed, flow_conf, profiler)
 
-    def inference_cross_lingual(self, tts_text, prompt_wav, zero_shot_spk_id='', stream=False, speed=1.0, text_frontend=True):
-        for i in tqdm(self.frontend.text_normalize(tts_text, split=True, text_frontend=text_frontend)):
-            model_input = self.frontend.frontend_cross_lingual(i, prompt_wav, self.sample_rate, zero_shot_spk_id)
-            start_time = time.time()
-            logging.info('synthesis text {}'.format(i))
-            for model_output in self.model.tts(**model_input, stream=stream, speed=speed):
-                speech_len = model_output['tts_speech'].shape[1] / self.sample_rate
-                logging.info('yield speech len {}, rtf {}'.format(speech_len, (time.time() - start_time) / speech_len))
-                yield model_output
-                start_time = time.time()
+    def inference_cross_lingual(self, tts_text, prompt_wav, zero_shot_spk_id='', stream=False, speed=1.0, text_frontend=True, flow_conf=None, profiler=None):
+        segments = self.frontend.text_normalize(tts_text, split=True, text_frontend=text_frontend)
+        yield from self.synthesize_segments(segments, lambda i: self.frontend.frontend_cross_lingual(i, prompt_wav, self.sample_rate, zero_shot_spk_id), stream, speed, flow_conf, profiler)
 
-    def inference_instruct(self, tts_text, spk_id, instruct_text, stream=False, speed=1.0, text_frontend=True):
+    def inference_instruct(self, tts_text, spk_id, instruct_text, stream=False, speed=1.0, text_frontend=True, flow_conf=None, profiler=None):
         assert self.__class__.__name__ == 'CosyVoice', 'inference_instruct is only implemented for CosyVoice!'
         instruct_text = self.frontend.text_normalize(instruct_text, split=False, text_frontend=text_frontend)
-        for i in tqdm(self.frontend.text_normalize(tts_text, split=True, text_frontend=text_frontend)):
-            model_input = self.frontend.frontend_instruct(i, spk_id, instruct_text)
-            start_time = time.time()
-            logging.info('synthesis text {}'.format(i))
-            for model_output in self.model.tts(**model_input, stream=stream, speed=speed):
-                speech_len = model_output['tts_speech'].shape[1] / self.sample_rate
-                logging.info('yield speech len {}, rtf {}'.format(speech_len, (time.time() - start_time) / speech_len))
-                yield model_output
-                start_time = time.time()
+        segments = self.frontend.text_normalize(tts_text, split=True, text_frontend=text_frontend)
+        yield from self.synthesize_segments(segments, lambda i: self.frontend.frontend_instruct(i, spk_id, instruct_text), stream, speed, flow_conf, profiler)
 
-    def inference_vc(self, source_wav, prompt_wav, stream=False, speed=1.0):
-        model_input = self.frontend.frontend_vc(source_wav, prompt_wav, self.sample_rate)
+    def inference_vc(self, source_wav, prompt_wav, stream=False, speed=1.0, flow_conf=None, profiler=None):
+        with profiler.span('frontend') if profiler is not None else nullcontext():
+            model_input = self.frontend.frontend_vc(source_wav, prompt_wav, self.sample_rate)
         start_time = time.time()
-        for model_output in self.model.tts(**model_input, stream=stream, speed=speed):
+        for model_output in self.model.tts(**model_input, stream=stream, speed=speed, flow_conf=flow_conf, profiler=profiler):
             speech_len = model_output['tts_speech'].shape[1] / self.sample_rate
             logging.info('yield speech len {}, rtf {}'.format(speech_len, (time.time() - start_time) / speech_len))
             yield model_output
@@ -140,31 +303,19 @@ class CosyVoice:
 
 class CosyVoice2(CosyVoice):
 
-    def __init__(self, model_dir, load_jit=False, load_trt=False, load_vllm=False, fp16=False, trt_concurrent=1):
+    def __init__(self, model_dir, load_jit=False, load_trt=False, load_vllm=False, fp16=False, trt_concurrent=1, **kwargs):
         self.model_dir = model_dir
         self.fp16 = fp16
         if not os.path.exists(model_dir):
             model_dir = snapshot_download(model_dir)
-        hyper_yaml_path = '{}/cosyvoice2.yaml'.format(model_dir)
-        if not os.path.exists(hyper_yaml_path):
-            raise ValueError('{} not found!'.format(hyper_yaml_path))
-        with open(hyper_yaml_path, 'r') as f:
-            configs = load_hyperpyyaml(f, overrides={'qwen_pretrain_path': os.path.join(model_dir, 'CosyVoice-BlankEN')})
-        assert get_model_type(configs) == CosyVoice2Model, 'do not use {} for CosyVoice2 initialization!'.format(model_dir)
-        self.frontend = CosyVoiceFrontEnd(configs['get_tokenizer'],
-                                          configs['feat_extractor'],
-                                          '{}/campplus.onnx'.format(model_dir),
-                                          '{}/speech_tokenizer_v2.onnx'.format(model_dir),
-                                          '{}/spk2info.pt'.format(model_dir),
-                                          configs['allowed_special'])
-        self.sample_rate = configs['sample_rate']
+        options = get_options(kwargs)
+        configs = self.load_configs(model_dir, 'cosyvoice2.yaml', 'speech_tokenizer_v2.onnx', CosyVoice2Model, options,
+                                    overrides={'qwen_pretrain_path': os.path.join(model_dir, 'CosyVoice-BlankEN')})
         if torch.cuda.is_available() is False and (load_jit is True or load_trt is True or load_vllm is True or fp16 is True):
             load_jit, load_trt, load_vllm, fp16 = False, False, False, False
             logging.warning('no cuda device, set load_jit/load_trt/load_vllm/fp16 to False')
         self.model = CosyVoice2Model(configs['llm'], configs['flow'], configs['hift'], fp16)
-        self.model.load('{}/llm.pt'.format(model_dir),
-                        '{}/flow.pt'.format(model_dir),
-                        '{}/hift.pt'.format(model_dir))
+        self.load_weights(model_dir, options)
         if load_vllm:
             self.model.load_vllm('{}/vllm'.format(model_dir))
         if load_jit:
@@ -174,47 +325,29 @@ class CosyVoice2(CosyVoice):
                                 '{}/flow.decoder.estimator.fp32.onnx'.format(model_dir),
                                 trt_concurrent,
                                 self.fp16)
+        self.load_options(model_dir, options, load_jit=load_jit, load_trt=load_trt, load_vllm=load_vllm)
         del configs
 
-    def inference_instruct2(self, tts_text, instruct_text, prompt_wav, zero_shot_spk_id='', stream=False, speed=1.0, text_frontend=True):
-        for i in tqdm(self.frontend.text_normalize(tts_text, split=True, text_frontend=text_frontend)):
-            model_input = self.frontend.frontend_instruct2(i, instruct_text, prompt_wav, self.sample_rate, zero_shot_spk_id)
-            start_time = time.time()
-            logging.info('synthesis text {}'.format(i))
-            for model_output in self.model.tts(**model_input, stream=stream, speed=speed):
-                speech_len = model_output['tts_speech'].shape[1] / self.sample_rate
-                logging.info('yield speech len {}, rtf {}'.format(speech_len, (time.time() - start_time) / speech_len))
-                yield model_output
-                start_time = time.time()
+    def inference_instruct2(self, tts_text, instruct_text, prompt_wav, zero_shot_spk_id='', stream=False, speed=1.0, text_frontend=True, flow_conf=None, profiler=None):
+        segments = self.frontend.text_normalize(tts_text, split=True, text_frontend=text_frontend)
+        yield from self.synthesize_segments(segments, lambda i: self.frontend.frontend_instruct2(i, instruct_text, prompt_wav, self.sample_rate, zero_shot_spk_id), stream, speed, flow_conf, profiler)
 
 
 class CosyVoice3(CosyVoice2):
 
-    def __init__(self, model_dir, load_trt=False, load_vllm=False, fp16=False, trt_concurrent=1):
+    def __init__(self, model_dir, load_trt=False, load_vllm=False, fp16=False, trt_concurrent=1, **kwargs):
         self.model_dir = model_dir
         self.fp16 = fp16
         if not os.path.exists(model_dir):
             model_dir = snapshot_download(model_dir)
-        hyper_yaml_path = '{}/cosyvoice3.yaml'.format(model_dir)
-        if not os.path.exists(hyper_yaml_path):
-            raise ValueError('{} not found!'.format(hyper_yaml_path))
-        with open(hyper_yaml_path, 'r') as f:
-            configs = load_hyperpyyaml(f, overrides={'qwen_pretrain_path': os.path.join(model_dir, 'CosyVoice-BlankEN')})
-        assert get_model_type(configs) == CosyVoice3Model, 'do not use {} for CosyVoice3 initialization!'.format(model_dir)
-        self.frontend = CosyVoiceFrontEnd(configs['get_tokenizer'],
-                                          configs['feat_extractor'],
-                                          '{}/campplus.onnx'.format(model_dir),
-                                          '{}/speech_tokenizer_v3.onnx'.format(model_dir),
-                                          '{}/spk2info.pt'.format(model_dir),
-                                          configs['allowed_special'])
-        self.sample_rate = configs['sample_rate']
+        options = get_options(kwargs)
+        configs = self.load_configs(model_dir, 'cosyvoice3.yaml', 'speech_tokenizer_v3.onnx', CosyVoice3Model, options,
+                                    overrides={'qwen_pretrain_path': os.path.join(model_dir, 'CosyVoice-BlankEN')})
         if torch.cuda.is_available() is False and (load_trt is True or fp16 is True):
             load_trt, fp16 = False, False
             logging.warning('no cuda device, set load_trt/fp16 to False')
         self.model = CosyVoice3Model(configs['llm'], configs['flow'], configs['hift'], fp16)
-        self.model.load('{}/llm.pt'.format(model_dir),
-                        '{}/flow.pt'.format(model_dir),
-                        '{}/hift.pt'.format(model_dir))
+        self.load_weights(model_dir, options)
         if load_vllm:
             self.model.load_vllm('{}/vllm'.format(model_dir))
         if load_trt:
@@ -224,6 +357,7 @@ class CosyVoice3(CosyVoice2):
                                 '{}/flow.decoder.estimator.fp32.onnx'.format(model_dir),
                                 trt_concurrent,
                                 self.fp16)
+        self.load_options(model_dir, options, load_trt=load_trt, load_vllm=load_vllm)
         del configs
 
 
@@ -11,11 +11,15 @@
 # WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 # See the License for the specific language governing permissions and
 # limitations under the License.
+from collections import OrderedDict
 from functools import partial
 from typing import Generator
+import hashlib
 import json
+import threading
 import onnxruntime
 import torch
+import torchaudio
 import numpy as np
 import whisper
 from typing import Callable
@@ -27,6 +31,56 @@ from cosyvoice.utils.file_utils import logging, load_wav
 from cosyvoice.utils.frontend_utils import contains_chinese, replace_blank, replace_corner_mark, remove_bracket, spell_out_number, split_paragraph, is_only_punctuation
 
 
+class PromptFeatureCache:
+    """Bounded LRU cache of prompt audio and its derived features, keyed by the audio content hash.
+
+    A prompt is decoded once, resampled once per target sample rate with a shared Resample module,
+    and the speech feat, speech token and speaker embedding extracted from it are memoized,
+    so repeated zero-shot/cross-lingual/instruct2/vc requests with the same prompt skip the onnx runs.
+    """
+
+    def __init__(self, max_size=16):
+        self.max_size = max_size
+        self.entries = OrderedDict()
+        self.resamplers = {}
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def audio_key(wav):
+        if isinstance(wav, (str, os.PathLike)):
+            with open(wav, 'rb') as f:
+                data = f.read()
+        else:
+            # file like object, restore the position for the following decode
+            position = wav.tell()
+            data = wav.read()
+            wav.seek(position)
+        return hashlib.sha1(data).hexdigest()
+
+    def get(self, key, name, extract):
+        """return feature `name` of audio `key`, call extract on cache miss"""
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                self.entries.move_to_end(key)
+                if name in entry:
+                    return entry[name]
+        value = extract()
+        with self.lock:
+            entry = self.entries.setdefault(key, {})
+            self.entries.move_to_end(key)
+            entry[name] = value
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+        return value
+
+    def resampler(self, orig_freq, new_freq):
+        with self.lock:
+            if (orig_freq, new_freq) not in self.resamplers:
+                self.resamplers[(orig_freq, new_freq)] = torchaudio.transforms.Resample(orig_freq=orig_freq, new_freq=new_freq)
+            return self.resamplers[(orig_freq, new_freq)]
+
+
 class CosyVoiceFrontEnd:
 
     def __init__(self,
@@ -35,13 +89,17 @@ class CosyVoiceFrontEnd:
                  campplus_model: str,
                  speech_tokenizer_model: str,
                  spk2info: str = '',
-                 allowed_special: str = 'all'):
+                 allowed_special: str = 'all',
+                 intra_op_num_threads: int = 1,
+                 inter_op_num_threads: int = 1,
+                 prompt_cache_size: int = 16):
         self.tokenizer = get_tokenizer()
         self.feat_extractor = feat_extractor
         self.device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
         option = onnxruntime.SessionOptions()
         option.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
-        option.intra_op_num_threads = 1
+        option.intra_op_num_threads = intra_op_num_threads
+        option.inter_op_num_threads = inter_op_num_threads
         self.campplus_session = onnxruntime.InferenceSession(campplus_model, sess_options=option, providers=["CPUExecutionProvider"])
         self.speech_tokenizer_session = onnxruntime.InferenceSession(speech_tokenizer_model, sess_options=option,
                                                                      providers=["CUDAExecutionProvider" if torch.cuda.is_available() else
@@ -51,6 +109,8 @@ class CosyVoiceFrontEnd:
         else:
             self.spk2info = {}
         self.allowed_special = allowed_special
+        # NOTE prompt_cache_size 0 disables the prompt feature cache
+        self.prompt_cache = PromptFeatureCache(prompt_cache_size) if prompt_cache_size > 0 else None
         self.inflect_parser = inflect.engine()
         # NOTE compatible when no text frontend tool is avaliable
         try:
@@ -92,42 +152,118 @@ class CosyVoiceFrontEnd:
             for i in range(text_token.shape[1]):
                 yield text_token[:, i: i + 1]
 
-    def _extract_speech_token(self, prompt_wav):
-        speech = load_wav(prompt_wav, 16000)
-        assert speech.shape[1] / 16000 <= 30, 'do not support extract speech token for audio longer than 30s'
-        feat = whisper.log_mel_spectrogram(speech, n_mels=128)
-        speech_token = self.speech_tokenizer_session.run(None,
-                                                         {self.speech_tokenizer_session.get_inputs()[0].name:
-                                                          feat.detach().cpu().numpy(),
-                                                          self.speech_tokenizer_session.get_inputs()[1].name:
-                                                          np.array([feat.shape[2]], dtype=np.int32)})[0].flatten().tolist()
-        speech_token = torch.tensor([speech_token], dtype=torch.int32).to(self.device)
+    def _prompt_key(self, prompt_wav):
+        return PromptFeatureCache.audio_key(prompt_wav) if self.prompt_cache is not None else None
+
+    def _cached(self, key, name, extract):
+        # NOTE return a copy, callers may modify the features inplace
+        if key is None:
+            return extract()
+        return self.prompt_cache.get(key, name, extract).clone()
+
+    def _load_wav(self, prompt_wav, target_sr, key=None, min_sr=16000):
+        if key is None:
+            return load_wav(prompt_wav, target_sr, min_sr)
+
+        def decode():
+            speech, sample_rate = torchaudio.load(prompt_wav, backend='soundfile')
+            return speech.mean(dim=0, keepdim=True), sample_rate
+        speech, sample_rate = self.prompt_cache.get(key, 'wav', decode)
+        if sample_rate == target_sr:
+            return speech
+        assert sample_rate >= min_sr, 'wav sample rate {} must be greater than {}'.format(sample_rate, target_sr)
+        return self.prompt_cache.get(key, 'wav_{}'.format(target_sr), lambda: self.prompt_cache.resampler(sample_rate, target_sr)(speech))
+
+    def _extract_speech_token(self, prompt_wav, key=None):
+        def extract():
+            speech = self._load_wav(prompt_wav, 16000, key)
+            assert speech.shape[1] / 16000 <= 30, 'do not support extract speech token for audio longer than 30s'
+            feat = whisper.log_mel_spectrogram(speech, n_mels=128)
+            speech_token = self.speech_tokenizer_session.run(None,
+                                                             {self.speech_tokenizer_session.get_inputs()[0].name:
+                                                              feat.detach().cpu().numpy(),
+                                                              self.speech_tokenizer_session.get_inputs()[1].name:
+                                                              np.array([feat.shape[2]], dtype=np.int32)})[0].flatten().tolist()
+            return torch.tensor([speech_token], dtype=torch.int32).to(self.device)
+        speech_token = self._cached(key, 'speech_token', extract)
         speech_token_len = torch.tensor([speech_token.shape[1]], dtype=torch.int32).to(self.device)
         return speech_token, speech_token_len
 
-    def _extract_spk_embedding(self, prompt_wav):
-        speech = load_wav(prompt_wav, 16000)
-        feat = kaldi.fbank(speech,
-                           num_mel_bins=80,
-                           dither=0,
-                           sample_frequency=16000)
-        feat = feat - feat.mean(dim=0, keepdim=True)
-        embedding = self.campplus_session.run(None,
-                                              {self.campplus_session.get_inputs()[0].name: feat.unsqueeze(dim=0).cpu().numpy()})[0].flatten().tolist()
-        embedding = torch.tensor([embedding]).to(self.device)
-        return embedding
-
-    def _extract_speech_feat(self, prompt_wav):
-        speech = load_wav(prompt_wav, 24000)
-        speech_feat = self.feat_extractor(speech).squeeze(dim=0).transpose(0, 1).to(self.device)
-        speech_feat = speech_feat.unsqueeze(dim=0)
+    def _extract_spk_embedding(self, prompt_wav, key=None):
+        def extract():
+            speech = self._load_wav(prompt_wav, 16000, key)
+            feat = kaldi.fbank(speech,
+                               num_mel_bins=80,
+                               dither=0,
+                               sample_frequency=16000)
+            feat = feat - feat.mean(dim=0, keepdim=True)
+            embedding = self.campplus_session.run(None,
+                                                  {self.campplus_session.get_inputs()[0].name: feat.unsqueeze(dim=0).cpu().numpy()})[0].flatten().tolist()
+            return torch.tensor([embedding]).to(self.device)
+        return self._cached(key, 'embedding', extract)
+
+    def _extract_speech_feat(self, prompt_wav, key=None):
+        def extract():
+            speech = self._load_wav(prompt_wav, 24000, key)
+            speech_feat = self.feat_extractor(speech).squeeze(dim=0).transpose(0, 1).to(self.device)
+            return speech_feat.unsqueeze(dim=0)
+        speech_feat = self._cached(key, 'speech_feat', extract)
         speech_feat_len = torch.tensor([speech_feat.shape[1]], dtype=torch.int32).to(self.device)
         return speech_feat, speech_feat_len
 
+    def _normalize_zh(self, text):
+        if self.text_frontend == 'wetext':
+            text = self.zh_tn_model.normalize(text)
+        text = text.replace("\n", "")
+        text = replace_blank(text)
+        text = replace_corner_mark(text)
+        text = text.replace(".", "。")
+        text = text.replace(" - ", "，")
+        text = remove_bracket(text)
+        return text
+
+    def _normalize_en(self, text):
+        if self.text_frontend == 'wetext':
+            text = self.en_tn_model.normalize(text)
+        text = spell_out_number(text, self.inflect_parser)
+        return text
+
+    def text_normalize_stream(self, text_generator, text_frontend=True):
+        """incremental text_normalize of a text generator, e.g. llm output tokens.
+
+        Text is buffered until a punctuation boundary, so that numbers, dates and english words
+        are complete when normalized, then the normalized segment is yielded.
+        The last character of the buffer is kept as lookahead, ascii '.' and ',' followed by a digit are not boundaries.
+        """
+        buffer = ''
+        for text in text_generator:
+            buffer += text
+            index = -1
+            for i in range(len(buffer) - 2, -1, -1):
+                if buffer[i] in '。！？；：，、!?;:\n' or (buffer[i] in '.,' and not buffer[i + 1].isdigit()):
+                    index = i
+                    break
+            if index != -1:
+                segment, buffer = buffer[:index + 1], buffer[index + 1:]
+                segment = self._normalize_segment(segment, text_frontend)
+                if segment != '':
+                    yield segment
+        segment = self._normalize_segment(buffer, text_frontend)
+        if segment != '':
+            yield segment
+
+    def _normalize_segment(self, text, text_frontend=True):
+        # NOTE no strip and no sentence split, segments are concatenated by the llm
+        if text_frontend is False or ('<|' in text and '|>' in text) or text.strip() == '':
+            return text
+        if self.text_frontend == 'ttsfrd':
+            return ''.join([i["text"] for i in json.loads(self.frd.do_voicegen_frd(text))["sentences"]])
+        return self._normalize_zh(text) if contains_chinese(text) else self._normalize_en(text)
+
     def text_normalize(self, text, split=True, text_frontend=True):
         if isinstance(text, Generator):
-            logging.info('get tts_text generator, will skip text_normalize!')
-            return [text]
+            logging.info('get tts_text generator, will normalize it incrementally!')
+            return [self.text_normalize_stream(text, text_frontend=text_frontend)]
         # NOTE skip text_frontend when ssml symbol in text
         if '<|' in text and '|>' in text:
             text_frontend = False
@@ -139,21 +275,12 @@ class CosyVoiceFrontEnd:
             text = ''.join(texts)
         else:
             if contains_chinese(text):
-                if self.text_frontend == 'wetext':
-                    text = self.zh_tn_model.normalize(text)
-                text = text.replace("\n", "")
-                text = replace_blank(text)
-                text = replace_corner_mark(text)
-                text = text.replace(".", "。")
-                text = text.replace(" - ", "，")
-                text = remove_bracket(text)
+                text = self._normalize_zh(text)
                 text = re.sub(r'[，,、]+$', '。', text)
                 texts = list(split_paragraph(text, partial(self.tokenizer.encode, allowed_special=self.allowed_special), "zh", token_max_n=80,
                                              token_min_n=60, merge_len=20, comma_split=False))
             else:
-                if self.text_frontend == 'wetext':
-                    text = self.en_tn_model.normalize(text)
-                text = spell_out_number(text, self.inflect_parser)
+                text = self._normalize_en(text)
                 texts = list(split_paragraph(text, partial(self.tokenizer.encode, allowed_special=self.allowed_special), "en", token_max_n=80,
                                              token_min_n=60, merge_len=20, comma_split=False))
         texts = [i for i in texts if not is_only_punctuation(i)]
@@ -169,14 +296,15 @@ class CosyVoiceFrontEnd:
         tts_text_token, tts_text_token_len = self._extract_text_token(tts_text)
         if zero_shot_spk_id == '':
             prompt_text_token, prompt_text_token_len = self._extract_text_token(prompt_text)
-            speech_feat, speech_feat_len = self._extract_speech_feat(prompt_wav)
-            speech_token, speech_token_len = self._extract_speech_token(prompt_wav)
+            prompt_key = self._prompt_key(prompt_wav)
+            speech_feat, speech_feat_len = self._extract_speech_feat(prompt_wav, prompt_key)
+            speech_token, speech_token_len = self._extract_speech_token(prompt_wav, prompt_key)
             if resample_rate == 24000:
                 # cosyvoice2, force speech_feat % speech_token = 2
                 token_len = min(int(speech_feat.shape[1] / 2), speech_token.shape[1])
                 speech_feat, speech_feat_len[:] = speech_feat[:, :2 * token_len], 2 * token_len
                 speech_token, speech_token_len[:] = speech_token[:, :token_len], token_len
-            embedding = self._extract_spk_embedding(prompt_wav)
+            embedding = self._extract_spk_embedding(prompt_wav, prompt_key)
             model_input = {'prompt_text': prompt_text_token, 'prompt_text_len': prompt_text_token_len,
                            'llm_prompt_speech_token': speech_token, 'llm_prompt_speech_token_len': speech_token_len,
                            'flow_prompt_speech_token': speech_token, 'flow_prompt_speech_token_len': speech_token_len,
@@ -213,9 +341,10 @@ class CosyVoiceFrontEnd:
         return model_input
 
     def frontend_vc(self, source_speech_16k, prompt_wav, resample_rate):
-        prompt_speech_token, prompt_speech_token_len = self._extract_speech_token(prompt_wav)
-        prompt_speech_feat, prompt_speech_feat_len = self._extract_speech_feat(prompt_wav)
-        embedding = self._extract_spk_embedding(prompt_wav)
+        prompt_key = self._prompt_key(prompt_wav)
+        prompt_speech_token, prompt_speech_token_len = self._extract_speech_token(prompt_wav, prompt_key)
+        prompt_speech_feat, prompt_speech_feat_len = self._extract_speech_feat(prompt_wav, prompt_key)
+        embedding = self._extract_spk_embedding(prompt_wav, prompt_key)
         source_speech_token, source_speech_token_len = self._extract_speech_token(source_speech_16k)
         model_input = {'source_speech_token': source_speech_token, 'source_speech_token_len': source_speech_token_len,
                        'flow_prompt_speech_token': prompt_speech_token, 'flow_prompt_speech_token_len': prompt_speech_token_len,
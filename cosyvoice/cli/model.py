@@ -21,9 +21,15 @@ import time
 from torch.nn import functional as F
 from contextlib import nullcontext
 import uuid
+from cosyvoice.cli.chunk_scheduler import ChunkScheduler
 from cosyvoice.utils.common import fade_in_out
-from cosyvoice.utils.file_utils import convert_onnx_to_trt, export_cosyvoice2_vllm
-from cosyvoice.utils.common import TrtContextWrapper
+from cosyvoice.utils.file_utils import convert_onnx_to_trt, export_cosyvoice2_vllm, load_checkpoint_mmap, logging
+from cosyvoice.utils.common import TrtContextWrapper, OrtSessionWrapper, OrtEstimatorWrapper, JitEstimatorWrapper, JitDecodeSpecWrapper
+from cosyvoice.llm.batcher import LLMBatcher
+from cosyvoice.llm.ort_decoder import OrtLLMDecoder
+from cosyvoice.llm.static_decoder import StaticCacheDecoder
+from cosyvoice.flow.batcher import EstimatorBatcher
+from cosyvoice.flow.ode_solvers import ODE_SOLVERS
 
 
 class CosyVoiceModel:
@@ -59,8 +65,14 @@ class CosyVoiceModel:
         self.llm_end_dict = {}
         self.mel_overlap_dict = {}
         self.flow_cache_dict = {}
+        self.profiler_dict = {}
         self.hift_cache_dict = {}
+        self.flow_conf_dict = {}
         self.silent_tokens = []
+        # flow matching ode settings, could be overridden per request by tts(flow_conf=...)
+        self.flow_conf = {'n_timesteps': 10, 'solver': 'euler', 'cfg_rate': None, 'cfg_schedule': None}
+        # modules running in cpu bf16 autocast, see quantize
+        self.bf16_modules = []
 
     def load(self, llm_model, flow_model, hift_model):
         self.llm.load_state_dict(torch.load(llm_model, map_location=self.device, weights_only=True), strict=True)
@@ -72,6 +84,58 @@ class CosyVoiceModel:
         self.hift.load_state_dict(hift_state_dict, strict=True)
         self.hift.to(self.device).eval()
 
+    def load_mmap(self, llm_model, flow_model, hift_model, use_safetensors=False):
+        # NOTE modules are built without parameter initialization by init_empty_weights, parameters are assigned the mmaped
+        # checkpoint tensors without copy, so cpu processes on the same host share the read-only weight pages
+        self.llm.load_state_dict(load_checkpoint_mmap(llm_model, use_safetensors), strict=True, assign=True)
+        self.llm.to(self.device).eval()
+        self.flow.load_state_dict(load_checkpoint_mmap(flow_model, use_safetensors), strict=True, assign=True)
+        self.flow.to(self.device).eval()
+        # in case hift_model is a hifigan model
+        hift_state_dict = {k.replace('generator.', ''): v for k, v in load_checkpoint_mmap(hift_model, use_safetensors).items()}
+        self.hift.load_state_dict(hift_state_dict, strict=True, assign=True)
+        self.hift.to(self.device).eval()
+
+    def load_int8(self, llm_model, flow_model, hift_model):
+        # NOTE quantized state dict is cached next to the fp32 one, rebuilt when the fp32 checkpoint is newer
+        llm_int8_model, flow_int8_model = ['{}.int8.pt'.format(os.path.splitext(i)[0]) for i in [llm_model, flow_model]]
+        if all(os.path.exists(j) and os.path.getmtime(j) >= os.path.getmtime(i) for i, j in [[llm_model, llm_int8_model], [flow_model, flow_int8_model]]):
+            self.quantize_int8()
+            self.llm.load_state_dict(torch.load(llm_int8_model, map_location=self.device, weights_only=True), strict=True)
+            self.flow.load_state_dict(torch.load(flow_int8_model, map_location=self.device, weights_only=True), strict=True)
+            hift_state_dict = {k.replace('generator.', ''): v for k, v in torch.load(hift_model, map_location=self.device, weights_only=True).items()}
+            self.hift.load_state_dict(hift_state_dict, strict=True)
+            self.hift.to(self.device).eval()
+        else:
+            self.load(llm_model, flow_model, hift_model)
+            self.quantize_int8()
+            torch.save(self.llm.state_dict(), llm_int8_model)
+            torch.save(self.flow.state_dict(), flow_int8_model)
+
+    def quantize_int8(self):
+        assert self.device.type == 'cpu', 'dynamic int8 quantization only supports cpu!'
+        # NOTE dynamic quantization only covers Linear layers, the convolutions of flow and hift stay in fp32
+        self.llm = torch.ao.quantization.quantize_dynamic(self.llm.eval(), {torch.nn.Linear}, dtype=torch.qint8, inplace=True)
+        self.flow = torch.ao.quantization.quantize_dynamic(self.flow.eval(), {torch.nn.Linear}, dtype=torch.qint8, inplace=True)
+
+    def load_bf16(self, bf16_modules):
+        assert self.device.type == 'cpu', 'bf16 autocast is only used for cpu, use fp16 on gpu!'
+        self.bf16_modules = bf16_modules
+
+    def bf16_context(self, module):
+        # NOTE always return an autocast context, so hift could disable the bf16 autocast of flow when nested
+        return torch.autocast('cpu', dtype=torch.bfloat16, enabled=module in self.bf16_modules)
+
+    def profile(self, uuid, stage, **info):
+        # time stage of request uuid when it has a profiler, see TTSProfiler
+        profiler = self.profiler_dict.get(uuid)
+        return profiler.span(stage, **info) if profiler is not None else nullcontext()
+
+    def profile_event(self, uuid, stage, duration, **info):
+        profiler = self.profiler_dict.get(uuid)
+        if profiler is not None:
+            profiler.record(stage, duration, **info)
+
     def load_jit(self, llm_text_encoder_model, llm_llm_model, flow_encoder_model):
         llm_text_encoder = torch.jit.load(llm_text_encoder_model, map_location=self.device)
         self.llm.text_encoder = llm_text_encoder
@@ -91,6 +155,61 @@ class CosyVoiceModel:
         assert estimator_engine is not None, 'failed to load trt {}'.format(flow_decoder_estimator_model)
         self.flow.decoder.estimator = TrtContextWrapper(estimator_engine, trt_concurrent=trt_concurrent, device=self.device)
 
+    def load_ort(self, flow_decoder_estimator_model, flow_decoder_estimator_streaming_model, hift_decode_model, intra_op_num_threads, inter_op_num_threads):
+        for i in [flow_decoder_estimator_model, hift_decode_model]:
+            assert os.path.exists(i), '{} not found, export it with cosyvoice/bin/export_onnx.py first!'.format(i)
+        streaming_estimator = None
+        if not os.path.exists(flow_decoder_estimator_streaming_model):
+            # NOTE the non-streaming graph has the wrong attention mask for streaming of causal estimators, keep pytorch for them
+            if self.flow.decoder.estimator.__class__.__name__ != 'ConditionalDecoder':
+                logging.warning('{} not found, streaming flow runs the pytorch estimator, export it with cosyvoice/bin/export_onnx.py'.format(
+                    flow_decoder_estimator_streaming_model))
+                streaming_estimator = self.flow.decoder.estimator
+            flow_decoder_estimator_streaming_model = None
+        del self.flow.decoder.estimator
+        self.flow.decoder.estimator = OrtEstimatorWrapper(flow_decoder_estimator_model, flow_decoder_estimator_streaming_model,
+                                                          intra_op_num_threads=intra_op_num_threads, inter_op_num_threads=inter_op_num_threads,
+                                                          streaming_estimator=streaming_estimator)
+        self.hift.ort_decode_spec = OrtSessionWrapper(hift_decode_model, intra_op_num_threads=intra_op_num_threads, inter_op_num_threads=inter_op_num_threads)
+
+    def load_ort_llm(self, llm_prefill_model, llm_decode_model, intra_op_num_threads, inter_op_num_threads):
+        for i in [llm_prefill_model, llm_decode_model]:
+            assert os.path.exists(i), '{} not found, export it with cosyvoice/bin/export_onnx_llm.py first!'.format(i)
+        self.llm.ort_decoder = OrtLLMDecoder(self.llm, llm_prefill_model, llm_decode_model,
+                                             intra_op_num_threads=intra_op_num_threads, inter_op_num_threads=inter_op_num_threads)
+
+    def load_cpu_compile(self, jit_dir, flow_model, hift_model, compile_estimator=True):
+        assert self.device.type == 'cpu', 'cpu compile only supports cpu, use load_jit/load_trt on gpu!'
+        os.makedirs(jit_dir, exist_ok=True)
+        # NOTE inductor kernels of the compiled llm decode step, see load_static_cache, are kept next to the torchscript graphs
+        os.environ.setdefault('TORCHINDUCTOR_CACHE_DIR', os.path.join(jit_dir, 'inductor'))
+        if compile_estimator is True:
+            assert isinstance(self.flow.decoder.estimator, torch.nn.Module), 'cpu compile only supports pytorch estimator!'
+            self.flow.decoder.estimator = JitEstimatorWrapper(self.flow.decoder.estimator, jit_dir, flow_model)
+        self.hift.jit_decode_spec = JitDecodeSpecWrapper(self.hift, '{}/hift.decode_spec.zip'.format(jit_dir), hift_model)
+
+    def load_static_cache(self, static_cache_len, compile=False):
+        assert hasattr(self.llm.llm, 'forward_one_step'), 'static kv cache decoding is only implemented for Qwen2 based llm!'
+        self.llm.static_decoder = StaticCacheDecoder(self.llm, max_cache_len=static_cache_len, compile=compile)
+
+    def load_llm_batcher(self, llm_batch_size):
+        self.llm.batcher = LLMBatcher(self.llm, max_batch_size=llm_batch_size)
+
+    def load_flow_batcher(self, flow_batch_size, flow_batch_wait=0.005):
+        assert isinstance(self.flow.decoder.estimator, torch.nn.Module), 'flow batcher does not support tensorrt/onnxruntime estimator!'
+        self.flow.decoder.batcher = EstimatorBatcher(self.flow.decoder.estimator, max_batch_size=flow_batch_size, max_wait=flow_batch_wait)
+
+    def set_flow_conf(self, **flow_conf):
+        self.flow_conf = self.get_flow_conf(flow_conf)
+
+    def get_flow_conf(self, flow_conf=None):
+        flow_conf = {**self.flow_conf, **(flow_conf if flow_conf is not None else {})}
+        assert set(flow_conf.keys()) == {'n_timesteps', 'solver', 'cfg_rate', 'cfg_schedule'}, 'unsupported flow_conf {}'.format(flow_conf)
+        assert flow_conf['solver'] in ODE_SOLVERS, 'unsupported ode solver {}, choose from {}'.format(flow_conf['solver'], list(ODE_SOLVERS.keys()))
+        assert flow_conf['n_timesteps'] >= 1, 'n_timesteps should be greater than 0'
+        self.flow.decoder.get_cfg_schedule(flow_conf['n_timesteps'], flow_conf['cfg_rate'], flow_conf['cfg_schedule'])
+        return flow_conf
+
     def get_trt_kwargs(self):
         min_shape = [(2, 80, 4), (2, 1, 4), (2, 80, 4), (2, 80, 4)]
         opt_shape = [(2, 80, 500), (2, 1, 500), (2, 80, 500), (2, 80, 500)]
@@ -100,7 +219,7 @@ class CosyVoiceModel:
 
     def llm_job(self, text, prompt_text, llm_prompt_speech_token, llm_embedding, uuid):
         cur_silent_token_num, max_silent_token_num = 0, 5
-        with self.llm_context, torch.cuda.amp.autocast(self.fp16 is True and hasattr(self.llm, 'vllm') is False):
+        with self.llm_context, torch.cuda.amp.autocast(self.fp16 is True and hasattr(self.llm, 'vllm') is False), self.bf16_context('llm'):
             if isinstance(text, Generator):
                 assert (self.__class__.__name__ != 'CosyVoiceModel') and not hasattr(self.llm, 'vllm'), 'streaming input text is only implemented for CosyVoice2/3 and do not support vllm!'
                 token_generator = self.llm.inference_bistream(text=text,
@@ -118,7 +237,12 @@ class CosyVoiceModel:
                                                      prompt_speech_token_len=torch.tensor([llm_prompt_speech_token.shape[1]], dtype=torch.int32).to(self.device),
                                                      embedding=llm_embedding.to(self.device),
                                                      uuid=uuid)  
+            stage, last_time = 'llm_prefill', time.time()
             for i in token_generator:
+                if uuid in self.profiler_dict:
+                    now = time.time()
+                    self.profile_event(uuid, stage, now - last_time)
+                    stage, last_time = 'llm_decode', now
                 if i in self.silent_tokens:
                     cur_silent_token_num += 1
                     if cur_silent_token_num > max_silent_token_num:
@@ -133,7 +257,7 @@ class CosyVoiceModel:
         self.llm_end_dict[uuid] = True
 
     def token2wav(self, token, prompt_token, prompt_feat, embedding, uuid, finalize=False, speed=1.0):
-        with torch.cuda.amp.autocast(self.fp16):
+        with self.profile(uuid, 'flow'), torch.cuda.amp.autocast(self.fp16), self.bf16_context('flow'):
             tts_mel, self.flow_cache_dict[uuid] = self.flow.inference(token=token.to(self.device, dtype=torch.int32),
                                                                       token_len=torch.tensor([token.shape[1]], dtype=torch.int32).to(self.device),
                                                                       prompt_token=prompt_token.to(self.device),
@@ -141,7 +265,8 @@ class CosyVoiceModel:
                                                                       prompt_feat=prompt_feat.to(self.device),
                                                                       prompt_feat_len=torch.tensor([prompt_feat.shape[1]], dtype=torch.int32).to(self.device),
                                                                       embedding=embedding.to(self.device),
-                                                                      flow_cache=self.flow_cache_dict[uuid])
+                                                                      flow_cache=self.flow_cache_dict[uuid],
+                                                                      **self.flow_conf_dict[uuid])
 
         # mel overlap fade in out
         if self.mel_overlap_dict[uuid].shape[2] != 0:
@@ -156,7 +281,8 @@ class CosyVoiceModel:
         if finalize is False:
             self.mel_overlap_dict[uuid] = tts_mel[:, :, -self.mel_overlap_len:]
             tts_mel = tts_mel[:, :, :-self.mel_overlap_len]
-            tts_speech, tts_source = self.hift.inference(speech_feat=tts_mel, cache_source=hift_cache_source)
+            with self.profile(uuid, 'hift'), self.bf16_context('hift'):
+                tts_speech, tts_source = self.hift.inference(speech_feat=tts_mel, cache_source=hift_cache_source)
             if self.hift_cache_dict[uuid] is not None:
                 tts_speech = fade_in_out(tts_speech, self.hift_cache_dict[uuid]['speech'], self.speech_window)
             self.hift_cache_dict[uuid] = {'mel': tts_mel[:, :, -self.mel_cache_len:],
@@ -167,7 +293,8 @@ class CosyVoiceModel:
             if speed != 1.0:
                 assert self.hift_cache_dict[uuid] is None, 'speed change only support non-stream inference mode'
                 tts_mel = F.interpolate(tts_mel, size=int(tts_mel.shape[2] / speed), mode='linear')
-            tts_speech, tts_source = self.hift.inference(speech_feat=tts_mel, cache_source=hift_cache_source)
+            with self.profile(uuid, 'hift'), self.bf16_context('hift'):
+                tts_speech, tts_source = self.hift.inference(speech_feat=tts_mel, cache_source=hift_cache_source)
             if self.hift_cache_dict[uuid] is not None:
                 tts_speech = fade_in_out(tts_speech, self.hift_cache_dict[uuid]['speech'], self.speech_window)
         return tts_speech
@@ -176,12 +303,15 @@ class CosyVoiceModel:
             prompt_text=torch.zeros(1, 0, dtype=torch.int32),
             llm_prompt_speech_token=torch.zeros(1, 0, dtype=torch.int32),
             flow_prompt_speech_token=torch.zeros(1, 0, dtype=torch.int32),
-            prompt_speech_feat=torch.zeros(1, 0, 80), source_speech_token=torch.zeros(1, 0, dtype=torch.int32), stream=False, speed=1.0, **kwargs):
+            prompt_speech_feat=torch.zeros(1, 0, 80), source_speech_token=torch.zeros(1, 0, dtype=torch.int32), stream=False, speed=1.0, flow_conf=None, profiler=None, **kwargs):
         # this_uuid is used to track variables related to this inference thread
         this_uuid = str(uuid.uuid1())
         with self.lock:
             self.tts_speech_token_dict[this_uuid], self.llm_end_dict[this_uuid] = [], False
             self.hift_cache_dict[this_uuid] = None
+            self.flow_conf_dict[this_uuid] = self.get_flow_conf(flow_conf)
+            if profiler is not None:
+                self.profiler_dict[this_uuid] = profiler
             self.mel_overlap_dict[this_uuid] = torch.zeros(1, 80, 0)
             self.flow_cache_dict[this_uuid] = torch.zeros(1, 80, 0, 2)
         if source_speech_token.shape[1] == 0:
@@ -191,9 +321,11 @@ class CosyVoiceModel:
         p.start()
         if stream is True:
             token_hop_len = self.token_min_hop_len
+            wait_start = time.time()
             while True:
                 time.sleep(0.1)
                 if len(self.tts_speech_token_dict[this_uuid]) >= token_hop_len + self.token_overlap_len:
+                    self.profile_event(this_uuid, 'hop_wait', time.time() - wait_start)
                     this_tts_speech_token = torch.tensor(self.tts_speech_token_dict[this_uuid][:token_hop_len + self.token_overlap_len]) \
                         .unsqueeze(dim=0)
                     this_tts_speech = self.token2wav(token=this_tts_speech_token,
@@ -202,7 +334,9 @@ class CosyVoiceModel:
                                                      embedding=flow_embedding,
                                                      uuid=this_uuid,
                                                      finalize=False)
+                    self.profile_event(this_uuid, 'chunk', 0.0, speech_len=this_tts_speech.shape[1] / self.hift.sampling_rate)
                     yield {'tts_speech': this_tts_speech.cpu()}
+                    wait_start = time.time()
                     with self.lock:
                         self.tts_speech_token_dict[this_uuid] = self.tts_speech_token_dict[this_uuid][token_hop_len:]
                     # increase token_hop_len for better speech quality
@@ -210,6 +344,7 @@ class CosyVoiceModel:
                 if self.llm_end_dict[this_uuid] is True and len(self.tts_speech_token_dict[this_uuid]) < token_hop_len + self.token_overlap_len:
                     break
             p.join()
+            self.profile_event(this_uuid, 'hop_wait', time.time() - wait_start)
             # deal with remain tokens, make sure inference remain token len equals token_hop_len when cache_speech is not None
             this_tts_speech_token = torch.tensor(self.tts_speech_token_dict[this_uuid]).unsqueeze(dim=0)
             this_tts_speech = self.token2wav(token=this_tts_speech_token,
@@ -218,10 +353,13 @@ class CosyVoiceModel:
                                              embedding=flow_embedding,
                                              uuid=this_uuid,
                                              finalize=True)
+            self.profile_event(this_uuid, 'chunk', 0.0, speech_len=this_tts_speech.shape[1] / self.hift.sampling_rate)
             yield {'tts_speech': this_tts_speech.cpu()}
         else:
             # deal with all tokens
+            wait_start = time.time()
             p.join()
+            self.profile_event(this_uuid, 'hop_wait', time.time() - wait_start)
             this_tts_speech_token = torch.tensor(self.tts_speech_token_dict[this_uuid]).unsqueeze(dim=0)
             this_tts_speech = self.token2wav(token=this_tts_speech_token,
                                              prompt_token=flow_prompt_speech_token,
@@ -230,13 +368,16 @@ class CosyVoiceModel:
                                              uuid=this_uuid,
                                              finalize=True,
                                              speed=speed)
+            self.profile_event(this_uuid, 'chunk', 0.0, speech_len=this_tts_speech.shape[1] / self.hift.sampling_rate)
             yield {'tts_speech': this_tts_speech.cpu()}
         with self.lock:
             self.tts_speech_token_dict.pop(this_uuid)
             self.llm_end_dict.pop(this_uuid)
             self.mel_overlap_dict.pop(this_uuid)
             self.hift_cache_dict.pop(this_uuid)
+            self.flow_conf_dict.pop(this_uuid)
             self.flow_cache_dict.pop(this_uuid)
+            self.profiler_dict.pop(this_uuid, None)
         if torch.cuda.is_available():
             torch.cuda.empty_cache()
             torch.cuda.current_stream().synchronize()
@@ -256,6 +397,10 @@ class CosyVoice2Model(CosyVoiceModel):
         self.fp16 = fp16
         # NOTE must matching training static_chunk_size
         self.token_hop_len = 25
+        # stream hop len is scheduled between min and max hop len by measured rtf, see ChunkScheduler
+        self.token_min_hop_len = self.token_hop_len
+        self.token_max_hop_len = 4 * self.token_hop_len
+        self.stream_scale_factor = 2
         # hift cache
         self.mel_cache_len = 8
         self.source_cache_len = int(self.mel_cache_len * 480)
@@ -268,12 +413,29 @@ class CosyVoice2Model(CosyVoiceModel):
         self.tts_speech_token_dict = {}
         self.llm_end_dict = {}
         self.hift_cache_dict = {}
+        self.flow_conf_dict = {}
+        self.flow_cache_dict = {}
+        self.profiler_dict = {}
         self.silent_tokens = []
+        # flow matching ode settings, could be overridden per request by tts(flow_conf=...)
+        self.flow_conf = {'n_timesteps': 10, 'solver': 'euler', 'cfg_rate': None, 'cfg_schedule': None}
+        # modules running in cpu bf16 autocast, see quantize
+        self.bf16_modules = []
+        # stream inference only encodes/decodes new tokens, see load_incremental_flow
+        self.incremental_flow, self.flow_estimator_cache = False, False
 
     def load_jit(self, flow_encoder_model):
         flow_encoder = torch.jit.load(flow_encoder_model, map_location=self.device)
         self.flow.encoder = flow_encoder
 
+    def load_incremental_flow(self, estimator_cache=False):
+        assert hasattr(self.flow, 'init_flow_cache') and hasattr(self.flow.encoder, 'forward_chunk'), \
+            'incremental flow needs pytorch {} encoder'.format(self.flow.__class__.__name__)
+        if estimator_cache is True:
+            assert isinstance(self.flow.decoder.estimator, torch.nn.Module) and not hasattr(self.flow.decoder, 'batcher'), \
+                'flow estimator cache only supports pytorch estimator without batcher'
+        self.incremental_flow, self.flow_estimator_cache = True, estimator_cache
+
     def load_vllm(self, model_dir):
         export_cosyvoice2_vllm(self.llm, model_dir, self.device)
         from vllm import EngineArgs, LLMEngine
@@ -286,17 +448,22 @@ class CosyVoice2Model(CosyVoiceModel):
         del self.llm.llm.model.model.layers
 
     def token2wav(self, token, prompt_token, prompt_feat, embedding, token_offset, uuid, stream=False, finalize=False, speed=1.0):
-        with torch.cuda.amp.autocast(self.fp16):
-            tts_mel, _ = self.flow.inference(token=token.to(self.device, dtype=torch.int32),
-                                             token_len=torch.tensor([token.shape[1]], dtype=torch.int32).to(self.device),
-                                             prompt_token=prompt_token.to(self.device),
-                                             prompt_token_len=torch.tensor([prompt_token.shape[1]], dtype=torch.int32).to(self.device),
-                                             prompt_feat=prompt_feat.to(self.device),
-                                             prompt_feat_len=torch.tensor([prompt_feat.shape[1]], dtype=torch.int32).to(self.device),
-                                             embedding=embedding.to(self.device),
-                                             streaming=stream,
-                                             finalize=finalize)
-        tts_mel = tts_mel[:, :, token_offset * self.flow.token_mel_ratio:]
+        with self.profile(uuid, 'flow'), torch.cuda.amp.autocast(self.fp16), self.bf16_context('flow'):
+            tts_mel, tts_flow_cache = self.flow.inference(token=token.to(self.device, dtype=torch.int32),
+                                                          token_len=torch.tensor([token.shape[1]], dtype=torch.int32).to(self.device),
+                                                          prompt_token=prompt_token.to(self.device),
+                                                          prompt_token_len=torch.tensor([prompt_token.shape[1]], dtype=torch.int32).to(self.device),
+                                                          prompt_feat=prompt_feat.to(self.device),
+                                                          prompt_feat_len=torch.tensor([prompt_feat.shape[1]], dtype=torch.int32).to(self.device),
+                                                          embedding=embedding.to(self.device),
+                                                          streaming=stream,
+                                                          finalize=finalize,
+                                                          flow_cache=self.flow_cache_dict[uuid],
+                                                          **self.flow_conf_dict[uuid])
+        # NOTE incremental flow only returns mel of the new tokens
+        if self.flow_cache_dict[uuid] is None:
+            tts_mel = tts_mel[:, :, token_offset * self.flow.token_mel_ratio:]
+        self.flow_cache_dict[uuid] = tts_flow_cache
         # append hift cache
         if self.hift_cache_dict[uuid] is not None:
             hift_cache_mel, hift_cache_source = self.hift_cache_dict[uuid]['mel'], self.hift_cache_dict[uuid]['source']
@@ -305,7 +472,8 @@ class CosyVoice2Model(CosyVoiceModel):
             hift_cache_source = torch.zeros(1, 1, 0)
         # keep overlap mel and hift cache
         if finalize is False:
-            tts_speech, tts_source = self.hift.inference(speech_feat=tts_mel, cache_source=hift_cache_source)
+            with self.profile(uuid, 'hift'), self.bf16_context('hift'):
+                tts_speech, tts_source = self.hift.inference(speech_feat=tts_mel, cache_source=hift_cache_source)
             if self.hift_cache_dict[uuid] is not None:
                 tts_speech = fade_in_out(tts_speech, self.hift_cache_dict[uuid]['speech'], self.speech_window)
             self.hift_cache_dict[uuid] = {'mel': tts_mel[:, :, -self.mel_cache_len:],
@@ -316,7 +484,8 @@ class CosyVoice2Model(CosyVoiceModel):
             if speed != 1.0:
                 assert self.hift_cache_dict[uuid] is None, 'speed change only support non-stream inference mode'
                 tts_mel = F.interpolate(tts_mel, size=int(tts_mel.shape[2] / speed), mode='linear')
-            tts_speech, tts_source = self.hift.inference(speech_feat=tts_mel, cache_source=hift_cache_source)
+            with self.profile(uuid, 'hift'), self.bf16_context('hift'):
+                tts_speech, tts_source = self.hift.inference(speech_feat=tts_mel, cache_source=hift_cache_source)
             if self.hift_cache_dict[uuid] is not None:
                 tts_speech = fade_in_out(tts_speech, self.hift_cache_dict[uuid]['speech'], self.speech_window)
         return tts_speech
@@ -325,12 +494,16 @@ class CosyVoice2Model(CosyVoiceModel):
             prompt_text=torch.zeros(1, 0, dtype=torch.int32),
             llm_prompt_speech_token=torch.zeros(1, 0, dtype=torch.int32),
             flow_prompt_speech_token=torch.zeros(1, 0, dtype=torch.int32),
-            prompt_speech_feat=torch.zeros(1, 0, 80), source_speech_token=torch.zeros(1, 0, dtype=torch.int32), stream=False, speed=1.0, **kwargs):
+            prompt_speech_feat=torch.zeros(1, 0, 80), source_speech_token=torch.zeros(1, 0, dtype=torch.int32), stream=False, speed=1.0, flow_conf=None, profiler=None, **kwargs):
         # this_uuid is used to track variables related to this inference thread
         this_uuid = str(uuid.uuid1())
         with self.lock:
             self.tts_speech_token_dict[this_uuid], self.llm_end_dict[this_uuid] = [], False
             self.hift_cache_dict[this_uuid] = None
+            self.flow_conf_dict[this_uuid] = self.get_flow_conf(flow_conf)
+            if profiler is not None:
+                self.profiler_dict[this_uuid] = profiler
+            self.flow_cache_dict[this_uuid] = self.flow.init_flow_cache(self.flow_estimator_cache) if stream is True and self.incremental_flow is True else None
         if source_speech_token.shape[1] == 0:
             p = threading.Thread(target=self.llm_job, args=(text, prompt_text, llm_prompt_speech_token, llm_embedding, this_uuid))
         else:
@@ -339,10 +512,13 @@ class CosyVoice2Model(CosyVoiceModel):
         if stream is True:
             token_offset = 0
             prompt_token_pad = int(np.ceil(flow_prompt_speech_token.shape[1] / self.token_hop_len) * self.token_hop_len - flow_prompt_speech_token.shape[1])
+            scheduler = ChunkScheduler(self.token_hop_len, self.token_min_hop_len, self.token_max_hop_len, self.flow.input_frame_rate, self.stream_scale_factor)
+            wait_start = time.time()
             while True:
                 time.sleep(0.1)
-                this_token_hop_len = self.token_hop_len + prompt_token_pad if token_offset == 0 else self.token_hop_len
+                this_token_hop_len = scheduler.hop_len + prompt_token_pad if token_offset == 0 else scheduler.hop_len
                 if len(self.tts_speech_token_dict[this_uuid]) - token_offset >= this_token_hop_len + self.flow.pre_lookahead_len:
+                    self.profile_event(this_uuid, 'hop_wait', time.time() - wait_start)
                     this_tts_speech_token = torch.tensor(self.tts_speech_token_dict[this_uuid][:token_offset + this_token_hop_len + self.flow.pre_lookahead_len]).unsqueeze(dim=0)
                     this_tts_speech = self.token2wav(token=this_tts_speech_token,
                                                      prompt_token=flow_prompt_speech_token,
@@ -353,10 +529,14 @@ class CosyVoice2Model(CosyVoiceModel):
                                                      stream=stream,
                                                      finalize=False)
                     token_offset += this_token_hop_len
+                    scheduler.update(this_tts_speech.shape[1] / self.hift.sampling_rate)
+                    self.profile_event(this_uuid, 'chunk', 0.0, speech_len=this_tts_speech.shape[1] / self.hift.sampling_rate)
                     yield {'tts_speech': this_tts_speech.cpu()}
+                    wait_start = time.time()
                 if self.llm_end_dict[this_uuid] is True and len(self.tts_speech_token_dict[this_uuid]) - token_offset < this_token_hop_len + self.flow.pre_lookahead_len:
                     break
             p.join()
+            self.profile_event(this_uuid, 'hop_wait', time.time() - wait_start)
             # deal with remain tokens, make sure inference remain token len equals token_hop_len when cache_speech is not None
             this_tts_speech_token = torch.tensor(self.tts_speech_token_dict[this_uuid]).unsqueeze(dim=0)
             this_tts_speech = self.token2wav(token=this_tts_speech_token,
@@ -365,11 +545,17 @@ class CosyVoice2Model(CosyVoiceModel):
                                              embedding=flow_embedding,
                                              token_offset=token_offset,
                                              uuid=this_uuid,
+                                             stream=stream,
                                              finalize=True)
-            yield {'tts_speech': this_tts_speech.cpu()}
+            # NOTE first chunk latency, underrun and hop lens of this request
+            stream_stats = scheduler.finish(this_tts_speech.shape[1] / self.hift.sampling_rate)
+            self.profile_event(this_uuid, 'chunk', 0.0, speech_len=this_tts_speech.shape[1] / self.hift.sampling_rate)
+            yield {'tts_speech': this_tts_speech.cpu(), 'stream_stats': stream_stats}
         else:
             # deal with all tokens
+            wait_start = time.time()
             p.join()
+            self.profile_event(this_uuid, 'hop_wait', time.time() - wait_start)
             this_tts_speech_token = torch.tensor(self.tts_speech_token_dict[this_uuid]).unsqueeze(dim=0)
             this_tts_speech = self.token2wav(token=this_tts_speech_token,
                                              prompt_token=flow_prompt_speech_token,
@@ -379,11 +565,15 @@ class CosyVoice2Model(CosyVoiceModel):
                                              uuid=this_uuid,
                                              finalize=True,
                                              speed=speed)
+            self.profile_event(this_uuid, 'chunk', 0.0, speech_len=this_tts_speech.shape[1] / self.hift.sampling_rate)
             yield {'tts_speech': this_tts_speech.cpu()}
         with self.lock:
             self.tts_speech_token_dict.pop(this_uuid)
             self.llm_end_dict.pop(this_uuid)
             self.hift_cache_dict.pop(this_uuid)
+            self.flow_conf_dict.pop(this_uuid)
+            self.flow_cache_dict.pop(this_uuid)
+            self.profiler_dict.pop(this_uuid, None)
         if torch.cuda.is_available():
             torch.cuda.empty_cache()
             torch.cuda.current_stream().synchronize()
@@ -403,6 +593,10 @@ class CosyVoice3Model(CosyVoice2Model):
         self.fp16 = fp16
         # NOTE must matching training static_chunk_size
         self.token_hop_len = 25
+        # stream hop len is scheduled between min and max hop len by measured rtf, see ChunkScheduler
+        self.token_min_hop_len = self.token_hop_len
+        self.token_max_hop_len = 4 * self.token_hop_len
+        self.stream_scale_factor = 2
         # rtf and decoding related
         self.llm_context = torch.cuda.stream(torch.cuda.Stream(self.device)) if torch.cuda.is_available() else nullcontext()
         self.lock = threading.Lock()
@@ -410,21 +604,39 @@ class CosyVoice3Model(CosyVoice2Model):
         self.tts_speech_token_dict = {}
         self.llm_end_dict = {}
         self.hift_cache_dict = {}
+        self.flow_conf_dict = {}
+        self.flow_cache_dict = {}
+        self.profiler_dict = {}
+        # flow matching ode settings, could be overridden per request by tts(flow_conf=...)
+        self.flow_conf = {'n_timesteps': 10, 'solver': 'euler', 'cfg_rate': None, 'cfg_schedule': None}
+        # modules running in cpu bf16 autocast, see quantize
+        self.bf16_modules = []
+        # stream inference only encodes/decodes new tokens, see load_incremental_flow
+        self.incremental_flow, self.flow_estimator_cache = False, False
         # FSQ silent and breath token
         self.silent_tokens = [1, 2, 28, 29, 55, 248, 494, 2241, 2242, 2322, 2323]
 
     def token2wav(self, token, prompt_token, prompt_feat, embedding, token_offset, uuid, stream=False, finalize=False, speed=1.0):
-        with torch.cuda.amp.autocast(self.fp16):
-            tts_mel, _ = self.flow.inference(token=token.to(self.device, dtype=torch.int32),
-                                             token_len=torch.tensor([token.shape[1]], dtype=torch.int32).to(self.device),
-                                             prompt_token=prompt_token.to(self.device),
-                                             prompt_token_len=torch.tensor([prompt_token.shape[1]], dtype=torch.int32).to(self.device),
-                                             prompt_feat=prompt_feat.to(self.device),
-                                             prompt_feat_len=torch.tensor([prompt_feat.shape[1]], dtype=torch.int32).to(self.device),
-                                             embedding=embedding.to(self.device),
-                                             streaming=stream,
-                                             finalize=finalize)
+        with torch.cuda.amp.autocast(self.fp16), self.bf16_context('flow'):
+            with self.profile(uuid, 'flow'):
+                tts_mel, _ = self.flow.inference(token=token.to(self.device, dtype=torch.int32),
+                                                 token_len=torch.tensor([token.shape[1]], dtype=torch.int32).to(self.device),
+                                                 prompt_token=prompt_token.to(self.device),
+                                                 prompt_token_len=torch.tensor([prompt_token.shape[1]], dtype=torch.int32).to(self.device),
+                                                 prompt_feat=prompt_feat.to(self.device),
+                                                 prompt_feat_len=torch.tensor([prompt_feat.shape[1]], dtype=torch.int32).to(self.device),
+                                                 embedding=embedding.to(self.device),
+                                                 streaming=stream,
+                                                 finalize=finalize,
+                                                 **self.flow_conf_dict[uuid])
             tts_mel = tts_mel[:, :, token_offset * self.flow.token_mel_ratio:]
+            # NOTE stream inference only vocodes the new mel, hift carries its state in hift_cache_dict,
+            # onnxruntime hift decode has no causal conv cache and vocodes the whole mel
+            if (finalize is False or self.hift_cache_dict[uuid] is not None) and not hasattr(self.hift, 'ort_decode_spec'):
+                assert speed == 1.0, 'speed change only support non-stream inference mode'
+                with self.profile(uuid, 'hift'), self.bf16_context('hift'):
+                    tts_speech, self.hift_cache_dict[uuid] = self.hift.inference_chunk(speech_feat=tts_mel, cache=self.hift_cache_dict[uuid], finalize=finalize)
+                return tts_speech
             # append mel cache
             if self.hift_cache_dict[uuid] is not None:
                 hift_cache_mel = self.hift_cache_dict[uuid]['mel']
@@ -435,7 +647,8 @@ class CosyVoice3Model(CosyVoice2Model):
             if speed != 1.0:
                 assert token_offset == 0 and finalize is True, 'speed change only support non-stream inference mode'
                 tts_mel = F.interpolate(tts_mel, size=int(tts_mel.shape[2] / speed), mode='linear')
-            tts_speech, _ = self.hift.inference(speech_feat=tts_mel, finalize=finalize)
+            with self.profile(uuid, 'hift'), self.bf16_context('hift'):
+                tts_speech, _ = self.hift.inference(speech_feat=tts_mel, finalize=finalize)
             tts_speech = tts_speech[:, self.hift_cache_dict[uuid]['speech_offset']:]
             self.hift_cache_dict[uuid]['speech_offset'] += tts_speech.shape[1]
         return tts_speech
@@ -0,0 +1,62 @@
+import threading
+import time
+from contextlib import contextmanager
+import torch
+
+
+class TTSProfiler:
+    """Stage timings of one CosyVoice inference call.
+
+    Pass an instance as profiler to CosyVoice.inference_* or CosyVoiceModel.tts. It records one event per stage:
+    frontend of every text segment, llm_prefill (time to the first speech token), llm_decode of every following
+    token, hop_wait (waiting for enough speech tokens of the next chunk, or for the llm to finish), flow and hift
+    of every chunk, chunk when a chunk is yielded, and pipeline with the SegmentPipeline stats after the last text
+    segment. The llm thread and the synthesis thread record concurrently.
+    callback, if given, is called with every event as it is recorded, e.g. to export metrics while synthesizing.
+    """
+
+    def __init__(self, callback=None):
+        self.callback = callback
+        self.start_time = time.time()
+        self.events = []
+        self.lock = threading.Lock()
+
+    def record(self, stage, duration, **info):
+        """record stage which took duration seconds and ended now, time of the event is relative to the profiler creation"""
+        event = {'stage': stage, 'time': time.time() - self.start_time, 'duration': duration, **info}
+        with self.lock:
+            self.events.append(event)
+        if self.callback is not None:
+            self.callback(event)
+
+    @contextmanager
+    def span(self, stage, **info):
+        start_time = time.time()
+        try:
+            yield
+        finally:
+            # NOTE cuda kernels are asynchronous, wait for them so that the duration is of this stage
+            if torch.cuda.is_available():
+                torch.cuda.current_stream().synchronize()
+            self.record(stage, time.time() - start_time, **info)
+
+    def summary(self):
+        """total/count/mean/max seconds of every stage, time to first chunk, wall time and rtf of the yielded speech"""
+        with self.lock:
+            events = list(self.events)
+        stages = {}
+        for event in events:
+            if event['stage'] not in ('chunk', 'pipeline'):
+                stages.setdefault(event['stage'], []).append(event['duration'])
+        summary = {stage: {'total': sum(v), 'count': len(v), 'mean': sum(v) / len(v), 'max': max(v)} for stage, v in stages.items()}
+        chunks = [i for i in events if i['stage'] == 'chunk']
+        speech_len = sum([i['speech_len'] for i in chunks])
+        wall_time = max([i['time'] for i in events]) if len(events) != 0 else 0.0
+        summary['chunks'] = len(chunks)
+        summary['first_chunk_latency'] = chunks[0]['time'] if len(chunks) != 0 else None
+        summary['speech_len'] = speech_len
+        summary['wall_time'] = wall_time
+        summary['rtf'] = wall_time / speech_len if speech_len > 0 else None
+        pipeline = [i for i in events if i['stage'] == 'pipeline']
+        summary['pipeline_overlap'] = pipeline[-1]['overlap'] if len(pipeline) != 0 else None
+        return summary
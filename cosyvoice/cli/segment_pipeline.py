@@ -0,0 +1,101 @@
+import queue
+import threading
+import time
+from cosyvoice.utils.file_utils import logging
+
+
+class SegmentPipeline:
+    """Pipelined synthesis of the text segments of one inference call.
+
+    Each segment runs its job (frontend and model.tts, i.e. llm then flow and hift) in its own producer
+    thread, and at most depth segments are in flight, so the llm decoding of segment k + 1 overlaps the
+    flow and hift of segment k on other cores. Outputs are buffered per segment, at most depth outputs each,
+    and yielded strictly in segment order. depth 1 runs the segments one by one in the calling thread, the
+    same as a plain loop. Overlap is the summed busy time of all segments divided by the wall time of the call,
+    it is written to the stats dict passed to run once all segments are yielded, so concurrent calls on the
+    same pipeline never see each other's stats.
+    """
+
+    def __init__(self, depth=2):
+        assert depth >= 1, 'pipeline depth should be greater than 0'
+        self.depth = depth
+
+    def put(self, outputs, item, stop):
+        """put item to the bounded outputs queue, give up when the consumer stopped"""
+        while not stop.is_set():
+            try:
+                outputs.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def producer(self, job, segment, outputs, stop, timing):
+        timing[0] = time.time()
+        try:
+            for output in job(segment):
+                if not self.put(outputs, ('output', output), stop):
+                    break
+            self.put(outputs, ('done', None), stop)
+        except Exception as e:
+            self.put(outputs, ('error', e), stop)
+        finally:
+            timing[1] = time.time()
+
+    def run(self, segments, job, stats=None):
+        """yield the outputs of job(segment) of every segment in order, fill stats of this call if given"""
+        start_time = time.time()
+        # [start time, end time] of every segment
+        timings = []
+        if self.depth == 1:
+            for segment in segments:
+                timing = [time.time(), None]
+                timings.append(timing)
+                yield from job(segment)
+                timing[1] = time.time()
+        else:
+            yield from self.run_pipelined(segments, job, timings)
+        wall_time = time.time() - start_time
+        busy_time = sum([i[1] - i[0] for i in timings])
+        overlap = busy_time / wall_time if wall_time > 0 else 0.0
+        if stats is not None:
+            stats.update({'segments': len(timings), 'busy_time': busy_time, 'wall_time': wall_time, 'overlap': overlap})
+        logging.info('pipelined {} segments with depth {}, busy {:.2f}s in {:.2f}s wall time, overlap {:.2f}'.format(
+            len(timings), self.depth, busy_time, wall_time, overlap))
+
+    def run_pipelined(self, segments, job, timings):
+        segments = iter(segments)
+        stop = threading.Event()
+        # (outputs queue, producer thread) of in flight segments in order
+        in_flight = []
+
+        def submit():
+            segment = next(segments, stop)
+            if segment is stop:
+                return
+            # NOTE bounded, a slow consumer blocks the producers instead of buffering the audio of every segment
+            outputs, timing = queue.Queue(maxsize=self.depth), [None, None]
+            thread = threading.Thread(target=self.producer, args=(job, segment, outputs, stop, timing), daemon=True)
+            thread.start()
+            in_flight.append((outputs, thread))
+            timings.append(timing)
+
+        try:
+            for _ in range(self.depth):
+                submit()
+            while len(in_flight) != 0:
+                outputs, thread = in_flight[0]
+                while True:
+                    kind, value = outputs.get()
+                    if kind == 'output':
+                        yield value
+                    elif kind == 'error':
+                        raise value
+                    else:
+                        break
+                thread.join()
+                in_flight.pop(0)
+                submit()
+        finally:
+            # NOTE consumer stopped early, producers finish their current output and exit
+            stop.set()
@@ -15,6 +15,7 @@ from torch import nn
 import torch.nn.functional as F
 from einops import repeat
 from x_transformers.x_transformers import RotaryEmbedding
+from cosyvoice.utils.common import cached_time_embed
 from cosyvoice.utils.mask import add_optional_chunk_mask
 from cosyvoice.flow.DiT.modules import (
     TimestepEmbedding,
@@ -77,6 +78,7 @@ class InputEmbedding(nn.Module):
     def __init__(self, mel_dim, text_dim, out_dim, spk_dim=None):
         super().__init__()
         spk_dim = 0 if spk_dim is None else spk_dim
+        self.mel_dim = mel_dim
         self.spk_dim = spk_dim
         self.proj = nn.Linear(mel_dim * 2 + text_dim + spk_dim, out_dim)
         self.conv_pos_embed = CausalConvPositionEmbedding(dim=out_dim)
@@ -97,6 +99,28 @@ class InputEmbedding(nn.Module):
         x = self.conv_pos_embed(x) + x
         return x
 
+    def prepare(self, cond, text_embed, spks):
+        """Project the step invariant inputs once.
+
+        proj is linear, so proj(cat(x, c)) = x W_x^T + (c W_c^T + b) and only the x part is left for every ode step.
+        Quantized proj has no weight to split, the concatenated c is kept instead.
+        """
+        to_cat = [cond, text_embed]
+        if self.spk_dim > 0:
+            to_cat.append(repeat(spks, "b c -> b t c", t=cond.shape[1]))
+        c = torch.cat(to_cat, dim=-1)
+        if isinstance(self.proj, nn.Linear):
+            return F.linear(c, self.proj.weight[:, self.mel_dim:], self.proj.bias)
+        return c
+
+    def forward_prepared(self, x, prepared):
+        if isinstance(self.proj, nn.Linear):
+            x = F.linear(x, self.proj.weight[:, :self.mel_dim]) + prepared
+        else:
+            x = self.proj(torch.cat([x, prepared], dim=-1))
+        x = self.conv_pos_embed(x) + x
+        return x
+
 
 # Transformer backbone using DiT blocks
 
@@ -142,7 +166,9 @@ class DiT(nn.Module):
         self.static_chunk_size = static_chunk_size
         self.num_decoding_left_chunks = num_decoding_left_chunks
 
-    def forward(self, x, mask, mu, t, spks=None, cond=None, streaming=False):
+    def forward(self, x, mask, mu, t, spks=None, cond=None, streaming=False, prepared=None):
+        if prepared is not None:
+            return self.forward_prepared(x, t, prepared)
         x = x.transpose(1, 2)
         mu = mu.transpose(1, 2)
         cond = cond.transpose(1, 2)
@@ -174,3 +200,47 @@ class DiT(nn.Module):
         x = self.norm_out(x, t)
         output = self.proj_out(x).transpose(1, 2)
         return output
+
+    def prepare(self, mask, mu, spks=None, cond=None, streaming=False, t_span=None):
+        """Step invariant inputs of forward, computed once per utterance and reused by every ode step.
+
+        Only x and t change between ode steps, so the cond/mu/spks projection of input_embed, the rotary table
+        and the attention mask are built here. Time embeddings of t_span are computed ahead and the ones of
+        other times (e.g. midpoint solver) are memoized on first use.
+        """
+        mu = mu.transpose(1, 2)
+        cond = cond.transpose(1, 2)
+        batch, seq_len = mu.shape[0], mu.shape[1]
+        if streaming is True:
+            attn_mask = add_optional_chunk_mask(mu, mask.bool(), False, False, 0, self.static_chunk_size, -1).unsqueeze(dim=1)
+        else:
+            attn_mask = add_optional_chunk_mask(mu, mask.bool(), False, False, 0, 0, -1).repeat(1, seq_len, 1).unsqueeze(dim=1)
+        prepared = {'input_embed': self.input_embed.prepare(cond, mu, spks),
+                    'rope': self.rotary_embed.forward_from_seq_len(seq_len),
+                    'attn_mask': attn_mask.bool(),
+                    'time_embed': {}}
+        if t_span is not None:
+            for t in t_span[:-1]:
+                cached_time_embed(self.time_embed, t.repeat(batch), prepared['time_embed'])
+        return prepared
+
+    def forward_prepared(self, x, t, prepared):
+        """forward with the step invariant inputs returned by prepare, x (b, c, n) and t are the only step inputs"""
+        x = x.transpose(1, 2)
+        if t.ndim == 0:
+            t = t.repeat(x.shape[0])
+        t = cached_time_embed(self.time_embed, t, prepared['time_embed'])
+        x = self.input_embed.forward_prepared(x, prepared['input_embed'])
+
+        if self.long_skip_connection is not None:
+            residual = x
+
+        for block in self.transformer_blocks:
+            x = block(x, t, mask=prepared['attn_mask'], rope=prepared['rope'])
+
+        if self.long_skip_connection is not None:
+            x = self.long_skip_connection(torch.cat((x, residual), dim=-1))
+
+        x = self.norm_out(x, t)
+        output = self.proj_out(x).transpose(1, 2)
+        return output
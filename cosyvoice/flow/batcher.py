@@ -0,0 +1,105 @@
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+import torch
+import torch.nn.functional as F
+from cosyvoice.utils.file_utils import logging
+
+
+class EstimatorBatcher:
+    """Batches the estimator forwards of concurrent flow matching requests.
+
+    Every request keeps running its own ode loop, but instead of calling the estimator directly it
+    submits the (cfg doubled) inputs of its current step here. A worker thread waits until every
+    request inside a solve has submitted, or max_wait passed, pads the mel lengths into one batch
+    with masks, runs a single estimator forward and splits the output back per request.
+    A single request never waits, so its latency stays the same as without batching.
+    """
+
+    def __init__(self, estimator, max_batch_size=4, max_wait=0.005):
+        self.estimator = estimator
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        # NOTE GroupNorm in ConditionalDecoder normalizes over time, so padded inputs change its output
+        self.allow_padding = estimator.__class__.__name__ != 'ConditionalDecoder'
+        self.condition = threading.Condition()
+        self.pending = []
+        self.sessions = 0
+        # number of requests in one estimator forward -> number of forwards
+        self.batch_stats = defaultdict(int)
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    @contextmanager
+    def session(self):
+        with self.condition:
+            self.sessions += 1
+        try:
+            yield
+        finally:
+            with self.condition:
+                self.sessions -= 1
+                self.condition.notify_all()
+
+    def __call__(self, x, mask, mu, t, spks, cond, streaming=False):
+        request = {'inputs': [x, mask, mu, t, spks, cond], 'streaming': streaming, 'output': None, 'event': threading.Event()}
+        with self.condition:
+            self.pending.append(request)
+            self.condition.notify_all()
+        request['event'].wait()
+        if isinstance(request['output'], Exception):
+            raise request['output']
+        return request['output']
+
+    def run(self):
+        with torch.inference_mode():
+            while True:
+                with self.condition:
+                    while len(self.pending) == 0:
+                        self.condition.wait()
+                    # wait for the other running solves to submit their step, so steps of all requests are aligned
+                    deadline = time.time() + self.max_wait
+                    while len(self.pending) < min(self.sessions, self.max_batch_size) and time.time() < deadline:
+                        self.condition.wait(deadline - time.time())
+                    batch = self.select()
+                self.forward(batch)
+
+    def select(self):
+        key = self.get_key(self.pending[0])
+        batch = [i for i in self.pending if self.get_key(i) == key][:self.max_batch_size]
+        selected = set(id(i) for i in batch)
+        self.pending = [i for i in self.pending if id(i) not in selected]
+        return batch
+
+    def get_key(self, request):
+        x = request['inputs'][0]
+        return request['streaming'], x.dtype, None if self.allow_padding else x.size(2)
+
+    def forward(self, batch):
+        try:
+            lengths = [i['inputs'][0].size(2) for i in batch]
+            sizes = [i['inputs'][0].size(0) for i in batch]
+            max_len = max(lengths)
+            inputs = []
+            for j in range(len(batch[0]['inputs'])):
+                tensors = [i['inputs'][j] for i in batch]
+                if tensors[0].dim() == 3:
+                    # zero padding also pads mask with 0, so padded frames are masked out
+                    tensors = [F.pad(k, (0, max_len - k.size(2))) for k in tensors]
+                inputs.append(torch.concat(tensors, dim=0))
+            output = self.estimator(*inputs, streaming=batch[0]['streaming'])
+            for i, j, k in zip(batch, output.split(sizes, dim=0), lengths):
+                i['output'] = j[:, :, :k]
+            self.batch_stats[len(batch)] += 1
+        except Exception as e:
+            logging.error('estimator batcher failed, {}'.format(e))
+            for i in batch:
+                i['output'] = e
+        for i in batch:
+            i['event'].set()
+
+    def get_stats(self):
+        forwards = sum(self.batch_stats.values())
+        requests = sum(k * v for k, v in self.batch_stats.items())
+        return {'forwards': forwards, 'mean_batch_size': requests / max(forwards, 1), 'batch_size_hist': dict(sorted(self.batch_stats.items()))}
@@ -16,8 +16,8 @@ import torch
 import torch.nn as nn
 import torch.nn.functional as F
 from einops import pack, rearrange, repeat
-from cosyvoice.utils.common import mask_to_bias
-from cosyvoice.utils.mask import add_optional_chunk_mask
+from cosyvoice.utils.common import mask_to_bias, cached_time_embed
+from cosyvoice.utils.mask import add_optional_chunk_mask, subsequent_chunk_mask_with_cache
 from matcha.models.components.decoder import SinusoidalPosEmb, Block1D, ResnetBlock1D, Downsample1D, TimestepEmbedding, Upsample1D
 from matcha.models.components.transformer import BasicTransformerBlock
 
@@ -61,6 +61,16 @@ class CausalConv1d(torch.nn.Conv1d):
         x = super(CausalConv1d, self).forward(x)
         return x
 
+    def forward_chunk(self, x: torch.Tensor, cache: torch.Tensor) -> Tuple[torch.Tensor, torch.Tensor]:
+        # NOTE cache is the last causal_padding input frames of previous chunks, empty for the first chunk
+        if cache.size(2) == 0:
+            x = F.pad(x, (self.causal_padding, 0), value=0.0)
+        else:
+            x = torch.concat([cache, x], dim=2)
+        new_cache = x[:, :, x.size(2) - self.causal_padding:]
+        x = super(CausalConv1d, self).forward(x)
+        return x, new_cache
+
 
 class CausalBlock1D(Block1D):
     def __init__(self, dim: int, dim_out: int):
@@ -77,6 +87,11 @@ class CausalBlock1D(Block1D):
         output = self.block(x * mask)
         return output * mask
 
+    def forward_chunk(self, x: torch.Tensor, mask: torch.Tensor, cache: torch.Tensor) -> Tuple[torch.Tensor, torch.Tensor]:
+        output, new_cache = self.block[0].forward_chunk(x * mask, cache)
+        output = self.block[1:](output)
+        return output * mask, new_cache
+
 
 class CausalResnetBlock1D(ResnetBlock1D):
     def __init__(self, dim: int, dim_out: int, time_emb_dim: int, groups: int = 8):
@@ -84,6 +99,14 @@ class CausalResnetBlock1D(ResnetBlock1D):
         self.block1 = CausalBlock1D(dim, dim_out)
         self.block2 = CausalBlock1D(dim_out, dim_out)
 
+    def forward_chunk(self, x: torch.Tensor, mask: torch.Tensor, time_emb: torch.Tensor,
+                      cache: Tuple[torch.Tensor, torch.Tensor]) -> Tuple[torch.Tensor, Tuple[torch.Tensor, torch.Tensor]]:
+        h, block1_cache = self.block1.forward_chunk(x, mask, cache[0])
+        h += self.mlp(time_emb).unsqueeze(-1)
+        h, block2_cache = self.block2.forward_chunk(h, mask, cache[1])
+        output = h + self.res_conv(x * mask)
+        return output, (block1_cache, block2_cache)
+
 
 class ConditionalDecoder(nn.Module):
     def __init__(
@@ -207,7 +230,45 @@ class ConditionalDecoder(nn.Module):
                 if m.bias is not None:
                     nn.init.constant_(m.bias, 0)
 
-    def forward(self, x, mask, mu, t, spks=None, cond=None, streaming=False):
+    def time_embed(self, t):
+        t = self.time_embeddings(t).to(t.dtype)
+        return self.time_mlp(t)
+
+    def attn_mask(self, mask, streaming=False):
+        """boolean attention mask (b, t, t) of mask (b, 1, t), full context"""
+        return add_optional_chunk_mask(mask.transpose(1, 2), mask.bool(), False, False, 0, 0, -1).repeat(1, mask.size(2), 1)
+
+    def prepare(self, mask, mu, spks=None, cond=None, streaming=False, t_span=None):
+        """Step invariant inputs of forward, computed once per utterance and reused by every ode step.
+
+        Only x and t change between ode steps, so mu/spks/cond are packed once, and the masks of every
+        resolution and their attention masks are built here. Time embeddings of t_span are computed ahead
+        and the ones of other times (e.g. midpoint solver) are memoized on first use.
+        """
+        h = mu
+        if spks is not None:
+            spks = repeat(spks, "b c -> b c t", t=mu.shape[-1])
+            h = pack([h, spks], "b * t")[0]
+        if cond is not None:
+            h = pack([h, cond], "b * t")[0]
+        masks = [mask]
+        for _ in range(len(self.down_blocks) - 1):
+            masks.append(masks[-1][:, :, ::2])
+        prepared = {'h': h, 'masks': masks, 'attn_masks': [self.attn_mask(m, streaming) for m in masks],
+                    'attn_bias': {}, 'time_embed': {}}
+        if t_span is not None:
+            for t in t_span[:-1]:
+                cached_time_embed(self.time_embed, t.repeat(mu.shape[0]), prepared['time_embed'])
+        return prepared
+
+    @staticmethod
+    def prepared_attn_bias(prepared, level, dtype):
+        # NOTE bias follows the dtype of hidden states, which may differ from mu under autocast
+        if (level, dtype) not in prepared['attn_bias']:
+            prepared['attn_bias'][(level, dtype)] = mask_to_bias(prepared['attn_masks'][level], dtype)
+        return prepared['attn_bias'][(level, dtype)]
+
+    def forward(self, x, mask, mu, t, spks=None, cond=None, streaming=False, prepared=None):
         """Forward pass of the UNet1DConditional model.
 
         Args:
@@ -216,6 +277,8 @@ class ConditionalDecoder(nn.Module):
             t (_type_): shape (batch_size)
             spks (_type_, optional): shape: (batch_size, condition_channels). Defaults to None.
             cond (_type_, optional): placeholder for future use. Defaults to None.
+            prepared (dict, optional): step invariant inputs returned by prepare, mask/mu/spks/cond are
+                not used when given. Defaults to None.
 
         Raises:
             ValueError: _description_
@@ -224,26 +287,21 @@ class ConditionalDecoder(nn.Module):
         Returns:
             _type_: _description_
         """
+        if prepared is None:
+            prepared = self.prepare(mask, mu, spks, cond, streaming)
+            t = self.time_embed(t)
+        else:
+            t = cached_time_embed(self.time_embed, t, prepared['time_embed'])
 
-        t = self.time_embeddings(t).to(t.dtype)
-        t = self.time_mlp(t)
-
-        x = pack([x, mu], "b * t")[0]
-
-        if spks is not None:
-            spks = repeat(spks, "b c -> b c t", t=x.shape[-1])
-            x = pack([x, spks], "b * t")[0]
-        if cond is not None:
-            x = pack([x, cond], "b * t")[0]
+        x = pack([x, prepared['h']], "b * t")[0]
 
         hiddens = []
-        masks = [mask]
-        for resnet, transformer_blocks, downsample in self.down_blocks:
-            mask_down = masks[-1]
+        masks = prepared['masks']
+        for level, (resnet, transformer_blocks, downsample) in enumerate(self.down_blocks):
+            mask_down = masks[level]
             x = resnet(x, mask_down, t)
             x = rearrange(x, "b c t -> b t c").contiguous()
-            attn_mask = add_optional_chunk_mask(x, mask_down.bool(), False, False, 0, 0, -1).repeat(1, x.size(1), 1)
-            attn_mask = mask_to_bias(attn_mask, x.dtype)
+            attn_mask = self.prepared_attn_bias(prepared, level, x.dtype)
             for transformer_block in transformer_blocks:
                 x = transformer_block(
                     hidden_states=x,
@@ -253,15 +311,12 @@ class ConditionalDecoder(nn.Module):
             x = rearrange(x, "b t c -> b c t").contiguous()
             hiddens.append(x)  # Save hidden states for skip connections
             x = downsample(x * mask_down)
-            masks.append(mask_down[:, :, ::2])
-        masks = masks[:-1]
         mask_mid = masks[-1]
 
         for resnet, transformer_blocks in self.mid_blocks:
             x = resnet(x, mask_mid, t)
             x = rearrange(x, "b c t -> b t c").contiguous()
-            attn_mask = add_optional_chunk_mask(x, mask_mid.bool(), False, False, 0, 0, -1).repeat(1, x.size(1), 1)
-            attn_mask = mask_to_bias(attn_mask, x.dtype)
+            attn_mask = self.prepared_attn_bias(prepared, len(masks) - 1, x.dtype)
             for transformer_block in transformer_blocks:
                 x = transformer_block(
                     hidden_states=x,
@@ -270,14 +325,14 @@ class ConditionalDecoder(nn.Module):
                 )
             x = rearrange(x, "b t c -> b c t").contiguous()
 
-        for resnet, transformer_blocks, upsample in self.up_blocks:
-            mask_up = masks.pop()
+        for i, (resnet, transformer_blocks, upsample) in enumerate(self.up_blocks):
+            level = len(masks) - 1 - i
+            mask_up = masks[level]
             skip = hiddens.pop()
             x = pack([x[:, :, :skip.shape[-1]], skip], "b * t")[0]
             x = resnet(x, mask_up, t)
             x = rearrange(x, "b c t -> b t c").contiguous()
-            attn_mask = add_optional_chunk_mask(x, mask_up.bool(), False, False, 0, 0, -1).repeat(1, x.size(1), 1)
-            attn_mask = mask_to_bias(attn_mask, x.dtype)
+            attn_mask = self.prepared_attn_bias(prepared, level, x.dtype)
             for transformer_block in transformer_blocks:
                 x = transformer_block(
                     hidden_states=x,
@@ -288,7 +343,7 @@ class ConditionalDecoder(nn.Module):
             x = upsample(x * mask_up)
         x = self.final_block(x, mask_up)
         output = self.final_proj(x * mask_up)
-        return output * mask
+        return output * masks[0]
 
 
 class CausalConditionalDecoder(ConditionalDecoder):
@@ -402,23 +457,33 @@ class CausalConditionalDecoder(ConditionalDecoder):
         self.final_proj = nn.Conv1d(channels[-1], self.out_channels, 1)
         self.initialize_weights()
 
-    def forward(self, x, mask, mu, t, spks=None, cond=None, streaming=False):
-        """Forward pass of the UNet1DConditional model.
+    def attn_mask(self, mask, streaming=False):
+        """boolean attention mask of mask (b, 1, t), chunk causal with static_chunk_size in streaming mode"""
+        if streaming is True:
+            return add_optional_chunk_mask(mask.transpose(1, 2), mask.bool(), False, False, 0, self.static_chunk_size, -1)
+        return add_optional_chunk_mask(mask.transpose(1, 2), mask.bool(), False, False, 0, 0, -1).repeat(1, mask.size(2), 1)
 
-        Args:
-            x (torch.Tensor): shape (batch_size, in_channels, time)
-            mask (_type_): shape (batch_size, 1, time)
-            t (_type_): shape (batch_size)
-            spks (_type_, optional): shape: (batch_size, condition_channels). Defaults to None.
-            cond (_type_, optional): placeholder for future use. Defaults to None.
+    def forward_chunk(self, x, mask, mu, t, spks=None, cond=None, cache=None):
+        """Forward of the new frames of streaming inference with cache, the output
+        equals to the matching frames of forward with streaming=True.
 
-        Raises:
-            ValueError: _description_
-            ValueError: _description_
+        Args:
+            x, mask, mu, spks, cond: same as forward, of the new frames only
+            t (torch.Tensor): shape (batch_size)
+            cache (dict, optional): returned by the previous chunk, None for the first chunk.
+                It keeps the causal conv left context and the attention inputs of all previous frames,
+                previous chunks must end at a multiple of static_chunk_size.
 
         Returns:
-            _type_: _description_
+            output of the new frames, shape (batch_size, out_channels, time), and the updated cache
         """
+        offset = 0 if cache is None else cache['offset']
+        assert offset % self.static_chunk_size == 0, 'previous chunks must end at a multiple of static_chunk_size {}'.format(self.static_chunk_size)
+        empty = torch.zeros(0, 0, 0, device=x.device, dtype=x.dtype)
+        conv_cache = iter([] if cache is None else cache['conv'])
+        att_cache = iter([] if cache is None else cache['att'])
+        new_cache = {'offset': offset + x.size(2), 'conv': [], 'att': []}
+
         t = self.time_embeddings(t).to(t.dtype)
         t = self.time_mlp(t)
 
@@ -430,65 +495,63 @@ class CausalConditionalDecoder(ConditionalDecoder):
         if cond is not None:
             x = pack([x, cond], "b * t")[0]
 
+        # NOTE new frames attend to all previous frames, which are never padded in inference
+        key_mask = torch.concat([torch.ones(x.size(0), 1, offset, dtype=torch.bool, device=x.device), mask.bool()], dim=2)
+        attn_mask = key_mask & subsequent_chunk_mask_with_cache(x.size(2), offset, self.static_chunk_size, x.device).unsqueeze(0)
+        attn_mask = mask_to_bias(attn_mask, x.dtype)
+
         hiddens = []
-        masks = [mask]
         for resnet, transformer_blocks, downsample in self.down_blocks:
-            mask_down = masks[-1]
-            x = resnet(x, mask_down, t)
+            assert isinstance(downsample, CausalConv1d), 'forward_chunk does not support downsampling'
+            x, resnet_cache = resnet.forward_chunk(x, mask, t, next(conv_cache, (empty, empty)))
+            new_cache['conv'].append(resnet_cache)
             x = rearrange(x, "b c t -> b t c").contiguous()
-            if streaming is True:
-                attn_mask = add_optional_chunk_mask(x, mask_down.bool(), False, False, 0, self.static_chunk_size, -1)
-            else:
-                attn_mask = add_optional_chunk_mask(x, mask_down.bool(), False, False, 0, 0, -1).repeat(1, x.size(1), 1)
-            attn_mask = mask_to_bias(attn_mask, x.dtype)
             for transformer_block in transformer_blocks:
-                x = transformer_block(
-                    hidden_states=x,
-                    attention_mask=attn_mask,
-                    timestep=t,
-                )
+                x, block_cache = self.transformer_block_chunk(transformer_block, x, attn_mask, next(att_cache, None))
+                new_cache['att'].append(block_cache)
             x = rearrange(x, "b t c -> b c t").contiguous()
             hiddens.append(x)  # Save hidden states for skip connections
-            x = downsample(x * mask_down)
-            masks.append(mask_down[:, :, ::2])
-        masks = masks[:-1]
-        mask_mid = masks[-1]
+            x, downsample_cache = downsample.forward_chunk(x * mask, next(conv_cache, empty))
+            new_cache['conv'].append(downsample_cache)
 
         for resnet, transformer_blocks in self.mid_blocks:
-            x = resnet(x, mask_mid, t)
+            x, resnet_cache = resnet.forward_chunk(x, mask, t, next(conv_cache, (empty, empty)))
+            new_cache['conv'].append(resnet_cache)
             x = rearrange(x, "b c t -> b t c").contiguous()
-            if streaming is True:
-                attn_mask = add_optional_chunk_mask(x, mask_mid.bool(), False, False, 0, self.static_chunk_size, -1)
-            else:
-                attn_mask = add_optional_chunk_mask(x, mask_mid.bool(), False, False, 0, 0, -1).repeat(1, x.size(1), 1)
-            attn_mask = mask_to_bias(attn_mask, x.dtype)
             for transformer_block in transformer_blocks:
-                x = transformer_block(
-                    hidden_states=x,
-                    attention_mask=attn_mask,
-                    timestep=t,
-                )
+                x, block_cache = self.transformer_block_chunk(transformer_block, x, attn_mask, next(att_cache, None))
+                new_cache['att'].append(block_cache)
             x = rearrange(x, "b t c -> b c t").contiguous()
 
         for resnet, transformer_blocks, upsample in self.up_blocks:
-            mask_up = masks.pop()
+            assert isinstance(upsample, CausalConv1d), 'forward_chunk does not support upsampling'
             skip = hiddens.pop()
             x = pack([x[:, :, :skip.shape[-1]], skip], "b * t")[0]
-            x = resnet(x, mask_up, t)
+            x, resnet_cache = resnet.forward_chunk(x, mask, t, next(conv_cache, (empty, empty)))
+            new_cache['conv'].append(resnet_cache)
             x = rearrange(x, "b c t -> b t c").contiguous()
-            if streaming is True:
-                attn_mask = add_optional_chunk_mask(x, mask_up.bool(), False, False, 0, self.static_chunk_size, -1)
-            else:
-                attn_mask = add_optional_chunk_mask(x, mask_up.bool(), False, False, 0, 0, -1).repeat(1, x.size(1), 1)
-            attn_mask = mask_to_bias(attn_mask, x.dtype)
             for transformer_block in transformer_blocks:
-                x = transformer_block(
-                    hidden_states=x,
-                    attention_mask=attn_mask,
-                    timestep=t,
-                )
+                x, block_cache = self.transformer_block_chunk(transformer_block, x, attn_mask, next(att_cache, None))
+                new_cache['att'].append(block_cache)
             x = rearrange(x, "b t c -> b c t").contiguous()
-            x = upsample(x * mask_up)
-        x = self.final_block(x, mask_up)
-        output = self.final_proj(x * mask_up)
-        return output * mask
+            x, upsample_cache = upsample.forward_chunk(x * mask, next(conv_cache, empty))
+            new_cache['conv'].append(upsample_cache)
+        x, final_block_cache = self.final_block.forward_chunk(x, mask, next(conv_cache, empty))
+        new_cache['conv'].append(final_block_cache)
+        output = self.final_proj(x * mask)
+        return output * mask, new_cache
+
+    @staticmethod
+    def transformer_block_chunk(transformer_block, x, attn_mask, cache=None):
+        """BasicTransformerBlock forward of the new frames.
+
+        cache is the normalized attention input of previous frames, keys and values are projected
+        from it again, which takes less memory than caching keys and values of all heads.
+        """
+        norm_hidden_states = transformer_block.norm1(x)
+        key_hidden_states = norm_hidden_states if cache is None else torch.concat([cache, norm_hidden_states], dim=1)
+        attn_output = transformer_block.attn1(norm_hidden_states, encoder_hidden_states=key_hidden_states, attention_mask=attn_mask)
+        x = attn_output + x
+        ff_output = transformer_block.ff(transformer_block.norm3(x))
+        x = ff_output + x
+        return x, key_hidden_states
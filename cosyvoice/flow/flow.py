@@ -107,7 +107,11 @@ class MaskedDiffWithXvec(torch.nn.Module):
                   prompt_feat,
                   prompt_feat_len,
                   embedding,
-                  flow_cache):
+                  flow_cache,
+                  n_timesteps=10,
+                  solver='euler',
+                  cfg_rate=None,
+                  cfg_schedule=None):
         assert token.shape[0] == 1
         # xvec projection
         embedding = F.normalize(embedding, dim=1)
@@ -136,9 +140,12 @@ class MaskedDiffWithXvec(torch.nn.Module):
             mask=mask.unsqueeze(1),
             spks=embedding,
             cond=conds,
-            n_timesteps=10,
+            n_timesteps=n_timesteps,
             prompt_len=mel_len1,
-            cache=flow_cache
+            cache=flow_cache,
+            solver=solver,
+            cfg_rate=cfg_rate,
+            cfg_schedule=cfg_schedule
         )
         feat = feat[:, :, mel_len1:]
         assert feat.shape[2] == mel_len2
@@ -236,8 +243,16 @@ class CausalMaskedDiffWithXvec(torch.nn.Module):
                   prompt_feat_len,
                   embedding,
                   streaming,
-                  finalize):
+                  finalize,
+                  n_timesteps=10,
+                  solver='euler',
+                  cfg_rate=None,
+                  cfg_schedule=None,
+                  flow_cache=None):
         assert token.shape[0] == 1
+        if flow_cache is not None:
+            return self.inference_chunk(token, prompt_token, prompt_feat, embedding, streaming, finalize, flow_cache,
+                                        n_timesteps=n_timesteps, solver=solver, cfg_rate=cfg_rate, cfg_schedule=cfg_schedule)
         # xvec projection
         embedding = F.normalize(embedding, dim=1)
         embedding = self.spk_embed_affine_layer(embedding)
@@ -267,13 +282,96 @@ class CausalMaskedDiffWithXvec(torch.nn.Module):
             mask=mask.unsqueeze(1),
             spks=embedding,
             cond=conds,
-            n_timesteps=10,
-            streaming=streaming
+            n_timesteps=n_timesteps,
+            streaming=streaming,
+            solver=solver,
+            cfg_rate=cfg_rate,
+            cfg_schedule=cfg_schedule
         )
         feat = feat[:, :, mel_len1:]
         assert feat.shape[2] == mel_len2
         return feat.float(), None
 
+    def init_flow_cache(self, estimator_cache=False):
+        """Empty flow_cache of streaming inference.
+
+        The encoder always runs on the new tokens only. With estimator_cache the estimator also keeps
+        the state of every ode step and only decodes the new frames, its memory grows with the utterance length.
+        """
+        return {'offset': 0, 'encoder': None, 'mu': None, 'estimator': [] if estimator_cache is True else None}
+
+    def inference_chunk(self, token, prompt_token, prompt_feat, embedding, streaming, finalize, flow_cache,
+                        n_timesteps=10, solver='euler', cfg_rate=None, cfg_schedule=None):
+        """Streaming inference with flow_cache, token is the whole token prefix as in inference,
+        returns mel of the tokens after flow_cache['offset'] and the updated flow_cache.
+        """
+        assert streaming is True, 'flow_cache only supports streaming inference'
+        # xvec projection
+        embedding = F.normalize(embedding, dim=1)
+        embedding = self.spk_embed_affine_layer(embedding)
+
+        # concat text and prompt_text, only tokens after offset are new
+        offset = flow_cache['offset']
+        token = torch.concat([prompt_token, token], dim=1)[:, offset:]
+        token = self.input_embedding(torch.clamp(token, min=0))
+
+        # text encode
+        if finalize is True:
+            h, encoder_cache = self.encoder.forward_chunk(token, cache=flow_cache['encoder'])
+        else:
+            token, context = token[:, :-self.pre_lookahead_len], token[:, -self.pre_lookahead_len:]
+            h, encoder_cache = self.encoder.forward_chunk(token, context=context, cache=flow_cache['encoder'])
+        # NOTE prompt is always decoded in the first chunk
+        mel_offset, mel_len1 = offset * self.token_mel_ratio, prompt_feat.shape[1] if offset == 0 else 0
+        mel_len2 = h.shape[1] - mel_len1
+        h = self.encoder_proj(h)
+        mu = h.transpose(1, 2).contiguous()
+
+        if flow_cache['estimator'] is not None:
+            # NOTE only the first chunk decodes the prompt frames, later chunks have no prompt condition
+            conds = torch.zeros([1, mel_len1 + mel_len2, self.output_size], device=token.device).to(h.dtype)
+            conds[:, :mel_len1] = prompt_feat[:, :mel_len1]
+            conds = conds.transpose(1, 2)
+            mask = torch.ones([1, 1, mel_len1 + mel_len2], device=token.device).to(h)
+            feat, estimator_cache = self.decoder.forward_chunk(
+                mu=mu,
+                mask=mask,
+                spks=embedding,
+                cond=conds,
+                n_timesteps=n_timesteps,
+                offset=mel_offset,
+                estimator_cache=flow_cache['estimator'],
+                solver=solver,
+                cfg_rate=cfg_rate,
+                cfg_schedule=cfg_schedule
+            )
+            mu_cache = None
+        else:
+            # NOTE decode all frames with the cached encoder output, estimator streaming mask keeps previous frames unchanged
+            if flow_cache['mu'] is not None:
+                mu = torch.concat([flow_cache['mu'], mu], dim=2)
+            conds = torch.zeros([1, mu.shape[2], self.output_size], device=token.device).to(h.dtype)
+            conds[:, :prompt_feat.shape[1]] = prompt_feat
+            conds = conds.transpose(1, 2)
+            mask = torch.ones([1, 1, mu.shape[2]], device=token.device).to(h)
+            feat, _ = self.decoder(
+                mu=mu,
+                mask=mask,
+                spks=embedding,
+                cond=conds,
+                n_timesteps=n_timesteps,
+                streaming=streaming,
+                solver=solver,
+                cfg_rate=cfg_rate,
+                cfg_schedule=cfg_schedule
+            )
+            feat = feat[:, :, mel_offset:]
+            estimator_cache, mu_cache = None, mu
+        feat = feat[:, :, mel_len1:]
+        assert feat.shape[2] == mel_len2
+        flow_cache = {'offset': offset + token.shape[1], 'encoder': encoder_cache, 'mu': mu_cache, 'estimator': estimator_cache}
+        return feat.float(), flow_cache
+
 
 class CausalMaskedDiffWithDiT(torch.nn.Module):
     def __init__(self,
@@ -365,7 +463,11 @@ class CausalMaskedDiffWithDiT(torch.nn.Module):
                   prompt_feat_len,
                   embedding,
                   streaming,
-                  finalize):
+                  finalize,
+                  n_timesteps=10,
+                  solver='euler',
+                  cfg_rate=None,
+                  cfg_schedule=None):
         assert token.shape[0] == 1
         # xvec projection
         embedding = F.normalize(embedding, dim=1)
@@ -395,8 +497,11 @@ class CausalMaskedDiffWithDiT(torch.nn.Module):
             mask=mask.unsqueeze(1),
             spks=embedding,
             cond=conds,
-            n_timesteps=10,
-            streaming=streaming
+            n_timesteps=n_timesteps,
+            streaming=streaming,
+            solver=solver,
+            cfg_rate=cfg_rate,
+            cfg_schedule=cfg_schedule
         )
         feat = feat[:, :, mel_len1:]
         assert feat.shape[2] == mel_len2
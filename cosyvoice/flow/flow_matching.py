@@ -12,10 +12,12 @@
 # WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 # See the License for the specific language governing permissions and
 # limitations under the License.
+from contextlib import nullcontext
 import torch
 import torch.nn.functional as F
 from matcha.models.components.flow_matching import BASECFM
-from cosyvoice.utils.common import set_all_random_seed
+from cosyvoice.flow.ode_solvers import ODE_SOLVERS
+from cosyvoice.utils.common import set_all_random_seed, OrtEstimatorWrapper, TrtContextWrapper, JitEstimatorWrapper
 
 
 class ConditionalCFM(BASECFM):
@@ -32,9 +34,12 @@ class ConditionalCFM(BASECFM):
         in_channels = in_channels + (spk_emb_dim if n_spks > 0 else 0)
         # Just change the architecture of the estimator here
         self.estimator = estimator
+        # NOTE pytorch estimator prepares the step invariant conditioning once per solve, see estimator prepare
+        self.prepare_estimator = True
 
     @torch.inference_mode()
-    def forward(self, mu, mask, n_timesteps, temperature=1.0, spks=None, cond=None, prompt_len=0, cache=torch.zeros(1, 80, 0, 2)):
+    def forward(self, mu, mask, n_timesteps, temperature=1.0, spks=None, cond=None, prompt_len=0, cache=torch.zeros(1, 80, 0, 2),
+                solver='euler', cfg_rate=None, cfg_schedule=None):
         """Forward diffusion
 
         Args:
@@ -47,6 +52,9 @@ class ConditionalCFM(BASECFM):
             spks (torch.Tensor, optional): speaker ids. Defaults to None.
                 shape: (batch_size, spk_emb_dim)
             cond: Not used but kept for future purposes
+            solver (str, optional): ode solver name in ODE_SOLVERS. Defaults to 'euler'.
+            cfg_rate (float, optional): classifier free guidance rate. Defaults to inference_cfg_rate.
+            cfg_schedule (int or list, optional): steps to apply guidance on, see get_cfg_schedule. Defaults to all steps.
 
         Returns:
             sample: generated mel-spectrogram
@@ -66,7 +74,8 @@ class ConditionalCFM(BASECFM):
         t_span = torch.linspace(0, 1, n_timesteps + 1, device=mu.device, dtype=mu.dtype)
         if self.t_scheduler == 'cosine':
             t_span = 1 - torch.cos(t_span * 0.5 * torch.pi)
-        return self.solve_euler(z, t_span=t_span, mu=mu, mask=mask, spks=spks, cond=cond), cache
+        return self.solve(z, t_span=t_span, mu=mu, mask=mask, spks=spks, cond=cond, solver=solver, cfg_rate=cfg_rate,
+                          cfg_schedule=cfg_schedule), cache
 
     def solve_euler(self, x, t_span, mu, mask, spks, cond, streaming=False):
         """
@@ -83,12 +92,49 @@ class ConditionalCFM(BASECFM):
                 shape: (batch_size, spk_emb_dim)
             cond: Not used but kept for future purposes
         """
-        t, _, dt = t_span[0], t_span[-1], t_span[1] - t_span[0]
-        t = t.unsqueeze(dim=0)
+        return self.solve(x, t_span, mu, mask, spks, cond, streaming=streaming, solver='euler')
 
-        # I am storing this because I can later plot it by putting a debugger here and saving it to a file
-        # Or in future might add like a return_all_steps flag
-        sol = []
+    def get_cfg_schedule(self, n_timesteps, cfg_rate=None, cfg_schedule=None):
+        """Classifier free guidance rate of every step.
+
+        cfg_schedule is None to guide all steps, an int k to guide only the first k steps,
+        or a list of n_timesteps rates. Steps with rate 0 run the estimator without the unconditional half.
+        """
+        cfg_rate = self.inference_cfg_rate if cfg_rate is None else cfg_rate
+        if cfg_schedule is None:
+            return [cfg_rate] * n_timesteps
+        if isinstance(cfg_schedule, int):
+            return [cfg_rate if i < cfg_schedule else 0.0 for i in range(n_timesteps)]
+        assert len(cfg_schedule) == n_timesteps, 'cfg_schedule length {} does not match n_timesteps {}'.format(len(cfg_schedule), n_timesteps)
+        return [float(i) for i in cfg_schedule]
+
+    def solve(self, x, t_span, mu, mask, spks, cond, streaming=False, solver='euler', cfg_rate=None, cfg_schedule=None, estimator_cache=None):
+        """
+        Fixed step solver for ODEs, see cosyvoice.flow.ode_solvers.
+        Args:
+            x (torch.Tensor): random noise
+            t_span (torch.Tensor): n_timesteps interpolated
+                shape: (n_timesteps + 1,)
+            mu (torch.Tensor): output of encoder
+                shape: (batch_size, n_feats, mel_timesteps)
+            mask (torch.Tensor): output_mask
+                shape: (batch_size, 1, mel_timesteps)
+            spks (torch.Tensor, optional): speaker ids. Defaults to None.
+                shape: (batch_size, spk_emb_dim)
+            cond: Not used but kept for future purposes
+            solver (str, optional): ode solver name in ODE_SOLVERS. Defaults to 'euler'.
+            cfg_rate (float, optional): classifier free guidance rate. Defaults to inference_cfg_rate.
+            cfg_schedule (int or list, optional): steps to apply guidance on, see get_cfg_schedule. Defaults to all steps.
+            estimator_cache (list, optional): estimator cache of every estimator call, x only holds the new frames
+                and the estimator runs forward_chunk, updated in place. Defaults to None.
+        """
+        assert solver in ODE_SOLVERS, 'unsupported ode solver {}, choose from {}'.format(solver, list(ODE_SOLVERS.keys()))
+        cfg_rates = self.get_cfg_schedule(len(t_span) - 1, cfg_rate, cfg_schedule)
+        if estimator_cache is not None:
+            assert isinstance(self.estimator, torch.nn.Module) and not hasattr(self, 'batcher'), 'estimator cache only supports pytorch estimator without batcher'
+            # NOTE estimator calls run in the same order in every chunk, the i-th call reuses the cache of the i-th call of previous chunk
+            prev_estimator_cache = list(estimator_cache)
+            estimator_cache.clear()
 
         # Do not use concat, it may cause memory format changed and trt infer with wrong results!
         # NOTE when flow run in amp mode, x.dtype is float32, which cause nan in trt fp16 inference, so set dtype=spks.dtype
@@ -98,33 +144,60 @@ class ConditionalCFM(BASECFM):
         t_in = torch.zeros([2], device=x.device, dtype=spks.dtype)
         spks_in = torch.zeros([2, 80], device=x.device, dtype=spks.dtype)
         cond_in = torch.zeros([2, 80, x.size(2)], device=x.device, dtype=spks.dtype)
-        for step in range(1, len(t_span)):
-            # Classifier-Free Guidance inference introduced in VoiceBox
+        # Classifier-Free Guidance inference introduced in VoiceBox, the unconditional half keeps zero mu, spks and cond
+        # NOTE only x and t change between steps, the conditioning is filled once
+        mask_in[:] = mask
+        mu_in[0] = mu
+        spks_in[0] = spks
+        cond_in[0] = cond
+        # batch size -> step invariant conditioning prepared by the estimator, batch 1 and 2 both occur with cfg_schedule
+        prepared = {}
+        use_prepared = self.prepare_estimator is True and estimator_cache is None and not hasattr(self, 'batcher') and \
+            isinstance(self.estimator, torch.nn.Module) and hasattr(self.estimator, 'prepare')
+
+        def velocity(x, t, step):
+            cfg_rate = cfg_rates[step]
+            # NOTE unguided step only needs the conditional half, trt engine is built with batch 2 so keep it guided with rate 0
+            batch_size = 1 if cfg_rate == 0 and not isinstance(self.estimator, TrtContextWrapper) else 2
             x_in[:] = x
-            mask_in[:] = mask
-            mu_in[0] = mu
-            t_in[:] = t.unsqueeze(0)
-            spks_in[0] = spks
-            cond_in[0] = cond
-            dphi_dt = self.forward_estimator(
-                x_in, mask_in,
-                mu_in, t_in,
-                spks_in,
-                cond_in,
-                streaming
-            )
+            t_in[:] = t
+            if use_prepared:
+                if batch_size not in prepared:
+                    prepared[batch_size] = self.estimator.prepare(mask_in[:batch_size], mu_in[:batch_size], spks_in[:batch_size],
+                                                                  cond_in[:batch_size], streaming, t_span.to(t_in.dtype))
+                dphi_dt = self.estimator(x_in[:batch_size], None, None, t_in[:batch_size], prepared=prepared[batch_size])
+            elif estimator_cache is not None:
+                i = len(estimator_cache)
+                dphi_dt, cache = self.estimator.forward_chunk(
+                    x_in[:batch_size], mask_in[:batch_size],
+                    mu_in[:batch_size], t_in[:batch_size],
+                    spks_in[:batch_size],
+                    cond_in[:batch_size],
+                    prev_estimator_cache[i] if i < len(prev_estimator_cache) else None
+                )
+                estimator_cache.append(cache)
+            else:
+                dphi_dt = self.forward_estimator(
+                    x_in[:batch_size], mask_in[:batch_size],
+                    mu_in[:batch_size], t_in[:batch_size],
+                    spks_in[:batch_size],
+                    cond_in[:batch_size],
+                    streaming
+                )
+            if batch_size == 1:
+                return dphi_dt
             dphi_dt, cfg_dphi_dt = torch.split(dphi_dt, [x.size(0), x.size(0)], dim=0)
-            dphi_dt = ((1.0 + self.inference_cfg_rate) * dphi_dt - self.inference_cfg_rate * cfg_dphi_dt)
-            x = x + dt * dphi_dt
-            t = t + dt
-            sol.append(x)
-            if step < len(t_span) - 1:
-                dt = t_span[step + 1] - t
+            return (1.0 + cfg_rate) * dphi_dt - cfg_rate * cfg_dphi_dt
 
-        return sol[-1].float()
+        with self.batcher.session() if hasattr(self, 'batcher') else nullcontext():
+            x = ODE_SOLVERS[solver](velocity, x, t_span)
+        return x.float()
 
     def forward_estimator(self, x, mask, mu, t, spks, cond, streaming=False):
-        if isinstance(self.estimator, torch.nn.Module):
+        if hasattr(self, 'batcher'):
+            # NOTE batch with the estimator calls of other concurrent requests
+            return self.batcher(x, mask, mu, t, spks, cond, streaming=streaming)
+        elif isinstance(self.estimator, (torch.nn.Module, OrtEstimatorWrapper, JitEstimatorWrapper)):
             return self.estimator(x, mask, mu, t, spks, cond, streaming=streaming)
         else:
             [estimator, stream], trt_engine = self.estimator.acquire_estimator()
@@ -201,7 +274,8 @@ class CausalConditionalCFM(ConditionalCFM):
         self.rand_noise = torch.randn([1, 80, 50 * 300])
 
     @torch.inference_mode()
-    def forward(self, mu, mask, n_timesteps, temperature=1.0, spks=None, cond=None, streaming=False):
+    def forward(self, mu, mask, n_timesteps, temperature=1.0, spks=None, cond=None, streaming=False, solver='euler', cfg_rate=None,
+                cfg_schedule=None):
         """Forward diffusion
 
         Args:
@@ -214,6 +288,9 @@ class CausalConditionalCFM(ConditionalCFM):
             spks (torch.Tensor, optional): speaker ids. Defaults to None.
                 shape: (batch_size, spk_emb_dim)
             cond: Not used but kept for future purposes
+            solver (str, optional): ode solver name in ODE_SOLVERS. Defaults to 'euler'.
+            cfg_rate (float, optional): classifier free guidance rate. Defaults to inference_cfg_rate.
+            cfg_schedule (int or list, optional): steps to apply guidance on, see get_cfg_schedule. Defaults to all steps.
 
         Returns:
             sample: generated mel-spectrogram
@@ -225,4 +302,29 @@ class CausalConditionalCFM(ConditionalCFM):
         t_span = torch.linspace(0, 1, n_timesteps + 1, device=mu.device, dtype=mu.dtype)
         if self.t_scheduler == 'cosine':
             t_span = 1 - torch.cos(t_span * 0.5 * torch.pi)
-        return self.solve_euler(z, t_span=t_span, mu=mu, mask=mask, spks=spks, cond=cond, streaming=streaming), None
+        return self.solve(z, t_span=t_span, mu=mu, mask=mask, spks=spks, cond=cond, streaming=streaming, solver=solver, cfg_rate=cfg_rate,
+                          cfg_schedule=cfg_schedule), None
+
+    @torch.inference_mode()
+    def forward_chunk(self, mu, mask, n_timesteps, temperature=1.0, spks=None, cond=None, offset=0, estimator_cache=None, solver='euler',
+                      cfg_rate=None, cfg_schedule=None):
+        """Streaming forward diffusion of the new frames only
+
+        Args:
+            mu, mask, cond: same as forward, of the new frames only
+            offset (int): number of frames decoded in previous chunks
+            estimator_cache (list): estimator cache of every estimator call returned by the previous chunk,
+                empty list for the first chunk, see CausalConditionalDecoder.forward_chunk
+
+        Returns:
+            sample: generated mel-spectrogram of the new frames
+                shape: (batch_size, n_feats, mel_timesteps)
+            estimator_cache: updated estimator cache
+        """
+
+        z = self.rand_noise[:, :, offset:offset + mu.size(2)].to(mu.device).to(mu.dtype) * temperature
+        t_span = torch.linspace(0, 1, n_timesteps + 1, device=mu.device, dtype=mu.dtype)
+        if self.t_scheduler == 'cosine':
+            t_span = 1 - torch.cos(t_span * 0.5 * torch.pi)
+        return self.solve(z, t_span=t_span, mu=mu, mask=mask, spks=spks, cond=cond, streaming=True, solver=solver, cfg_rate=cfg_rate,
+                          cfg_schedule=cfg_schedule, estimator_cache=estimator_cache), estimator_cache
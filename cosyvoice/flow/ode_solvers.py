@@ -0,0 +1,67 @@
+"""Fixed step ode solvers for flow matching inference.
+
+Every solver integrates dx/dt = fn(x, t, step) over t_span and returns x at t_span[-1],
+step is the index of the interval [t_span[step], t_span[step + 1]] being solved.
+"""
+
+
+def euler(fn, x, t_span):
+    """First order, one estimator call per step."""
+    for step in range(len(t_span) - 1):
+        t, dt = t_span[step], t_span[step + 1] - t_span[step]
+        x = x + dt * fn(x, t, step)
+    return x
+
+
+def midpoint(fn, x, t_span):
+    """Second order, two estimator calls per step."""
+    for step in range(len(t_span) - 1):
+        t, dt = t_span[step], t_span[step + 1] - t_span[step]
+        x_mid = x + 0.5 * dt * fn(x, t, step)
+        x = x + dt * fn(x_mid, t + 0.5 * dt, step)
+    return x
+
+
+def heun(fn, x, t_span):
+    """Second order, two estimator calls per step."""
+    for step in range(len(t_span) - 1):
+        t, dt = t_span[step], t_span[step + 1] - t_span[step]
+        dphi_dt = fn(x, t, step)
+        x_pred = x + dt * dphi_dt
+        x = x + 0.5 * dt * (dphi_dt + fn(x_pred, t + dt, step))
+    return x
+
+
+def adams_bashforth2(fn, x, t_span):
+    """Second order multistep, one estimator call per step.
+
+    Reuses the velocity of the previous step, supports non uniform t_span (e.g. cosine scheduler).
+    The first step has no history and falls back to euler.
+    """
+    prev_dphi_dt, prev_dt = None, None
+    for step in range(len(t_span) - 1):
+        t, dt = t_span[step], t_span[step + 1] - t_span[step]
+        dphi_dt = fn(x, t, step)
+        if prev_dphi_dt is None:
+            x = x + dt * dphi_dt
+        else:
+            ratio = dt / (2 * prev_dt)
+            x = x + dt * ((1 + ratio) * dphi_dt - ratio * prev_dphi_dt)
+        prev_dphi_dt, prev_dt = dphi_dt, dt
+    return x
+
+
+ODE_SOLVERS = {
+    'euler': euler,
+    'midpoint': midpoint,
+    'heun': heun,
+    'ab2': adams_bashforth2,
+}
+
+# estimator calls per step of each solver
+ODE_SOLVER_NFE = {
+    'euler': 1,
+    'midpoint': 2,
+    'heun': 2,
+    'ab2': 1,
+}
@@ -11,13 +11,14 @@
 # WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 # See the License for the specific language governing permissions and
 # limitations under the License.
+from typing import List, Optional, Tuple
 import torch
 import torch.nn as nn
 try:
     from torch.nn.utils.parametrizations import weight_norm
 except ImportError:
     from torch.nn.utils import weight_norm
-from cosyvoice.transformer.convolution import CausalConv1d
+from cosyvoice.transformer.convolution import CausalConv1d, get_causal_cache
 
 
 class ConvRNNF0Predictor(nn.Module):
@@ -101,3 +102,27 @@ class CausalConvRNNF0Predictor(nn.Module):
             x = self.condnet[i](x)
         x = x.transpose(1, 2)
         return torch.abs(self.classifier(x).squeeze(-1))
+
+    def forward_chunk(self, x: torch.Tensor, context: torch.Tensor = torch.zeros(0, 0, 0),
+                      cache: Optional[List[torch.Tensor]] = None) -> Tuple[torch.Tensor, List[torch.Tensor]]:
+        """f0 of the new frames x with carried state.
+
+        Args:
+            x (torch.Tensor): new mel frames, (batch, in_channels, time)
+            context (torch.Tensor): lookahead frames of condnet[0], zeros are padded when it is empty
+            cache (list, optional): left context of the other causal convs, None for the first chunk
+
+        Returns:
+            f0 of the new frames, (batch, time), and the cache of the next chunk
+        """
+        x = self.condnet[0](x, context)
+        new_cache = []
+        for i in range(1, len(self.condnet)):
+            if hasattr(self.condnet[i], 'causal_padding'):
+                conv_cache = torch.zeros(0, 0, 0) if cache is None else cache[len(new_cache)]
+                new_cache.append(get_causal_cache(x, conv_cache, self.condnet[i].causal_padding))
+                x = self.condnet[i](x, conv_cache)
+            else:
+                x = self.condnet[i](x)
+        x = x.transpose(1, 2)
+        return torch.abs(self.classifier(x).squeeze(-1)), new_cache
@@ -14,7 +14,7 @@
 
 """HIFI-GAN"""
 
-from typing import Dict, Optional, List
+from typing import Dict, Optional, List, Tuple
 import numpy as np
 from scipy.signal import get_window
 import torch
@@ -28,7 +28,7 @@ try:
 except ImportError:
     from torch.nn.utils import weight_norm
 from torch.distributions.uniform import Uniform
-from cosyvoice.transformer.convolution import CausalConv1d, CausalConv1dDownSample, CausalConv1dUpsample
+from cosyvoice.transformer.convolution import CausalConv1d, CausalConv1dDownSample, CausalConv1dUpsample, get_causal_cache
 from cosyvoice.transformer.activation import Snake
 from cosyvoice.utils.common import get_padding
 from cosyvoice.utils.common import init_weights
@@ -116,6 +116,23 @@ class ResBlock(torch.nn.Module):
             x = xt + x
         return x
 
+    def forward_chunk(self, x: torch.Tensor, cache: Optional[List[torch.Tensor]] = None) -> Tuple[torch.Tensor, List[torch.Tensor]]:
+        # NOTE causal only, cache keeps the left context of convs1[0], convs2[0], convs1[1], ..., None for the first chunk
+        assert self.causal is True
+        empty = torch.zeros(0, 0, 0)
+        new_cache = []
+        for idx in range(len(self.convs1)):
+            xt = self.activations1[idx](x)
+            conv_cache = empty if cache is None else cache[2 * idx]
+            new_cache.append(get_causal_cache(xt, conv_cache, self.convs1[idx].causal_padding))
+            xt = self.convs1[idx](xt, conv_cache)
+            xt = self.activations2[idx](xt)
+            conv_cache = empty if cache is None else cache[2 * idx + 1]
+            new_cache.append(get_causal_cache(xt, conv_cache, self.convs2[idx].causal_padding))
+            xt = self.convs2[idx](xt, conv_cache)
+            x = xt + x
+        return x, new_cache
+
     def remove_weight_norm(self):
         for idx in range(len(self.convs1)):
             remove_weight_norm(self.convs1[idx])
@@ -189,6 +206,42 @@ class SineGen(torch.nn.Module):
         return sine_waves.transpose(1, 2), uv.transpose(1, 2), noise
 
 
+def _mul32(x: torch.Tensor, c: int) -> torch.Tensor:
+    # x * c mod 2 ** 32 of int64 x in [0, 2 ** 32), split c in 16 bits halves so no product overflows int64
+    return (x * (c & 0xffff) + (((x * (c >> 16)) & 0xffff) << 16)) & 0xffffffff
+
+
+def _hash32(x: torch.Tensor) -> torch.Tensor:
+    # lowbias32 integer hash of Chris Wellons, bijective on [0, 2 ** 32)
+    x = x ^ (x >> 16)
+    x = _mul32(x, 0x7feb352d)
+    x = x ^ (x >> 15)
+    x = _mul32(x, 0x846ca68b)
+    x = x ^ (x >> 16)
+    return x
+
+
+class CounterNoise:
+    """Deterministic uniform noise in [0, 1) indexed by absolute sample position.
+
+    Replaces the pre-generated noise tables of causal inference, which took 300 * 24000 * 9 float32
+    (about 259MB) per vocoder. Sample i of channel c is a hash of the counter i * channels + c and the
+    stream key, so any span is generated on demand with constant memory, and chunked inference starting
+    at offset gets exactly the noise of full inference.
+    """
+
+    def __init__(self, channels: int, key: int):
+        self.channels = channels
+        self.key = (key * 0x9e3779b9) & 0xffffffff
+
+    def __call__(self, offset: int, length: int, device: torch.device = torch.device('cpu')) -> torch.Tensor:
+        """noise of samples offset ... offset + length - 1, shape (1, length, channels)"""
+        counter = torch.arange(offset * self.channels, (offset + length) * self.channels, dtype=torch.int64, device=device)
+        x = _hash32(_hash32(counter & 0xffffffff) ^ self.key)
+        # top 24 bits are exact in float32
+        return ((x >> 8).to(torch.float32) * 2 ** -24).reshape(1, length, self.channels)
+
+
 class SineGen2(torch.nn.Module):
     """ Definition of sine generator
     SineGen(samp_rate, harmonic_num = 0,
@@ -223,7 +276,7 @@ class SineGen2(torch.nn.Module):
         if causal is True:
             self.rand_ini = torch.rand(1, 9)
             self.rand_ini[:, 0] = 0
-            self.sine_waves = torch.rand(1, 300 * 24000, 9)
+            self.noise = CounterNoise(self.dim, key=1)
 
     def _f02uv(self, f0):
         # generate uv signal
@@ -286,6 +339,27 @@ class SineGen2(torch.nn.Module):
             sines = torch.cos(i_phase * 2 * np.pi)
         return sines
 
+    def _f02sine_chunk(self, f0_values, offset, cache=None):
+        """ causal inference of _f02sine on the samples starting at offset
+            cache: accumulated rad_values of previous frames (batchsize, 1, dim), None for the first chunk
+            return the sines and the cache of the next chunk
+        """
+        assert self.training is False and self.causal is True and not self.flag_for_pulse
+        rad_values = (f0_values / self.sampling_rate) % 1
+        if offset == 0:
+            rad_values[:, 0, :] = rad_values[:, 0, :] + self.rand_ini.to(rad_values.device)
+        rad_values = torch.nn.functional.interpolate(rad_values.transpose(1, 2),
+                                                     scale_factor=1 / self.upsample_scale,
+                                                     mode="linear").transpose(1, 2)
+        # NOTE same as cumsum over all frames, the nearest upsampled phase only depends on previous frames
+        rad_cumsum = torch.cumsum(rad_values, dim=1)
+        if cache is not None:
+            rad_cumsum = rad_cumsum + cache
+        phase = rad_cumsum * 2 * np.pi
+        phase = torch.nn.functional.interpolate(phase.transpose(1, 2) * self.upsample_scale,
+                                                scale_factor=self.upsample_scale, mode="nearest").transpose(1, 2)
+        return torch.sin(phase), rad_cumsum[:, -1:]
+
     def forward(self, f0):
         """ sine_tensor, uv = forward(f0)
         input F0: tensor(batchsize=1, length, dim=1)
@@ -307,7 +381,7 @@ class SineGen2(torch.nn.Module):
         # .       for voiced regions is self.noise_std
         noise_amp = uv * self.noise_std + (1 - uv) * self.sine_amp / 3
         if self.training is False and self.causal is True:
-            noise = noise_amp * self.sine_waves[:, :sine_waves.shape[1]].to(sine_waves.device)
+            noise = noise_amp * self.noise(0, sine_waves.shape[1], sine_waves.device)
         else:
             noise = noise_amp * torch.randn_like(sine_waves)
 
@@ -316,6 +390,21 @@ class SineGen2(torch.nn.Module):
         sine_waves = sine_waves * uv + noise
         return sine_waves, uv, noise
 
+    def forward_chunk(self, f0, offset, cache=None):
+        """ sine_tensor, uv, noise, cache = forward_chunk(f0, offset, cache)
+        causal inference of forward on the samples starting at offset,
+        cache is the sine phase of previous samples, None for the first chunk
+        """
+        fn = torch.multiply(f0, torch.FloatTensor([[range(1, self.harmonic_num + 2)]]).to(f0.device))
+        sine_waves, cache = self._f02sine_chunk(fn, offset, cache)
+        sine_waves = sine_waves * self.sine_amp
+        uv = self._f02uv(f0)
+        # NOTE the deterministic noise is indexed by the absolute sample position
+        noise_amp = uv * self.noise_std + (1 - uv) * self.sine_amp / 3
+        noise = noise_amp * self.noise(offset, sine_waves.shape[1], sine_waves.device)
+        sine_waves = sine_waves * uv + noise
+        return sine_waves, uv, noise, cache
+
 
 class SourceModuleHnNSF(torch.nn.Module):
     """ SourceModule for hn-nsf
@@ -353,7 +442,7 @@ class SourceModuleHnNSF(torch.nn.Module):
         self.l_tanh = torch.nn.Tanh()
         self.causal = causal
         if causal is True:
-            self.uv = torch.rand(1, 300 * 24000, 1)
+            self.noise = CounterNoise(1, key=2)
 
     def forward(self, x):
         """
@@ -369,11 +458,23 @@ class SourceModuleHnNSF(torch.nn.Module):
 
         # source for noise branch, in the same shape as uv
         if self.training is False and self.causal is True:
-            noise = self.uv[:, :uv.shape[1]] * self.sine_amp / 3
+            noise = self.noise(0, uv.shape[1], uv.device) * self.sine_amp / 3
         else:
             noise = torch.randn_like(uv) * self.sine_amp / 3
         return sine_merge, noise, uv
 
+    def forward_chunk(self, x, offset, cache=None):
+        """
+        Sine_source, noise_source, uv, cache = SourceModuleHnNSF.forward_chunk(F0_sampled, offset, cache)
+        causal inference of forward on the samples starting at offset, cache is the sine phase of previous samples
+        """
+        assert self.training is False and self.causal is True and isinstance(self.l_sin_gen, SineGen2)
+        with torch.no_grad():
+            sine_wavs, uv, _, cache = self.l_sin_gen.forward_chunk(x, offset, cache)
+        sine_merge = self.l_tanh(self.l_linear(sine_wavs))
+        noise = self.noise(offset, uv.shape[1], uv.device) * self.sine_amp / 3
+        return sine_merge, noise, uv, cache
+
 
 class HiFTGenerator(nn.Module):
     """
@@ -488,15 +589,17 @@ class HiFTGenerator(nn.Module):
         for l in self.source_resblocks:
             l.remove_weight_norm()
 
-    def _stft(self, x):
+    def _stft(self, x, center=True):
+        # NOTE stft/istft run in fp32, autocast (e.g. cpu bf16) may cast the source and conv outputs to low precision
         spec = torch.stft(
-            x,
+            x.float(),
             self.istft_params["n_fft"], self.istft_params["hop_len"], self.istft_params["n_fft"], window=self.stft_window.to(x.device),
-            return_complex=True)
+            center=center, return_complex=True)
         spec = torch.view_as_real(spec)  # [B, F, TT, 2]
         return spec[..., 0], spec[..., 1]
 
     def _istft(self, magnitude, phase):
+        magnitude, phase = magnitude.float(), phase.float()
         magnitude = torch.clip(magnitude, max=1e2)
         real = magnitude * torch.cos(phase)
         img = magnitude * torch.sin(phase)
@@ -508,6 +611,20 @@ class HiFTGenerator(nn.Module):
         s_stft_real, s_stft_imag = self._stft(s.squeeze(1))
         s_stft = torch.cat([s_stft_real, s_stft_imag], dim=1)
 
+        magnitude, phase = self.forward_decode_spec(x, s_stft)
+        x = self._istft(magnitude, phase)
+        x = torch.clamp(x, -self.audio_limit, self.audio_limit)
+        return x
+
+    def forward_decode_spec(self, x: torch.Tensor, s_stft: torch.Tensor):
+        if hasattr(self, 'ort_decode_spec'):
+            return self.ort_decode_spec(x, s_stft)
+        if hasattr(self, 'jit_decode_spec'):
+            return self.jit_decode_spec(x, s_stft)
+        return self.decode_spec(x, s_stft)
+
+    def decode_spec(self, x: torch.Tensor, s_stft: torch.Tensor):
+        """mel and source stft -> istft magnitude and phase, the part of decode that could be exported to onnx"""
         x = self.conv_pre(x)
         for i in range(self.num_upsamples):
             x = F.leaky_relu(x, self.lrelu_slope)
@@ -533,10 +650,7 @@ class HiFTGenerator(nn.Module):
         x = self.conv_post(x)
         magnitude = torch.exp(x[:, :self.istft_params["n_fft"] // 2 + 1, :])
         phase = torch.sin(x[:, self.istft_params["n_fft"] // 2 + 1:, :])  # actually, sin is redundancy
-
-        x = self._istft(magnitude, phase)
-        x = torch.clamp(x, -self.audio_limit, self.audio_limit)
-        return x
+        return magnitude, phase
 
     def forward(
             self,
@@ -672,13 +786,23 @@ class CausalHiFTGenerator(HiFTGenerator):
     def decode(self, x: torch.Tensor, s: torch.Tensor = torch.zeros(1, 1, 0), finalize: bool = True) -> torch.Tensor:
         s_stft_real, s_stft_imag = self._stft(s.squeeze(1))
         if finalize is True:
-            x = self.conv_pre(x)
+            # NOTE no lookahead mel, conv_pre pads zeros on the right
+            x = F.pad(x, (0, self.conv_pre_look_right))
         else:
-            x = self.conv_pre(x[:, :, :-self.conv_pre_look_right], x[:, :, -self.conv_pre_look_right:])
             s_stft_real = s_stft_real[:, :, :-int(np.prod(self.upsample_rates) * self.conv_pre_look_right)]
             s_stft_imag = s_stft_imag[:, :, :-int(np.prod(self.upsample_rates) * self.conv_pre_look_right)]
         s_stft = torch.cat([s_stft_real, s_stft_imag], dim=1)
 
+        magnitude, phase = self.forward_decode_spec(x, s_stft)
+        x = self._istft(magnitude, phase)
+        if finalize is False:
+            x = x[:, :-int(np.prod(self.upsample_rates) * self.istft_params['hop_len'])]
+        x = torch.clamp(x, -self.audio_limit, self.audio_limit)
+        return x
+
+    def decode_spec(self, x: torch.Tensor, s_stft: torch.Tensor):
+        """mel with conv_pre_look_right lookahead frames and source stft -> istft magnitude and phase"""
+        x = self.conv_pre(x[:, :, :-self.conv_pre_look_right], x[:, :, -self.conv_pre_look_right:])
         for i in range(self.num_upsamples):
             x = F.leaky_relu(x, self.lrelu_slope)
             x = self.ups[i](x)
@@ -703,12 +827,7 @@ class CausalHiFTGenerator(HiFTGenerator):
         x = self.conv_post(x)
         magnitude = torch.exp(x[:, :self.istft_params["n_fft"] // 2 + 1, :])
         phase = torch.sin(x[:, self.istft_params["n_fft"] // 2 + 1:, :])  # actually, sin is redundancy
-
-        x = self._istft(magnitude, phase)
-        if finalize is False:
-            x = x[:, :-int(np.prod(self.upsample_rates) * self.istft_params['hop_len'])]
-        x = torch.clamp(x, -self.audio_limit, self.audio_limit)
-        return x
+        return magnitude, phase
 
     @torch.inference_mode()
     def inference(self, speech_feat: torch.Tensor, finalize: bool = True) -> torch.Tensor:
@@ -725,6 +844,136 @@ class CausalHiFTGenerator(HiFTGenerator):
             generated_speech = self.decode(x=speech_feat[:, :, :-self.f0_predictor.condnet[0].causal_padding], s=s, finalize=finalize)
         return generated_speech, s
 
+    def _istft_chunk(self, magnitude, phase, cache=None, finalize=True):
+        """overlap add of the new istft frames, cache keeps the last n_fft // hop_len - 1 frames,
+        only the samples covered by all their frames are returned unless finalize"""
+        n_fft, hop_len = self.istft_params["n_fft"], self.istft_params["hop_len"]
+        magnitude, phase = magnitude.float(), phase.float()
+        magnitude = torch.clip(magnitude, max=1e2)
+        spec = torch.complex(magnitude * torch.cos(phase), magnitude * torch.sin(phase))
+        # NOTE the first n_fft // 2 samples are the center padding of torch.istft
+        start = n_fft // 2 if cache is None else n_fft - hop_len
+        if cache is not None:
+            spec = torch.concat([cache, spec], dim=2)
+        num_frames = spec.size(2)
+        window = self.stft_window.to(magnitude.device)
+        frames = torch.fft.irfft(spec, n_fft, dim=1) * window[None, :, None]
+        output_size, kernel_size = (1, (num_frames - 1) * hop_len + n_fft), (1, n_fft)
+        x = F.fold(frames, output_size, kernel_size, stride=(1, hop_len))[:, 0, 0]
+        window_envelop = F.fold(window.pow(2)[None, :, None].repeat(1, 1, num_frames), output_size, kernel_size, stride=(1, hop_len))[:, 0, 0]
+        end = (num_frames - 1) * hop_len + n_fft // 2 if finalize is True else num_frames * hop_len
+        x = x[:, start:end] / window_envelop[:, start:end]
+        return x, spec[:, :, num_frames - (n_fft // hop_len - 1):]
+
+    @torch.inference_mode()
+    def inference_chunk(self, speech_feat: torch.Tensor, cache: Optional[dict] = None, finalize: bool = True) -> Tuple[torch.Tensor, dict]:
+        """Stream inference with carried state, only the new mel frames are vocoded.
+
+        Frames without enough lookahead mel are kept in the cache and vocoded by the next call,
+        the concatenated output of all calls equals to inference of the whole mel.
+
+        Args:
+            speech_feat (torch.Tensor): new mel frames, shape (batch_size, in_channels, time)
+            cache (dict, optional): returned by the previous call, None for the first call.
+                It keeps the pending mel, the f0 predictor and causal conv left context,
+                the sine phase, the pending source samples and the last istft frames.
+            finalize (bool): whether speech_feat ends the utterance, the lookahead is zero padded
+
+        Returns:
+            new speech samples, shape (batch_size, samples), and the updated cache
+        """
+        f0_look_right = self.f0_predictor.condnet[0].causal_padding
+        # NOTE the last stft frame of a chunk needs source samples of the next mel frame
+        assert f0_look_right < self.conv_pre_look_right
+        n_fft, hop_len = self.istft_params["n_fft"], self.istft_params["hop_len"]
+        upsample_scale = int(np.prod(self.upsample_rates) * hop_len)
+        stft_cache_len = max([i.stride[0] for i in self.source_downs])
+        if cache is None:
+            cache = {'offset': 0, 'f0_offset': 0, 'mel': speech_feat[:, :, :0], 'f0': None, 'phase': None,
+                     'source': None, 'stft': None, 'decode': None, 'spec': None}
+        offset, f0_offset = cache['offset'], cache['f0_offset']
+        mel = torch.concat([cache['mel'], speech_feat], dim=2)
+        mel_end = offset + mel.size(2)
+        decode_end = mel_end if finalize is True else mel_end - self.conv_pre_look_right
+        f0_end = mel_end if finalize is True else mel_end - f0_look_right
+        if decode_end <= offset:
+            return torch.zeros(speech_feat.size(0), 0, device=speech_feat.device), dict(cache, mel=mel)
+
+        # 1. mel->f0->source of mel frames [f0_offset, f0_end), f0_predictor runs on cpu as in inference
+        self.f0_predictor.to('cpu')
+        f0_mel = mel[:, :, f0_offset - offset:].cpu()
+        f0, f0_cache = self.f0_predictor.forward_chunk(f0_mel[:, :, :f0_end - f0_offset], f0_mel[:, :, f0_end - f0_offset:], cache['f0'])
+        s = self.f0_upsamp(f0.to(speech_feat)[:, None]).transpose(1, 2)  # bs,n,t
+        s, _, _, phase_cache = self.m_source.forward_chunk(s, f0_offset * upsample_scale, cache['phase'])
+        s = s.transpose(1, 2)
+
+        # 2. stft frames of the source matching mel frames [offset, decode_end), the first chunk has one more frame for center padding
+        num_frames = (decode_end - offset) * upsample_scale // hop_len + (1 if offset == 0 else 0)
+        if cache['source'] is None:
+            source = F.pad(s, (n_fft // 2, 0), mode='reflect')
+        else:
+            source = torch.concat([cache['source'], s], dim=2)
+        if finalize is True:
+            source = F.pad(source, (0, n_fft // 2), mode='reflect')
+        assert source.size(2) >= (num_frames - 1) * hop_len + n_fft
+        s_stft_real, s_stft_imag = self._stft(source[:, 0, :(num_frames - 1) * hop_len + n_fft], center=False)
+        s_stft = torch.cat([s_stft_real, s_stft_imag], dim=1)
+        # NOTE keep the previous frames needed by the strided source_downs, zeros for the first chunk
+        if cache['stft'] is None:
+            s_stft = F.pad(s_stft, (stft_cache_len - 1, 0))
+        else:
+            s_stft = torch.concat([cache['stft'], s_stft], dim=2)
+
+        # 3. decode mel frames [offset, decode_end) with causal conv cache
+        x = F.pad(mel, (0, self.conv_pre_look_right)) if finalize is True else mel
+        x = self.conv_pre(x[:, :, :-self.conv_pre_look_right], x[:, :, -self.conv_pre_look_right:])
+        empty = torch.zeros(0, 0, 0)
+        decode_cache = cache['decode']
+        new_decode_cache = {'ups': [], 'source_resblocks': [], 'resblocks': []}
+        for i in range(self.num_upsamples):
+            x = F.leaky_relu(x, self.lrelu_slope)
+            conv_cache = empty if decode_cache is None else decode_cache['ups'][i]
+            new_decode_cache['ups'].append(get_causal_cache(self.ups[i].upsample(x), conv_cache, self.ups[i].causal_padding))
+            x = self.ups[i](x, conv_cache)
+
+            if i == self.num_upsamples - 1 and offset == 0:
+                x = self.reflection_pad(x)
+
+            # fusion, every downsampled source frame i covers stft frames [u * i - u + 1, u * i + u]
+            u = self.source_downs[i].stride[0]
+            if u == 1:
+                si = self.source_downs[i](s_stft[:, :, s_stft.size(2) - x.size(2):])
+            else:
+                si = self.source_downs[i](s_stft[:, :, s_stft.size(2) - x.size(2) * u - 1:],
+                                          s_stft[:, :, s_stft.size(2) - x.size(2) * u - u:s_stft.size(2) - x.size(2) * u - 1])
+            si, resblock_cache = self.source_resblocks[i].forward_chunk(si, None if decode_cache is None else decode_cache['source_resblocks'][i])
+            new_decode_cache['source_resblocks'].append(resblock_cache)
+            x = x + si
+
+            xs = None
+            for j in range(self.num_kernels):
+                resblock_cache = None if decode_cache is None else decode_cache['resblocks'][i * self.num_kernels + j]
+                xj, resblock_cache = self.resblocks[i * self.num_kernels + j].forward_chunk(x, resblock_cache)
+                new_decode_cache['resblocks'].append(resblock_cache)
+                if xs is None:
+                    xs = xj
+                else:
+                    xs += xj
+            x = xs / self.num_kernels
+
+        x = F.leaky_relu(x)
+        conv_cache = empty if decode_cache is None else decode_cache['conv_post']
+        new_decode_cache['conv_post'] = get_causal_cache(x, conv_cache, self.conv_post.causal_padding)
+        x = self.conv_post(x, conv_cache)
+        magnitude = torch.exp(x[:, :self.istft_params["n_fft"] // 2 + 1, :])
+        phase = torch.sin(x[:, self.istft_params["n_fft"] // 2 + 1:, :])  # actually, sin is redundancy
+        generated_speech, spec_cache = self._istft_chunk(magnitude, phase, cache['spec'], finalize)
+        generated_speech = torch.clamp(generated_speech, -self.audio_limit, self.audio_limit)
+        cache = {'offset': decode_end, 'f0_offset': f0_end, 'mel': mel[:, :, decode_end - offset:], 'f0': f0_cache, 'phase': phase_cache,
+                 'source': source[:, :, num_frames * hop_len:], 'stft': s_stft[:, :, s_stft.size(2) - stft_cache_len:],
+                 'decode': new_decode_cache, 'spec': spec_cache}
+        return generated_speech, cache
+
 
 if __name__ == '__main__':
     torch.backends.cudnn.deterministic = True
@@ -0,0 +1,148 @@
+import queue
+import threading
+import time
+from collections import defaultdict
+import torch
+import torch.nn.functional as F
+from cosyvoice.utils.file_utils import logging
+
+
+class LLMBatcher:
+    """Continuous batching of speech token decoding across concurrent requests.
+
+    Every request is prefilled on its own and then joins a shared decode batch. Each decode step
+    gathers the last sampled token of all active requests into one forward over a left padded kv cache,
+    samples every request with its own history and stop condition, and streams tokens back through
+    a per request queue. Works with TransformerLM (forward_chunk) and Qwen2LM/CosyVoice3LM (forward_one_step).
+    """
+
+    def __init__(self, llm, max_batch_size=8):
+        self.llm = llm
+        self.max_batch_size = max_batch_size
+        self.stop_token_ids = getattr(llm, 'stop_token_ids', [llm.eos_token])
+        self.request_queue = queue.Queue()
+        self.active = []
+        # per layer tensors of shape (batch, head, time, *), left padded to the longest request
+        self.cache = []
+        # batch size -> [decode steps, decode seconds]
+        self.step_stats = defaultdict(lambda: [0, 0.0])
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def inference(self, lm_input, sampling, min_len, max_len, uuid):
+        request = {'uuid': uuid, 'lm_input': lm_input, 'sampling': sampling, 'min_len': min_len, 'max_len': max_len,
+                   'out_tokens': [], 'length': 0, 'queue': queue.Queue()}
+        self.request_queue.put(request)
+        while True:
+            top_ids = request['queue'].get()
+            if top_ids is None:
+                break
+            if isinstance(top_ids, Exception):
+                raise top_ids
+            # in stream mode, yield token one by one
+            yield top_ids
+
+    def run(self):
+        with torch.inference_mode():
+            while True:
+                try:
+                    if len(self.active) == 0:
+                        self.add_request(self.request_queue.get())
+                    while len(self.active) < self.max_batch_size and self.request_queue.empty() is False:
+                        self.add_request(self.request_queue.get())
+                    if len(self.active) != 0:
+                        self.step()
+                except Exception as e:
+                    logging.error('llm batcher failed, {}'.format(e))
+                    for request in self.active:
+                        request['queue'].put(e)
+                    self.active, self.cache = [], []
+
+    def add_request(self, request):
+        if request['max_len'] <= 0:
+            request['queue'].put(None)
+            return
+        try:
+            logp, cache = self.prefill(request['lm_input'])
+        except Exception as e:
+            request['queue'].put(e)
+            return
+        request['length'] = cache[0].size(2)
+        if self.sample(request, logp) is False:
+            return
+        if len(self.active) == 0:
+            self.cache = cache
+        else:
+            max_length = max(self.cache[0].size(2), cache[0].size(2))
+            self.cache = [torch.concat([F.pad(i, (0, 0, max_length - i.size(2), 0)), F.pad(j, (0, 0, max_length - j.size(2), 0))], dim=0)
+                          for i, j in zip(self.cache, cache)]
+        self.active.append(request)
+
+    def sample(self, request, logp):
+        out_tokens = request['out_tokens']
+        top_ids = self.llm.sampling_ids(logp, out_tokens, request['sampling'], ignore_eos=True if len(out_tokens) < request['min_len'] else False)
+        if top_ids in self.stop_token_ids:
+            request['queue'].put(None)
+            return False
+        request['queue'].put(top_ids)
+        out_tokens.append(top_ids)
+        if len(out_tokens) == request['max_len']:
+            request['queue'].put(None)
+            return False
+        request['next_input'] = self.llm.speech_embedding.weight[top_ids].reshape(1, 1, -1)
+        return True
+
+    def step(self):
+        start_time = time.time()
+        batch_size, cache_len = len(self.active), self.cache[0].size(2)
+        xs = torch.concat([request['next_input'] for request in self.active], dim=0)
+        lengths = torch.tensor([request['length'] for request in self.active], device=xs.device)
+        # NOTE left padding, valid positions of each request are the last length + 1 ones
+        masks = torch.arange(cache_len + 1, device=xs.device).unsqueeze(0) >= (cache_len - lengths).unsqueeze(1)
+        y_pred, self.cache = self.forward_step(xs, masks, lengths)
+        logp = self.llm.llm_decoder(y_pred[:, -1]).log_softmax(dim=-1)
+        keep = []
+        for i, request in enumerate(self.active):
+            request['length'] += 1
+            if self.sample(request, logp[i]) is True:
+                keep.append(i)
+        if len(keep) != batch_size:
+            self.active = [self.active[i] for i in keep]
+            if len(keep) == 0:
+                self.cache = []
+            else:
+                # drop finished requests and the left padding no longer needed by the remaining ones
+                start = self.cache[0].size(2) - max([request['length'] for request in self.active])
+                self.cache = [i[keep, :, start:] for i in self.cache]
+        stats = self.step_stats[batch_size]
+        stats[0] += 1
+        stats[1] += time.time() - start_time
+
+    def prefill(self, lm_input):
+        masks = torch.tril(torch.ones((1, lm_input.shape[1], lm_input.shape[1]), device=lm_input.device)).to(torch.bool)
+        if hasattr(self.llm.llm, 'forward_one_step'):
+            y_pred, cache = self.llm.llm.forward_one_step(lm_input, masks=masks, cache=None)
+            cache = cache.to_legacy_cache() if hasattr(cache, 'to_legacy_cache') else cache
+            cache = [j for i in cache for j in i]
+        else:
+            y_pred, att_cache, _ = self.llm.llm.forward_chunk(lm_input, offset=0, required_cache_size=-1,
+                                                              att_cache=torch.zeros((0, 0, 0, 0), device=lm_input.device),
+                                                              cnn_cache=torch.zeros((0, 0, 0, 0), device=lm_input.device),
+                                                              att_mask=masks)
+            cache = list(att_cache.split(1, dim=0))
+        logp = self.llm.llm_decoder(y_pred[:, -1]).log_softmax(dim=-1)
+        return logp.squeeze(dim=0), cache
+
+    def forward_step(self, xs, masks, lengths):
+        if hasattr(self.llm.llm, 'forward_one_step'):
+            # NOTE qwen2 uses rope, so every request keeps its own position id
+            return self.llm.llm.forward_one_step_batch(xs, masks, lengths.unsqueeze(1), self.cache)
+        else:
+            return self.llm.llm.forward_one_step_batch(xs, masks.unsqueeze(1), self.cache)
+
+    def get_stats(self):
+        """Aggregate decode throughput per batch size, tokens/s counts one token for every request in the batch."""
+        stats = {}
+        for batch_size, (steps, seconds) in sorted(self.step_stats.items()):
+            stats[batch_size] = {'steps': steps, 'seconds': seconds, 'tokens_per_second': batch_size * steps / max(seconds, 1e-6)}
+        return stats
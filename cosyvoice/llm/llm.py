@@ -24,7 +24,7 @@ import torch.nn.functional as F
 from torch.nn.utils.rnn import pad_sequence
 from cosyvoice.utils.common import IGNORE_ID
 from cosyvoice.transformer.label_smoothing_loss import LabelSmoothingLoss
-from cosyvoice.utils.common import th_accuracy
+from cosyvoice.utils.common import th_accuracy, is_empty_init
 from cosyvoice.utils.file_utils import logging
 from cosyvoice.utils.mask import make_pad_mask
 
@@ -214,30 +214,46 @@ class TransformerLM(torch.nn.Module):
         max_len = int((text_len - prompt_text_len) * max_token_text_ratio)
 
         # 5. step by step decode
-        out_tokens = []
-        offset = 0
-        att_cache, cnn_cache = torch.zeros((0, 0, 0, 0), device=lm_input.device), torch.zeros((0, 0, 0, 0), device=lm_input.device)
-        for i in range(max_len):
-            y_pred, att_cache, cnn_cache = self.llm.forward_chunk(lm_input, offset=offset, required_cache_size=-1,
-                                                                  att_cache=att_cache, cnn_cache=cnn_cache,
-                                                                  att_mask=torch.tril(torch.ones((1, lm_input.shape[1], lm_input.shape[1]),
-                                                                                                 device=lm_input.device)).to(torch.bool))
-            logp = self.llm_decoder(y_pred[:, -1]).log_softmax(dim=-1)
-            top_ids = self.sampling_ids(logp.squeeze(dim=0), out_tokens, sampling, ignore_eos=True if i < min_len else False)
-            if top_ids == self.eos_token:
-                break
-            # in stream mode, yield token one by one
-            yield top_ids
-            out_tokens.append(top_ids)
-            offset += lm_input.size(1)
-            lm_input = self.speech_embedding.weight[top_ids].reshape(1, 1, -1)
+        for token in self.inference_wrapper(lm_input, sampling, min_len, max_len, uuid):
+            yield token
+
+    @torch.inference_mode()
+    def inference_wrapper(self, lm_input, sampling, min_len, max_len, uuid):
+        if hasattr(self, 'batcher'):
+            for top_ids in self.batcher.inference(lm_input, sampling, min_len, max_len, uuid):
+                yield top_ids
+        elif hasattr(self, 'ort_decoder'):
+            for top_ids in self.ort_decoder.inference(lm_input, sampling, min_len, max_len):
+                yield top_ids
+        else:
+            out_tokens = []
+            offset = 0
+            att_cache, cnn_cache = torch.zeros((0, 0, 0, 0), device=lm_input.device), torch.zeros((0, 0, 0, 0), device=lm_input.device)
+            for i in range(max_len):
+                y_pred, att_cache, cnn_cache = self.llm.forward_chunk(lm_input, offset=offset, required_cache_size=-1,
+                                                                      att_cache=att_cache, cnn_cache=cnn_cache,
+                                                                      att_mask=torch.tril(torch.ones((1, lm_input.shape[1], lm_input.shape[1]),
+                                                                                                     device=lm_input.device)).to(torch.bool))
+                logp = self.llm_decoder(y_pred[:, -1]).log_softmax(dim=-1)
+                top_ids = self.sampling_ids(logp.squeeze(dim=0), out_tokens, sampling, ignore_eos=True if i < min_len else False)
+                if top_ids == self.eos_token:
+                    break
+                # in stream mode, yield token one by one
+                yield top_ids
+                out_tokens.append(top_ids)
+                offset += lm_input.size(1)
+                lm_input = self.speech_embedding.weight[top_ids].reshape(1, 1, -1)
 
 
 class Qwen2Encoder(torch.nn.Module):
-    from transformers import Qwen2ForCausalLM
     def __init__(self, pretrain_path):
         super().__init__()
-        self.model = Qwen2ForCausalLM.from_pretrained(pretrain_path)
+        from transformers import AutoConfig, AutoModelForCausalLM, Qwen2ForCausalLM
+        if is_empty_init():
+            # NOTE pretrained weights are overwritten by llm.pt anyway, only build the model from config
+            self.model = AutoModelForCausalLM.from_config(AutoConfig.from_pretrained(pretrain_path))
+        else:
+            self.model = Qwen2ForCausalLM.from_pretrained(pretrain_path)
 
     def forward(self, xs: torch.Tensor, xs_lens: torch.Tensor):
         T = xs.size(1)
@@ -264,6 +280,23 @@ class Qwen2Encoder(torch.nn.Module):
         new_cache = outs.past_key_values
         return xs, new_cache
 
+    def forward_one_step_batch(self, xs, masks, position_ids, cache):
+        # NOTE cache is a flat list of left padded key/value tensors, (batch, head, time, dim) for each layer
+        from transformers import DynamicCache
+        cache = DynamicCache.from_legacy_cache(tuple((cache[i], cache[i + 1]) for i in range(0, len(cache), 2)))
+        outs = self.model(
+            inputs_embeds=xs,
+            attention_mask=masks,
+            position_ids=position_ids,
+            output_hidden_states=True,
+            return_dict=True,
+            use_cache=True,
+            past_key_values=cache,
+        )
+        xs = outs.hidden_states[-1]
+        new_cache = [j for i in outs.past_key_values.to_legacy_cache() for j in i]
+        return xs, new_cache
+
 
 class Qwen2LM(TransformerLM):
     def __init__(
@@ -512,12 +545,22 @@ class Qwen2LM(TransformerLM):
                 time.sleep(0.001)
             with self.lock:
                 self.vllm_output_queue.pop(uuid)
+        elif hasattr(self, 'batcher'):
+            for top_ids in self.batcher.inference(lm_input, sampling, min_len, max_len, uuid):
+                yield top_ids
+        elif hasattr(self, 'ort_decoder'):
+            for top_ids in self.ort_decoder.inference(lm_input, sampling, min_len, max_len):
+                yield top_ids
+        elif hasattr(self, 'static_decoder'):
+            for top_ids in self.static_decoder.inference(lm_input, sampling, min_len, max_len):
+                yield top_ids
         else:
             out_tokens = []
             cache = None
             for i in range(max_len):
+                # NOTE forward_one_step only uses the last row of the causal mask, which is all True
                 y_pred, cache = self.llm.forward_one_step(lm_input,
-                                                          masks=torch.tril(torch.ones((1, lm_input.shape[1], lm_input.shape[1]), device=lm_input.device)).to(torch.bool),
+                                                          masks=torch.ones((1, 1, lm_input.shape[1]), device=lm_input.device, dtype=torch.bool),
                                                           cache=cache)
                 logp = self.llm_decoder(y_pred[:, -1]).log_softmax(dim=-1)
                 top_ids = self.sampling_ids(logp.squeeze(dim=0), out_tokens, sampling, ignore_eos=True if i < min_len else False)
@@ -588,7 +631,7 @@ class Qwen2LM(TransformerLM):
                 while True:
                     seq_len = lm_input.shape[1] if cache is None else lm_input.shape[1] + cache[0][0].size(2)
                     y_pred, cache = self.llm.forward_one_step(lm_input,
-                                                              masks=torch.tril(torch.ones((1, seq_len, seq_len), device=lm_input.device)).to(torch.bool),
+                                                              masks=torch.ones((1, 1, seq_len), device=lm_input.device, dtype=torch.bool),
                                                               cache=cache)
                     logp = self.llm_decoder(y_pred[:, -1]).log_softmax(dim=-1)
                     if next_fill_index != -1 and len(out_tokens) == next_fill_index:
@@ -614,7 +657,7 @@ class Qwen2LM(TransformerLM):
         while True:
             seq_len = lm_input.shape[1] if cache is None else lm_input.shape[1] + cache[0][0].size(2)
             y_pred, cache = self.llm.forward_one_step(lm_input,
-                                                      masks=torch.tril(torch.ones((1, seq_len, seq_len), device=lm_input.device)).to(torch.bool),
+                                                      masks=torch.ones((1, 1, seq_len), device=lm_input.device, dtype=torch.bool),
                                                       cache=cache)
             logp = self.llm_decoder(y_pred[:, -1]).log_softmax(dim=-1)
             top_ids = self.sampling_ids(logp.squeeze(dim=0), out_tokens, sampling, ignore_eos=False)
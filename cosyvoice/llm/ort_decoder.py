@@ -0,0 +1,86 @@
+import numpy as np
+import torch
+from cosyvoice.utils.common import OrtSessionWrapper
+
+
+class LLMStep(torch.nn.Module):
+    """One forward of the speech token llm with explicit kv cache, used for onnx export.
+
+    forward(xs) is the prefill graph, forward(xs, cache) the decode graph, both return the
+    log probability of the next token and the updated cache. Cache layout is
+    (layers, head, time, d_k * 2) for TransformerLM, same as forward_chunk att_cache,
+    and (layers, 2, kv_head, time, head_dim) for Qwen2LM/CosyVoice3LM.
+    """
+
+    def __init__(self, llm):
+        super().__init__()
+        self.llm = llm
+        self.is_qwen2 = hasattr(llm.llm, 'forward_one_step')
+
+    def forward(self, xs, cache=None):
+        cache_len = 0 if cache is None else cache.size(3 if self.is_qwen2 else 2)
+        seq_len = xs.size(1)
+        # NOTE causal mask of the new positions over cache + new positions
+        masks = torch.arange(cache_len + seq_len, device=xs.device).unsqueeze(0) <= \
+            (torch.arange(seq_len, device=xs.device) + cache_len).unsqueeze(1)
+        if self.is_qwen2:
+            y_pred, new_cache = self.forward_qwen2(xs, masks, cache, cache_len)
+        else:
+            y_pred, new_cache = self.forward_transformer(xs, masks, cache)
+        logp = self.llm.llm_decoder(y_pred[:, -1]).log_softmax(dim=-1)
+        return logp, new_cache
+
+    def forward_transformer(self, xs, masks, cache):
+        if cache is None:
+            att_cache = [torch.zeros((0, 0, 0, 0), device=xs.device)] * len(self.llm.llm.encoders)
+        else:
+            att_cache = list(cache.unsqueeze(1).unbind(dim=0))
+        y_pred, new_cache = self.llm.llm.forward_one_step_batch(xs, masks.unsqueeze(0), att_cache)
+        return y_pred, torch.concat(new_cache, dim=0)
+
+    def forward_qwen2(self, xs, masks, cache, cache_len):
+        from transformers import DynamicCache
+        if cache is not None:
+            cache = DynamicCache.from_legacy_cache(tuple((i[0].unsqueeze(0), i[1].unsqueeze(0)) for i in cache.unbind(dim=0)))
+        # NOTE pass 4d additive mask and position ids explicitly, so nothing depends on traced python values
+        attention_mask = (~masks).to(xs.dtype).unsqueeze(0).unsqueeze(0) * torch.finfo(xs.dtype).min
+        position_ids = (torch.arange(xs.size(1), device=xs.device) + cache_len).unsqueeze(0)
+        outs = self.llm.llm.model.model(
+            inputs_embeds=xs,
+            attention_mask=attention_mask,
+            position_ids=position_ids,
+            past_key_values=cache,
+            use_cache=True,
+            return_dict=True,
+        )
+        new_cache = torch.stack([torch.concat([k, v], dim=0) for k, v in outs.past_key_values.to_legacy_cache()], dim=0)
+        return outs.last_hidden_state, new_cache
+
+
+class OrtLLMDecoder:
+    """Speech token decoding with onnxruntime prefill/decode graphs exported from LLMStep.
+
+    The kv cache stays in numpy between steps, sampling still uses llm.sampling_ids.
+    """
+
+    def __init__(self, llm, prefill_model, decode_model, intra_op_num_threads=4, inter_op_num_threads=1):
+        self.llm = llm
+        self.stop_token_ids = getattr(llm, 'stop_token_ids', [llm.eos_token])
+        self.prefill_session = OrtSessionWrapper(prefill_model, intra_op_num_threads, inter_op_num_threads).session
+        self.decode_session = OrtSessionWrapper(decode_model, intra_op_num_threads, inter_op_num_threads).session
+        self.speech_embedding = llm.speech_embedding.weight.detach().float().cpu().numpy()
+
+    def inference(self, lm_input, sampling, min_len, max_len):
+        out_tokens = []
+        xs = lm_input.detach().float().cpu().numpy()
+        logp, cache = self.prefill_session.run(None, {'xs': xs})
+        for i in range(max_len):
+            if i != 0:
+                logp, cache = self.decode_session.run(None, {'xs': xs, 'cache': cache})
+            top_ids = self.llm.sampling_ids(torch.from_numpy(logp).squeeze(dim=0), out_tokens, sampling, ignore_eos=True if i < min_len else False)
+            if top_ids in self.stop_token_ids:
+                break
+            # in stream mode, yield token one by one
+            yield top_ids
+            out_tokens.append(top_ids)
+            xs = self.speech_embedding[top_ids].reshape(1, 1, -1).astype(np.float32)
@@ -0,0 +1,89 @@
+import threading
+import torch
+from cosyvoice.utils.file_utils import logging
+
+
+class StaticCacheDecoder:
+    """Speech token decoding of Qwen2LM/CosyVoice3LM on a preallocated fixed size kv cache.
+
+    Every request takes a transformers StaticCache of max_cache_len positions from a free list, so the kv
+    buffers are allocated once and reused across utterances instead of being concatenated every step.
+    No causal mask is materialized per step: each cache keeps a boolean row of max_cache_len in which written
+    positions are unmasked inplace, so a decode step always sees (1, 1, D) input, (1, 1, 1, max_cache_len) mask
+    and (1,) cache position, which is shape stable and could be captured by torch.compile.
+    The lm head of Qwen2ForCausalLM is skipped, only the last hidden state goes to llm_decoder.
+    """
+
+    def __init__(self, llm, max_cache_len=2048, compile=False):
+        self.llm = llm
+        self.model = llm.llm.model.model
+        assert self.model.config._attn_implementation == 'sdpa', 'static cache decoder needs sdpa attention for boolean masks'
+        self.max_cache_len = max_cache_len
+        self.stop_token_ids = getattr(llm, 'stop_token_ids', [llm.eos_token])
+        parameter = next(self.model.parameters())
+        self.device, self.dtype = parameter.device, parameter.dtype
+        self.positions = torch.arange(max_cache_len, device=self.device)
+        self.free_caches = []
+        self.lock = threading.Lock()
+        self.decode_forward = torch.compile(self.forward_model, dynamic=False) if compile is True else self.forward_model
+
+    def acquire(self):
+        from transformers import StaticCache
+        with self.lock:
+            if len(self.free_caches) != 0:
+                return self.free_caches.pop()
+        cache = StaticCache(config=self.model.config, max_batch_size=1, max_cache_len=self.max_cache_len, device=self.device, dtype=self.dtype)
+        mask = torch.zeros((1, 1, 1, self.max_cache_len), dtype=torch.bool, device=self.device)
+        return cache, mask
+
+    def release(self, cache, mask):
+        cache.reset()
+        mask.zero_()
+        with self.lock:
+            self.free_caches.append((cache, mask))
+
+    def forward_model(self, xs, attention_mask, cache_position, cache):
+        outs = self.model(
+            inputs_embeds=xs,
+            attention_mask=attention_mask,
+            position_ids=cache_position.unsqueeze(0),
+            cache_position=cache_position,
+            past_key_values=cache,
+            use_cache=True,
+            return_dict=True,
+        )
+        return outs.last_hidden_state
+
+    def forward(self, xs, cache, mask, offset):
+        """run xs (1, T, D) at positions offset ... offset + T - 1, return the hidden states (1, T, D)"""
+        seq_len = xs.size(1)
+        assert offset + seq_len <= self.max_cache_len, 'static cache of {} positions is full'.format(self.max_cache_len)
+        cache_position = self.positions[offset:offset + seq_len]
+        mask[:, :, :, offset:offset + seq_len] = True
+        if seq_len == 1:
+            return self.decode_forward(xs, mask, cache_position, cache)
+        # NOTE prefill is causal inside the new positions, positions after offset + T are never attended
+        attention_mask = (self.positions.unsqueeze(0) <= cache_position.unsqueeze(1)).reshape(1, 1, seq_len, self.max_cache_len)
+        return self.forward_model(xs, attention_mask, cache_position, cache)
+
+    def inference(self, lm_input, sampling, min_len, max_len):
+        if lm_input.size(1) + max_len > self.max_cache_len:
+            logging.warning('lm input {} plus max_len {} exceeds static cache length {}, truncate max_len'.format(lm_input.size(1), max_len, self.max_cache_len))
+            max_len = self.max_cache_len - lm_input.size(1)
+        cache, mask = self.acquire()
+        try:
+            out_tokens = []
+            offset = 0
+            for i in range(max_len):
+                y_pred = self.forward(lm_input, cache, mask, offset)
+                offset += lm_input.size(1)
+                logp = self.llm.llm_decoder(y_pred[:, -1]).log_softmax(dim=-1)
+                top_ids = self.llm.sampling_ids(logp.squeeze(dim=0), out_tokens, sampling, ignore_eos=True if i < min_len else False)
+                if top_ids in self.stop_token_ids:
+                    break
+                # in stream mode, yield token one by one
+                yield top_ids
+                out_tokens.append(top_ids)
+                lm_input = self.llm.speech_embedding.weight[top_ids].reshape(1, 1, -1)
+        finally:
+            self.release(cache, mask)
@@ -146,6 +146,23 @@ class ConvolutionModule(nn.Module):
         return x.transpose(1, 2), new_cache
 
 
+def get_causal_cache(x: torch.Tensor, cache: torch.Tensor, size: int) -> torch.Tensor:
+    """Cache of a left causal conv for the next chunk, i.e. the last `size` frames of cache + x.
+
+    Args:
+        x (torch.Tensor): input frames of the current chunk, (#batch, channels, time)
+        cache (torch.Tensor): cache passed to the conv for the current chunk, empty means zero padding
+        size (int): causal_padding of the conv
+
+    Returns:
+        torch.Tensor: cache for the next chunk, (#batch, channels, size)
+    """
+    if cache.size(2) == 0:
+        cache = torch.zeros(x.size(0), x.size(1), size).to(x)
+    x = torch.concat([cache, x], dim=2)
+    return x[:, :, x.size(2) - size:]
+
+
 # NOTE(Xiang Lyu) causal conv module used in convolution-based vocoder
 class CausalConv1d(torch.nn.Conv1d):
     def __init__(
@@ -15,12 +15,13 @@
 # limitations under the License.
 # Modified from ESPnet(https://github.com/espnet/espnet)
 """Encoder definition."""
-from typing import Tuple
+from typing import List, Tuple
 
 import torch
 import torch.utils.checkpoint as ckpt
 
 from cosyvoice.transformer.convolution import ConvolutionModule
+from cosyvoice.transformer.embedding import EspnetRelPositionalEncoding
 from cosyvoice.transformer.encoder_layer import TransformerEncoderLayer
 from cosyvoice.transformer.encoder_layer import ConformerEncoderLayer
 from cosyvoice.transformer.positionwise_feed_forward import PositionwiseFeedForward
@@ -271,6 +272,51 @@ class BaseEncoder(torch.nn.Module):
 
         return (xs, r_att_cache, r_cnn_cache)
 
+    @torch.jit.unused
+    def forward_one_step_batch(
+        self,
+        xs: torch.Tensor,
+        att_mask: torch.Tensor,
+        att_cache: List[torch.Tensor],
+    ) -> Tuple[torch.Tensor, List[torch.Tensor]]:
+        """ Forward one decoding step for a batch of sequences, which have
+            different history lengths and share a left padded cache
+
+        Args:
+            xs (torch.Tensor): input of current step, (b, 1, mel-dim)
+            att_mask (torch.Tensor): (b, 1, cache_t1 + 1), False for the
+                left padding of each sequence
+            att_cache (List[torch.Tensor]): cache of each layer, with shape
+                (b, head, cache_t1, d_k * 2)
+
+        Returns:
+            torch.Tensor: output of current step, (b, 1, hidden-dim)
+            List[torch.Tensor]: new cache of each layer, with shape
+                (b, head, cache_t1 + 1, d_k * 2)
+
+        """
+        # NOTE only relative position encoding is invariant to left padding
+        assert isinstance(self.embed.pos_enc, EspnetRelPositionalEncoding), \
+            'batch decoding only supports rel_pos_espnet'
+        tmp_masks = torch.ones(xs.size(0), 1, xs.size(1),
+                               device=xs.device,
+                               dtype=torch.bool)
+        if self.global_cmvn is not None:
+            xs = self.global_cmvn(xs)
+        xs, _, _ = self.embed(xs, tmp_masks, 0)
+        pos_emb = self.embed.position_encoding(offset=0,
+                                               size=att_mask.size(2))
+        r_att_cache = []
+        for i, layer in enumerate(self.encoders):
+            xs, _, new_att_cache, _ = layer(xs,
+                                            att_mask,
+                                            pos_emb,
+                                            att_cache=att_cache[i])
+            r_att_cache.append(new_att_cache)
+        if self.normalize_before:
+            xs = self.after_norm(xs)
+        return xs, r_att_cache
+
     @torch.jit.unused
     def forward_chunk_by_chunk(
         self,
@@ -15,7 +15,7 @@
 # limitations under the License.
 # Modified from ESPnet(https://github.com/espnet/espnet)
 """Encoder definition."""
-from typing import Tuple
+from typing import Any, Dict, Optional, Tuple
 
 import torch
 from torch import nn
@@ -32,6 +32,7 @@ from cosyvoice.utils.class_utils import (
 )
 from cosyvoice.utils.mask import make_pad_mask
 from cosyvoice.utils.mask import add_optional_chunk_mask
+from cosyvoice.utils.mask import subsequent_chunk_mask_with_cache
 
 
 class Upsample1D(nn.Module):
@@ -62,6 +63,20 @@ class Upsample1D(nn.Module):
         outputs = self.conv(outputs)
         return outputs, input_lengths * self.stride
 
+    def forward_chunk(self, inputs: torch.Tensor, cache: torch.Tensor = torch.zeros(0, 0, 0)) -> Tuple[torch.Tensor, torch.Tensor]:
+        """
+        inputs: (batch_size, channels, seq_len) of the new frames
+        cache: (batch_size, channels, stride * 2) upsampled inputs of previous chunks, empty for the first chunk
+        """
+        outputs = F.interpolate(inputs, scale_factor=float(self.stride), mode="nearest")
+        if cache.size(2) == 0:
+            outputs = F.pad(outputs, (self.stride * 2, 0), value=0.0)
+        else:
+            outputs = torch.concat([cache, outputs], dim=2)
+        new_cache = outputs[:, :, -self.stride * 2:]
+        outputs = self.conv(outputs)
+        return outputs, new_cache
+
 
 class PreLookaheadLayer(nn.Module):
     def __init__(self, in_channels: int, channels: int, pre_lookahead_len: int = 1):
@@ -102,6 +117,36 @@ class PreLookaheadLayer(nn.Module):
         outputs = outputs + inputs
         return outputs
 
+    def forward_chunk(self, inputs: torch.Tensor, context: torch.Tensor = torch.zeros(0, 0, 0),
+                      cache: torch.Tensor = torch.zeros(0, 0, 0)) -> Tuple[torch.Tensor, torch.Tensor]:
+        """
+        inputs: (batch_size, seq_len, channels) of the new tokens
+        context: (batch_size, pre_lookahead_len, channels), empty for the last chunk
+        cache: (batch_size, channels, conv2.kernel_size - 1) conv1 outputs of previous chunks, empty for the first chunk
+        """
+        assert self.training is False, 'forward_chunk is only used in inference mode'
+        outputs = inputs.transpose(1, 2).contiguous()
+        context = context.transpose(1, 2).contiguous()
+        # look ahead
+        if context.size(2) == 0:
+            outputs = F.pad(outputs, (0, self.pre_lookahead_len), mode='constant', value=0.0)
+        else:
+            assert context.size(2) == self.pre_lookahead_len
+            outputs = torch.concat([outputs, context], dim=2)
+        outputs = F.leaky_relu(self.conv1(outputs))
+        # outputs
+        if cache.size(2) == 0:
+            outputs = F.pad(outputs, (self.conv2.kernel_size[0] - 1, 0), mode='constant', value=0.0)
+        else:
+            outputs = torch.concat([cache, outputs], dim=2)
+        new_cache = outputs[:, :, -(self.conv2.kernel_size[0] - 1):]
+        outputs = self.conv2(outputs)
+        outputs = outputs.transpose(1, 2).contiguous()
+
+        # residual connection
+        outputs = outputs + inputs
+        return outputs, new_cache
+
 
 class UpsampleConformerEncoder(torch.nn.Module):
 
@@ -306,6 +351,72 @@ class UpsampleConformerEncoder(torch.nn.Module):
         # for cross attention with decoder later
         return xs, masks
 
+    def forward_chunk(
+        self,
+        xs: torch.Tensor,
+        context: torch.Tensor = torch.zeros(0, 0, 0),
+        cache: Optional[Dict[str, Any]] = None,
+    ) -> Tuple[torch.Tensor, Dict[str, Any]]:
+        """Encode the new tokens of streaming inference with cache, the outputs
+           equal to the matching frames of forward with streaming=True.
+
+        Args:
+            xs: input tensor (1, T, D) of the new tokens, tokens of previous
+                chunks must be a multiple of static_chunk_size
+            context: pre lookahead tokens (1, pre_lookahead_len, D) after xs,
+                empty for the last chunk
+            cache: attention/conv cache returned by the previous chunk,
+                None for the first chunk
+        Returns:
+            xs: output tensor (1, T * up_layer.stride, D')
+            cache: updated cache
+        """
+        assert self.training is False, 'forward_chunk is only used in inference mode'
+        assert xs.size(0) == 1, 'forward_chunk only supports batch size 1'
+        if cache is None:
+            cache = {'offset': 0,
+                     'pre_lookahead_cache': torch.zeros(0, 0, 0),
+                     'att_cache': [torch.zeros(0, 0, 0, 0)] * len(self.encoders),
+                     'cnn_cache': [torch.zeros(0, 0, 0, 0)] * len(self.encoders),
+                     'up_cache': torch.zeros(0, 0, 0),
+                     'up_att_cache': [torch.zeros(0, 0, 0, 0)] * len(self.up_encoders),
+                     'up_cnn_cache': [torch.zeros(0, 0, 0, 0)] * len(self.up_encoders)}
+        offset = cache['offset']
+        assert offset % self.static_chunk_size == 0, 'previous chunks must end at a multiple of static_chunk_size {}'.format(self.static_chunk_size)
+        new_cache = {'offset': offset + xs.size(1), 'att_cache': [], 'cnn_cache': [], 'up_att_cache': [], 'up_cnn_cache': []}
+        masks = torch.ones(1, 1, xs.size(1), dtype=torch.bool, device=xs.device)
+        if self.global_cmvn is not None:
+            xs = self.global_cmvn(xs)
+        # NOTE pos_emb covers cached and new frames, see RelPositionMultiHeadedAttention.rel_shift
+        xs, pos_emb, _ = self.embed(xs, masks, offset=offset)
+        if context.size(1) != 0:
+            context_masks = torch.ones(1, 1, context.size(1)).to(masks)
+            context, _, _ = self.embed(context, context_masks, offset=offset + xs.size(1))
+        chunk_masks = subsequent_chunk_mask_with_cache(xs.size(1), offset, self.static_chunk_size, xs.device).unsqueeze(0)
+        # lookahead + conformer encoder
+        xs, new_cache['pre_lookahead_cache'] = self.pre_lookahead_layer.forward_chunk(xs, context=context, cache=cache['pre_lookahead_cache'])
+        for i, layer in enumerate(self.encoders):
+            xs, _, att_cache, cnn_cache = layer(xs, chunk_masks, pos_emb, masks, cache['att_cache'][i], cache['cnn_cache'][i])
+            new_cache['att_cache'].append(att_cache)
+            new_cache['cnn_cache'].append(cnn_cache)
+
+        # upsample + conformer encoder
+        xs = xs.transpose(1, 2).contiguous()
+        xs, new_cache['up_cache'] = self.up_layer.forward_chunk(xs, cache['up_cache'])
+        xs = xs.transpose(1, 2).contiguous()
+        offset = offset * self.up_layer.stride
+        masks = torch.ones(1, 1, xs.size(1), dtype=torch.bool, device=xs.device)
+        xs, pos_emb, _ = self.up_embed(xs, masks, offset=offset)
+        chunk_masks = subsequent_chunk_mask_with_cache(xs.size(1), offset, self.static_chunk_size * self.up_layer.stride, xs.device).unsqueeze(0)
+        for i, layer in enumerate(self.up_encoders):
+            xs, _, att_cache, cnn_cache = layer(xs, chunk_masks, pos_emb, masks, cache['up_att_cache'][i], cache['up_cnn_cache'][i])
+            new_cache['up_att_cache'].append(att_cache)
+            new_cache['up_cnn_cache'].append(cnn_cache)
+
+        if self.normalize_before:
+            xs = self.after_norm(xs)
+        return xs, new_cache
+
     def forward_layers(self, xs: torch.Tensor, chunk_masks: torch.Tensor,
                        pos_emb: torch.Tensor,
                        mask_pad: torch.Tensor) -> torch.Tensor:
@@ -16,12 +16,16 @@
 # Modified from ESPnet(https://github.com/espnet/espnet)
 """Unility functions for Transformer."""
 
+import os
 import queue
 import random
+import threading
+from contextlib import contextmanager
 from typing import List
 
 import numpy as np
 import torch
+from torch.overrides import TorchFunctionMode
 
 IGNORE_ID = -1
 
@@ -124,6 +128,46 @@ def th_accuracy(pad_outputs: torch.Tensor, pad_targets: torch.Tensor,
     return (numerator / denominator).detach()
 
 
+# NOTE thread local, modules built by other threads during init_empty_weights are initialized as usual
+_empty_init = threading.local()
+
+
+class SkipInitMode(TorchFunctionMode):
+    """Torch function mode making the random initializers no-ops, parameters keep their uninitialized memory."""
+
+    def __init__(self):
+        super().__init__()
+        self.skipped = {torch.Tensor.uniform_, torch.Tensor.normal_,
+                        torch.nn.init.uniform_, torch.nn.init.normal_, torch.nn.init.trunc_normal_,
+                        torch.nn.init.kaiming_uniform_, torch.nn.init.kaiming_normal_,
+                        torch.nn.init.xavier_uniform_, torch.nn.init.xavier_normal_, torch.nn.init.orthogonal_}
+
+    def __torch_function__(self, func, types, args=(), kwargs=None):
+        if func in self.skipped:
+            return args[0] if len(args) != 0 else kwargs['tensor']
+        return func(*args, **(kwargs or {}))
+
+
+@contextmanager
+def init_empty_weights():
+    """Build modules without random initialization of their parameters.
+
+    Parameters are allocated but never written, so their pages are not resident, and must be assigned
+    afterwards, e.g. by load_state_dict(..., assign=True). Buffers and plain tensor attributes are built as usual.
+    Torch function modes are thread local, so only modules built by the calling thread are affected.
+    """
+    _empty_init.enabled = True
+    try:
+        with SkipInitMode():
+            yield
+    finally:
+        _empty_init.enabled = False
+
+
+def is_empty_init():
+    return getattr(_empty_init, 'enabled', False)
+
+
 def get_padding(kernel_size, dilation=1):
     return int((kernel_size * dilation - dilation) / 2)
 
@@ -195,6 +239,18 @@ def mask_to_bias(mask: torch.Tensor, dtype: torch.dtype) -> torch.Tensor:
     return mask
 
 
+def cached_time_embed(time_embed, t: torch.Tensor, cache: dict) -> torch.Tensor:
+    """Time embedding of an ode step, memoized by the value of t.
+
+    Every element of t holds the same ode time in flow inference, and t_span is fixed for an utterance,
+    so each value is embedded once and reused by every call at the same time.
+    """
+    key = (float(t.reshape(-1)[0]), t.numel())
+    if key not in cache:
+        cache[key] = time_embed(t)
+    return cache[key]
+
+
 class TrtContextWrapper:
     def __init__(self, trt_engine, trt_concurrent=1, device='cuda:0'):
         self.trt_context_pool = queue.Queue(maxsize=trt_concurrent)
@@ -211,3 +267,124 @@ class TrtContextWrapper:
 
     def release_estimator(self, context, stream):
         self.trt_context_pool.put([context, stream])
+
+
+class OrtSessionWrapper:
+    def __init__(self, onnx_model, intra_op_num_threads=1, inter_op_num_threads=1):
+        import onnxruntime
+        option = onnxruntime.SessionOptions()
+        option.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+        option.intra_op_num_threads = intra_op_num_threads
+        option.inter_op_num_threads = inter_op_num_threads
+        self.session = onnxruntime.InferenceSession(onnx_model, sess_options=option, providers=['CPUExecutionProvider'])
+        self.input_names = [i.name for i in self.session.get_inputs()]
+
+    def __call__(self, *inputs):
+        # NOTE onnx models are exported in fp32 and run on cpu, outputs follow device and dtype of the first input
+        ort_inputs = {k: v.detach().float().cpu().numpy() for k, v in zip(self.input_names, inputs)}
+        return [torch.from_numpy(i).to(inputs[0].device, dtype=inputs[0].dtype) for i in self.session.run(None, ort_inputs)]
+
+
+class OrtEstimatorWrapper:
+    def __init__(self, onnx_model, streaming_onnx_model=None, intra_op_num_threads=1, inter_op_num_threads=1, streaming_estimator=None):
+        self.session = OrtSessionWrapper(onnx_model, intra_op_num_threads, inter_op_num_threads)
+        # NOTE streaming changes the attention mask of causal estimators, so it is exported as a separate graph,
+        # without the graph streaming calls run on streaming_estimator, the pytorch estimator
+        self.streaming_session = OrtSessionWrapper(streaming_onnx_model, intra_op_num_threads, inter_op_num_threads) \
+            if streaming_onnx_model is not None else None
+        self.streaming_estimator = streaming_estimator
+
+    def __call__(self, x, mask, mu, t, spks, cond, streaming=False):
+        if streaming is True and self.streaming_session is not None:
+            return self.streaming_session(x, mask, mu, t, spks, cond)[0]
+        if streaming is True and self.streaming_estimator is not None:
+            return self.streaming_estimator(x, mask, mu, t, spks, cond, streaming=True)
+        return self.session(x, mask, mu, t, spks, cond)[0]
+
+
+# padded mel lengths of the cpu torchscript estimator, neighbours differ by at most 1.5x
+JIT_ESTIMATOR_BUCKETS = [64, 96, 128, 192, 256, 384, 512, 768, 1024, 1536, 2048, 3000]
+
+
+class JitTraceTarget(torch.nn.Module):
+    """trace target calling method of module with fixed keyword arguments, e.g. streaming of the estimator"""
+
+    def __init__(self, module, method='forward', **kwargs):
+        super().__init__()
+        self.module = module
+        self.method = method
+        self.kwargs = kwargs
+
+    def forward(self, *inputs):
+        return getattr(self.module, self.method)(*inputs, **self.kwargs)
+
+
+def load_jit_graph(module, inputs, jit_model, checkpoint, method='forward', **kwargs):
+    """Frozen torchscript graph of module.method traced with inputs, optimized for cpu inference.
+
+    The frozen graph is saved to jit_model and loaded on later starts, it is traced again when the checkpoint is newer.
+    """
+    if not os.path.exists(jit_model) or os.path.getmtime(jit_model) < os.path.getmtime(checkpoint):
+        # NOTE trace outside inference mode, inference tensors could not be recorded as graph inputs
+        with torch.inference_mode(False), torch.no_grad():
+            inputs = [i.clone() for i in inputs]
+            graph = torch.jit.freeze(torch.jit.trace(JitTraceTarget(module, method, **kwargs).eval(), inputs, check_trace=False))
+        # NOTE concurrent processes may trace the same graph, write to a temporary file and rename atomically
+        torch.jit.save(graph, '{}.{}.tmp'.format(jit_model, os.getpid()))
+        os.replace('{}.{}.tmp'.format(jit_model, os.getpid()), jit_model)
+    return torch.jit.optimize_for_inference(torch.jit.load(jit_model, map_location='cpu'))
+
+
+class JitEstimatorWrapper:
+    """Flow estimator running frozen torchscript graphs on cpu, one graph per (batch size, padded length, streaming).
+
+    Mel length is padded up to the nearest bucket with masked frames, which only attend and convolve as zeros,
+    so the number of traced graphs is bounded by the buckets. Graphs are traced on first use and saved in jit_dir.
+    Inputs longer than the last bucket run the eager estimator.
+    """
+
+    def __init__(self, estimator, jit_dir, checkpoint, buckets=JIT_ESTIMATOR_BUCKETS):
+        self.estimator = estimator
+        self.jit_dir = jit_dir
+        self.checkpoint = checkpoint
+        self.buckets = sorted(buckets)
+        self.graphs = {}
+        self.lock = threading.Lock()
+
+    def get_graph(self, inputs, streaming):
+        key = (inputs[0].size(0), inputs[0].size(2), streaming)
+        with self.lock:
+            if key not in self.graphs:
+                jit_model = '{}/flow.decoder.estimator.b{}.t{}{}.zip'.format(self.jit_dir, key[0], key[1], '.streaming' if streaming is True else '')
+                self.graphs[key] = load_jit_graph(self.estimator, inputs, jit_model, self.checkpoint, streaming=streaming)
+            return self.graphs[key]
+
+    def __call__(self, x, mask, mu, t, spks, cond, streaming=False):
+        length = x.size(2)
+        bucket = next((i for i in self.buckets if i >= length), None)
+        if bucket is None:
+            return self.estimator(x, mask, mu, t, spks, cond, streaming=streaming)
+        x, mask, mu, cond = [torch.nn.functional.pad(i, (0, bucket - length)) for i in [x, mask, mu, cond]]
+        inputs = [x, mask, mu, t, spks, cond]
+        return self.get_graph(inputs, streaming)(*inputs)[:, :, :length]
+
+
+class JitDecodeSpecWrapper:
+    """hift decode_spec running a frozen torchscript graph on cpu.
+
+    decode_spec is fully convolutional and exported to onnx with dynamic time, so a single graph traced on
+    first use serves every mel length without padding, which would change the output of unmasked convolutions.
+    """
+
+    def __init__(self, hift, jit_model, checkpoint):
+        self.hift = hift
+        self.jit_model = jit_model
+        self.checkpoint = checkpoint
+        self.graph = None
+        self.lock = threading.Lock()
+
+    def __call__(self, x, s_stft):
+        with self.lock:
+            if self.graph is None:
+                self.graph = load_jit_graph(self.hift, [x, s_stft], self.jit_model, self.checkpoint, method='decode_spec')
+        return self.graph(x, s_stft)
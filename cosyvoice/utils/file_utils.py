@@ -116,3 +116,37 @@ def export_cosyvoice2_vllm(model, model_path, device):
     model.llm.model.config.vocab_size = tmp_vocab_size
     model.llm.model.config.tie_word_embeddings = tmp_tie_embedding
     model.llm.model.set_input_embeddings(embed_tokens)
+
+
+def load_checkpoint_mmap(model_file, use_safetensors=False):
+    """Load a state dict whose tensors are backed by the mmaped file, pages are read lazily and shared
+    by all processes on the same host. With use_safetensors, model_file is converted once to a
+    safetensors cache next to it, rebuilt when model_file is newer.
+    """
+    if use_safetensors is False:
+        return torch.load(model_file, map_location='cpu', weights_only=True, mmap=True)
+    from safetensors import safe_open
+    from safetensors.torch import load_file, save_file
+    safetensors_file = '{}.safetensors'.format(os.path.splitext(model_file)[0])
+    if not os.path.exists(safetensors_file) or os.path.getmtime(safetensors_file) < os.path.getmtime(model_file):
+        logging.info('convert {} to {}'.format(model_file, safetensors_file))
+        state_dict = torch.load(model_file, map_location='cpu', weights_only=True)
+        # NOTE safetensors does not allow shared tensors, e.g. tied qwen2 embedding, save them once and record the alias
+        tensors, aliases, views = {}, {}, {}
+        for k, v in state_dict.items():
+            view = (v.untyped_storage().data_ptr(), v.storage_offset(), tuple(v.shape), tuple(v.stride()), v.dtype)
+            if view in views:
+                aliases[k] = views[view]
+            else:
+                views[view] = k
+                tensors[k] = v.contiguous()
+        # NOTE write to a temporary file first, so concurrent workers never read a partial cache
+        tmp_file = '{}.{}.tmp'.format(safetensors_file, os.getpid())
+        save_file(tensors, tmp_file, metadata={'aliases': json.dumps(aliases)})
+        os.replace(tmp_file, safetensors_file)
+    with safe_open(safetensors_file, framework='pt') as f:
+        aliases = json.loads((f.metadata() or {}).get('aliases', '{}'))
+    state_dict = load_file(safetensors_file, device='cpu')
+    for k, v in aliases.items():
+        state_dict[k] = state_dict[v]
+    return state_dict
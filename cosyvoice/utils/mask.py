@@ -158,6 +158,37 @@ def subsequent_chunk_mask(
     return ret
 
 
+def subsequent_chunk_mask_with_cache(
+        size: int,
+        cache_size: int,
+        chunk_size: int,
+        device: torch.device = torch.device("cpu"),
+) -> torch.Tensor:
+    """Create mask (size, cache_size + size) of `size` new steps over
+       `cache_size` cached steps and themselves, this is for chunk by
+       chunk streaming decoding with cache
+
+    Args:
+        size (int): number of new steps
+        cache_size (int): number of cached steps before the new steps
+        chunk_size (int): size of chunk
+        device (torch.device): "cpu" or "cuda" or torch.Tensor.device
+
+    Returns:
+        torch.Tensor: mask, equals to the last `size` rows of
+            subsequent_chunk_mask(cache_size + size, chunk_size)
+
+    Examples:
+        >>> subsequent_chunk_mask_with_cache(2, 2, 2)
+        [[1, 1, 1, 1],
+         [1, 1, 1, 1]]
+    """
+    pos_idx = torch.arange(cache_size + size, device=device)
+    block_value = (torch.div(pos_idx[cache_size:], chunk_size, rounding_mode='trunc') + 1) * chunk_size
+    ret = pos_idx.unsqueeze(0) < block_value.unsqueeze(1)
+    return ret
+
+
 def add_optional_chunk_mask(xs: torch.Tensor,
                             masks: torch.Tensor,
                             use_dynamic_chunk: bool,
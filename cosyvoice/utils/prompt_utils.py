@@ -0,0 +1,150 @@
+import re
+import torch
+import torchaudio
+
+PROMPT_PUNCTUATION = '。！？；：，、.!?;:,'
+# CosyVoice3 instruction prefix ends with this marker, the prefix is not spoken in the prompt wav
+END_OF_PROMPT = '<|endofprompt|>'
+
+
+def frame_energy(speech: torch.Tensor, sample_rate: int, frame_shift: float = 0.01, frame_len: float = 0.025) -> torch.Tensor:
+    """log energy in dB of every frame of a mono (1, T) wav"""
+    shift, length = int(sample_rate * frame_shift), int(sample_rate * frame_len)
+    speech = speech[0]
+    if speech.shape[0] < length:
+        speech = torch.nn.functional.pad(speech, (0, length - speech.shape[0]))
+    frames = speech.unfold(0, length, shift)
+    return 10 * torch.log10(frames.pow(2).mean(dim=1) + 1e-10)
+
+
+def energy_vad(energy: torch.Tensor, frame_shift: float = 0.01, dynamic_range: float = 35.0, noise_margin: float = 12.0,
+               min_speech: float = 0.1, max_gap: float = 0.2):
+    """voiced runs [start frame, end frame) of frame log energy, and the noise floor in dB
+
+    A frame is voiced when it is noise_margin above the noise floor (10% quantile) and within dynamic_range of the peak
+    (99% quantile). Gaps shorter than max_gap are bridged, runs shorter than min_speech are dropped.
+    """
+    noise_floor = torch.quantile(energy.float(), 0.1).item()
+    peak = torch.quantile(energy.float(), 0.99).item()
+    threshold = max(noise_floor + noise_margin, peak - dynamic_range)
+    runs, start = [], None
+    for i, voiced in enumerate((energy > threshold).tolist() + [False]):
+        if voiced and start is None:
+            start = i
+        elif not voiced and start is not None:
+            if len(runs) != 0 and (start - runs[-1][1]) * frame_shift < max_gap:
+                runs[-1][1] = i
+            else:
+                runs.append([start, i])
+            start = None
+    return [(s, e) for s, e in runs if (e - s) * frame_shift >= min_speech], noise_floor
+
+
+def split_clauses(text: str):
+    """split text after punctuation, return the clauses and their spoken weights
+
+    The weight is the number of chinese characters, latin words and digits, roughly the number of syllables spoken.
+    """
+    clauses = [i for i in re.split(r'(?<=[{}])'.format(re.escape(PROMPT_PUNCTUATION)), text) if i.strip() != '']
+    weights = [len(re.findall(r'[\u4e00-\u9fff]|[a-zA-Z]+|\d', i)) for i in clauses]
+    return clauses, weights
+
+
+def select_prompt_region(speech: torch.Tensor, sample_rate: int, prompt_text: str = '', min_sec: float = 3.0, max_sec: float = 8.0,
+                         frame_shift: float = 0.01, pad: float = 0.1, tolerance: float = 0.4):
+    """pick the best min_sec-max_sec voiced region of a (1, T) prompt wav and the part of prompt_text spoken in it
+
+    Regions start and end at pauses found by energy_vad. A pause is a candidate cut only when a punctuation of
+    prompt_text falls within tolerance seconds of it, assuming a constant speech rate over the voiced time,
+    so the returned text stays aligned with the audio. Empty prompt_text, e.g. of cross lingual inference,
+    allows every pause. Among the regions within budget, the one with most voiced time, weighted by the voiced
+    ratio and the energy above the noise floor, is chosen, i.e. dense and clean speech.
+    Returns a dict of start/end seconds, prompt_text, voiced seconds, and aligned, which is False when no region
+    within budget is aligned with the text and the whole prompt without leading and trailing silence is kept.
+    An instruction prefix up to END_OF_PROMPT is not aligned and kept in front of the returned prompt_text.
+    """
+    assert 0 < min_sec <= max_sec, 'min_sec should be in (0, max_sec]'
+    prefix = ''
+    if END_OF_PROMPT in prompt_text:
+        index = prompt_text.index(END_OF_PROMPT) + len(END_OF_PROMPT)
+        prefix, prompt_text = prompt_text[:index], prompt_text[index:]
+    region = align_prompt_region(speech, sample_rate, prompt_text, min_sec, max_sec, frame_shift, pad, tolerance)
+    region['prompt_text'] = prefix + region['prompt_text']
+    return region
+
+
+def align_prompt_region(speech: torch.Tensor, sample_rate: int, prompt_text: str, min_sec: float, max_sec: float,
+                        frame_shift: float, pad: float, tolerance: float):
+    """select_prompt_region of a prompt_text which is all spoken in the prompt wav"""
+    duration = speech.shape[1] / sample_rate
+    energy = frame_energy(speech, sample_rate, frame_shift)
+    units, noise_floor = energy_vad(energy, frame_shift)
+    if len(units) == 0:
+        return {'start': 0.0, 'end': duration, 'prompt_text': prompt_text, 'voiced_sec': 0.0, 'aligned': False}
+
+    def bounds(first, last):
+        # pad into the neighbouring pauses, but never into the neighbouring speech
+        start = max(units[first][0] * frame_shift - pad, units[first - 1][1] * frame_shift if first > 0 else 0.0, 0.0)
+        end = min(units[last][1] * frame_shift + pad, units[last + 1][0] * frame_shift if last + 1 < len(units) else duration, duration)
+        return start, end
+
+    whole_start, whole_end = bounds(0, len(units) - 1)
+    whole = {'start': whole_start, 'end': whole_end, 'prompt_text': prompt_text,
+             'voiced_sec': sum([e - s for s, e in units]) * frame_shift, 'aligned': True}
+    if whole_end - whole_start <= max_sec:
+        return whole
+
+    # cut k is (first unit after the cut, first clause after the cut)
+    clauses, weights = split_clauses(prompt_text)
+    voiced = [0]
+    for s, e in units:
+        voiced.append(voiced[-1] + e - s)
+    cuts = [(0, 0)]
+    if sum(weights) == 0:
+        cuts += [(k, 0) for k in range(1, len(units))]
+    else:
+        written = [0]
+        for w in weights:
+            written.append(written[-1] + w)
+        total_sec = voiced[-1] * frame_shift
+        for k in range(1, len(units)):
+            pause = voiced[k] / voiced[-1]
+            j = min(range(1, len(clauses)), key=lambda i: abs(written[i] / written[-1] - pause), default=None)
+            if j is None or abs(written[j] / written[-1] - pause) * total_sec > tolerance:
+                continue
+            if j > cuts[-1][1]:
+                cuts.append((k, j))
+            elif j == cuts[-1][1] and len(cuts) > 1 and abs(written[j] / written[-1] - pause) < abs(written[j] / written[-1] - voiced[cuts[-1][0]] / voiced[-1]):
+                # NOTE two pauses match the same punctuation, keep the closer one
+                cuts[-1] = (k, j)
+    cuts.append((len(units), len(clauses)))
+
+    best, best_score = None, 0.0
+    for p in range(len(cuts) - 1):
+        for q in range(p + 1, len(cuts)):
+            start, end = bounds(cuts[p][0], cuts[q][0] - 1)
+            if end - start > max_sec:
+                break
+            text = ''.join(clauses[cuts[p][1]: cuts[q][1]])
+            if end - start < min_sec or (sum(weights) != 0 and text.strip() == ''):
+                continue
+            voiced_sec = (voiced[cuts[q][0]] - voiced[cuts[p][0]]) * frame_shift
+            first, last = int(units[cuts[p][0]][0]), int(units[cuts[q][0] - 1][1])
+            snr = energy[first: last].mean().item() - noise_floor
+            score = voiced_sec * voiced_sec / (end - start) * min(max(snr, 0.0), 30.0) / 30.0
+            if best is None or score > best_score:
+                best, best_score = {'start': start, 'end': end, 'prompt_text': text.strip(), 'voiced_sec': voiced_sec, 'aligned': True}, score
+    if best is None:
+        whole['aligned'] = False
+        return whole
+    return best
+
+
+def trim_prompt_wav(prompt_text: str, prompt_wav, min_sec: float = 3.0, max_sec: float = 8.0):
+    """load prompt_wav, return the re-aligned prompt text, the trimmed (1, T) wav, its sample rate and the selected region"""
+    speech, sample_rate = torchaudio.load(prompt_wav, backend='soundfile')
+    speech = speech.mean(dim=0, keepdim=True)
+    region = select_prompt_region(speech, sample_rate, prompt_text, min_sec, max_sec)
+    region['prompt_sec'] = speech.shape[1] / sample_rate
+    speech = speech[:, int(region['start'] * sample_rate): int(region['end'] * sample_rate)]
+    return region['prompt_text'], speech, sample_rate, region
@@ -0,0 +1,5 @@
+import os
+import sys
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(ROOT_DIR)
+sys.path.append('{}/third_party/Matcha-TTS'.format(ROOT_DIR))
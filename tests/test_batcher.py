@@ -0,0 +1,94 @@
+import threading
+import time
+
+import pytest
+from asr import batcher as batcher_module
+from asr.batcher import ASRBatcher
+
+
+class FakeASR:
+    """generate_fn returning 'text of <path>', batches containing a path starting with 'bad' fail"""
+
+    def __init__(self):
+        self.batches = []
+
+    def generate(self, audio_paths):
+        self.batches.append(list(audio_paths))
+        if any(i.startswith("bad") for i in audio_paths):
+            raise RuntimeError("bad audio")
+        return [f"text of {i}" for i in audio_paths]
+
+
+def submit_all(batcher, audio_paths):
+    """并发提交，返回 路径 -> 识别结果或异常"""
+    results = {}
+
+    def submit(audio_path):
+        try:
+            results[audio_path] = batcher.transcribe(audio_path)
+        except Exception as e:
+            results[audio_path] = e
+
+    threads = [threading.Thread(target=submit, args=(i,)) for i in audio_paths]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(timeout=10)
+    return results
+
+
+@pytest.fixture(autouse=True)
+def durations(monkeypatch):
+    # 路径形如 a_5.wav 时时长为5秒
+    monkeypatch.setattr(batcher_module, "audio_duration", lambda path: float(path.split("_")[-1].split(".")[0]) if "_" in path else 1.0)
+
+
+def test_flush_on_batch_size():
+    asr = FakeASR()
+    batcher = ASRBatcher(asr.generate, max_wait=5.0, max_batch_size=4)
+    start_time = time.time()
+    results = submit_all(batcher, [f"{i}.wav" for i in range(4)])
+    assert time.time() - start_time < 2.0
+    assert results == {f"{i}.wav": f"text of {i}.wav" for i in range(4)}
+    assert [len(i) for i in asr.batches] == [4]
+
+
+def test_flush_on_max_wait():
+    asr = FakeASR()
+    batcher = ASRBatcher(asr.generate, max_wait=0.05, max_batch_size=8)
+    start_time = time.time()
+    assert batcher.transcribe("a.wav") == "text of a.wav"
+    assert 0.04 <= time.time() - start_time < 2.0
+    assert asr.batches == [["a.wav"]]
+
+
+def test_flush_on_batch_sec():
+    asr = FakeASR()
+    batcher = ASRBatcher(asr.generate, max_wait=0.5, max_batch_size=8, max_batch_sec=10.0)
+    results = submit_all(batcher, ["a_6.wav", "b_6.wav"])
+    assert results == {"a_6.wav": "text of a_6.wav", "b_6.wav": "text of b_6.wav"}
+    # 两条共12秒超过max_batch_sec，分两批识别
+    assert sorted(len(i) for i in asr.batches) == [1, 1]
+
+
+def test_results_go_to_their_callers():
+    asr = FakeASR()
+    batcher = ASRBatcher(asr.generate, max_wait=0.2, max_batch_size=3)
+    audio_paths = [f"{i}.wav" for i in range(7)]
+    results = submit_all(batcher, audio_paths)
+    assert results == {i: f"text of {i}" for i in audio_paths}
+    assert sorted(sum(asr.batches, [])) == sorted(audio_paths)
+    stats = batcher.get_stats()
+    assert sum(k * v for k, v in stats["batch_size_hist"].items()) == len(audio_paths)
+
+
+def test_bad_audio_fails_only_its_request():
+    asr = FakeASR()
+    batcher = ASRBatcher(asr.generate, max_wait=5.0, max_batch_size=3)
+    results = submit_all(batcher, ["a.wav", "bad.wav", "c.wav"])
+    assert results["a.wav"] == "text of a.wav"
+    assert results["c.wav"] == "text of c.wav"
+    assert isinstance(results["bad.wav"], RuntimeError)
+    # 整批失败后逐条重试
+    assert len(asr.batches[0]) == 3
+    assert sorted(sum(asr.batches[1:], [])) == ["a.wav", "bad.wav", "c.wav"]
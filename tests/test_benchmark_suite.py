@@ -0,0 +1,19 @@
+import builtins
+import pytest
+pytest.importorskip('torch')
+from cosyvoice.benchmark import suite
+
+
+def test_rss_without_proc(monkeypatch):
+    """macOS/Windows have no /proc, rss is None and the case is recorded without peak_rss_delta_mb"""
+    open_file = builtins.open
+
+    def fake_open(path, *args, **kwargs):
+        if str(path).startswith('/proc/'):
+            raise FileNotFoundError(path)
+        return open_file(path, *args, **kwargs)
+    monkeypatch.setattr(builtins, 'open', fake_open)
+    assert suite.rss_mb() is None
+    assert suite.reset_peak_rss() is False
+    rows = suite.compare([{'name': 'a', 'rtf': 1.0}], [{'name': 'a', 'rtf': 1.0, 'peak_rss_delta_mb': 10.0}])
+    assert [i[1] for i in rows] == ['rtf']
@@ -0,0 +1,43 @@
+import pytest
+pytest.importorskip('torch')
+from cosyvoice.cli import chunk_scheduler
+from cosyvoice.cli.chunk_scheduler import ChunkScheduler
+
+
+class FakeClock:
+    now = 0.0
+
+    @classmethod
+    def time(cls):
+        return cls.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    FakeClock.now = 0.0
+    monkeypatch.setattr(chunk_scheduler, 'time', FakeClock)
+    return FakeClock
+
+
+def test_hop_sequence_and_underrun(clock):
+    scheduler = ChunkScheduler(25, 25, 100, 25, stream_scale_factor=2)
+    assert scheduler.hop_len == 25
+    # fast chunks, hops grow at most stream_scale_factor times per chunk up to token_max_hop_len
+    clock.now = 0.2
+    assert scheduler.update(1.0) == 50
+    clock.now = 0.6
+    assert scheduler.update(2.0) == 100
+    # this chunk arrives 4.8s after the 3.2s of buffered speech ran out, rtf goes up and the hop shrinks
+    clock.now = 8.0
+    assert scheduler.update(4.0) == 75
+    clock.now = 8.5
+    stats = scheduler.finish(1.0)
+    assert stats['first_chunk_latency'] == pytest.approx(0.2)
+    assert stats['underrun'] == 1
+    assert stats['underrun_time'] == pytest.approx(4.8)
+    assert stats['hop_lens'] == [25, 50, 100]
+
+
+def test_hops_are_multiples_of_token_hop_len():
+    with pytest.raises(AssertionError):
+        ChunkScheduler(25, 10, 100, 25)
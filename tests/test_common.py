@@ -0,0 +1,44 @@
+import threading
+import pytest
+torch = pytest.importorskip('torch')
+from cosyvoice.utils.common import init_empty_weights, is_empty_init
+from cosyvoice.utils.file_utils import load_checkpoint_mmap
+
+
+def test_init_empty_weights_skips_random_init():
+    torch.manual_seed(0)
+    expected = torch.rand(1)
+    torch.manual_seed(0)
+    with init_empty_weights():
+        assert is_empty_init()
+        torch.nn.Linear(64, 64)
+    assert not is_empty_init()
+    # NOTE no random number was drawn to initialize the linear
+    assert torch.equal(torch.rand(1), expected)
+
+
+def test_init_empty_weights_is_thread_local():
+    torch.manual_seed(0)
+    expected = torch.nn.Linear(4, 4).weight.detach().clone()
+    result = {}
+
+    def build():
+        result['empty_init'] = is_empty_init()
+        torch.manual_seed(0)
+        result['weight'] = torch.nn.Linear(4, 4).weight.detach().clone()
+    with init_empty_weights():
+        thread = threading.Thread(target=build)
+        thread.start()
+        thread.join()
+    assert result['empty_init'] is False
+    assert torch.equal(result['weight'], expected)
+
+
+def test_safetensors_cache_path(tmp_path):
+    pytest.importorskip('safetensors')
+    model_dir = tmp_path / 'CosyVoice.pt_models'
+    model_dir.mkdir()
+    torch.save({'weight': torch.ones(2)}, model_dir / 'flow.pt')
+    state_dict = load_checkpoint_mmap(str(model_dir / 'flow.pt'), use_safetensors=True)
+    assert torch.equal(state_dict['weight'], torch.ones(2))
+    assert (model_dir / 'flow.safetensors').exists()
@@ -0,0 +1,17 @@
+import pytest
+pytest.importorskip('numpy')
+pytest.importorskip('torch')
+from tts.cosyvoice_pool import CosyVoiceWorkerPool
+
+
+def test_worker_startup_failure_raises(tmp_path):
+    # NOTE the worker fails before sending ready, the pool must raise instead of waiting forever
+    with pytest.raises(RuntimeError):
+        CosyVoiceWorkerPool({'model_dir': str(tmp_path / 'missing')}, num_workers=1, pin_cpu=False)
+
+
+def test_split_cpus_without_affinity(monkeypatch):
+    # NOTE macOS/Windows have no sched_setaffinity, workers are not pinned
+    from tts.cosyvoice_pool import split_cpus
+    monkeypatch.delattr('os.sched_setaffinity', raising=False)
+    assert split_cpus(2) == [None, None]
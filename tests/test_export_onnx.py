@@ -0,0 +1,48 @@
+import os
+import random
+import pytest
+torch = pytest.importorskip('torch')
+pytest.importorskip('onnxruntime')
+from cosyvoice.benchmark.models import build_tiny_model
+from cosyvoice.bin.export_onnx import export_ort_estimator, export_ort_hift, get_dummy_input, get_hift_dummy_input
+from cosyvoice.utils.common import OrtSessionWrapper, OrtEstimatorWrapper
+
+
+@pytest.mark.parametrize('name', ['v1_tiny', 'v2_tiny'])
+def test_onnxruntime_parity(name, tmp_path):
+    """onnxruntime estimator and hift decode graphs match eager mode, with dynamic batch size and length"""
+    model = build_tiny_model(name).model
+    estimator, hift = model.flow.decoder.estimator, model.hift
+    out_channels = estimator.out_channels
+    streaming_list = [False] if estimator.__class__.__name__ == 'ConditionalDecoder' else [False, True]
+    for streaming in streaming_list:
+        export_ort_estimator(estimator, out_channels, streaming, str(tmp_path / 'estimator.{}.onnx'.format(streaming)), model.device)
+    export_ort_hift(hift, str(tmp_path / 'hift.onnx'), model.device)
+    estimator_ort = OrtEstimatorWrapper(str(tmp_path / 'estimator.False.onnx'),
+                                        str(tmp_path / 'estimator.True.onnx') if len(streaming_list) == 2 else None)
+    hift_ort = OrtSessionWrapper(str(tmp_path / 'hift.onnx'))
+    random.seed(0)
+    with torch.no_grad():
+        for _ in range(5):
+            x, mask, mu, t, spks, cond = get_dummy_input(random.randint(1, 2), random.randint(16, 512), out_channels, model.device)
+            for streaming in streaming_list:
+                output_pytorch = estimator(x, mask, mu, t, spks, cond, streaming=streaming)
+                output_onnx = estimator_ort(x, mask, mu, t, spks, cond, streaming=streaming)
+                torch.testing.assert_close(output_onnx, output_pytorch, rtol=1e-2, atol=1e-4)
+            x, s_stft = get_hift_dummy_input(hift, random.randint(16, 512), model.device)
+            for output_pytorch, output_onnx in zip(hift.decode_spec(x, s_stft), hift_ort(x, s_stft)):
+                torch.testing.assert_close(output_onnx, output_pytorch, rtol=1e-2, atol=1e-4)
+
+
+def test_missing_streaming_graph_keeps_pytorch_streaming(tmp_path):
+    """without the streaming graph, streaming calls of a causal estimator run the pytorch estimator, not the non-streaming graph"""
+    model = build_tiny_model('v2_tiny').model
+    estimator = model.flow.decoder.estimator
+    export_ort_estimator(estimator, estimator.out_channels, False, str(tmp_path / 'estimator.onnx'), model.device)
+    export_ort_hift(model.hift, str(tmp_path / 'hift.onnx'), model.device)
+    model.load_ort(str(tmp_path / 'estimator.onnx'), str(tmp_path / 'missing.onnx'), str(tmp_path / 'hift.onnx'), 1, 1)
+    assert not os.path.exists(tmp_path / 'missing.onnx')
+    x, mask, mu, t, spks, cond = get_dummy_input(2, 128, estimator.out_channels, model.device)
+    with torch.no_grad():
+        torch.testing.assert_close(model.flow.decoder.estimator(x, mask, mu, t, spks, cond, streaming=True),
+                                   estimator(x, mask, mu, t, spks, cond, streaming=True))
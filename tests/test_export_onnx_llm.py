@@ -0,0 +1,26 @@
+import pytest
+torch = pytest.importorskip('torch')
+pytest.importorskip('onnxruntime')
+from cosyvoice.benchmark.models import build_tiny_model
+from cosyvoice.bin.export_onnx_llm import export_ort_llm, greedy_sampling, run_llm
+from cosyvoice.llm.ort_decoder import OrtLLMDecoder
+
+
+@pytest.mark.parametrize('name', ['v1_tiny', 'v2_tiny'])
+def test_onnxruntime_greedy_decoding_parity(name, tmp_path):
+    """greedy decoding with the onnxruntime prefill/decode graphs yields the same tokens as eager mode"""
+    bm = build_tiny_model(name)
+    llm, device = bm.model.llm, bm.model.device
+    prefill_model, decode_model = str(tmp_path / 'llm.prefill.ort.onnx'), str(tmp_path / 'llm.decode.ort.onnx')
+    with torch.no_grad():
+        export_ort_llm(llm, prefill_model, decode_model, device)
+        llm.sampling = greedy_sampling(llm)
+        text = bm.text(16).to(device)
+        tokens_pytorch, _ = run_llm(llm, text, 4)
+        llm.ort_decoder = OrtLLMDecoder(llm, prefill_model, decode_model, intra_op_num_threads=1)
+        try:
+            tokens_onnx, _ = run_llm(llm, text, 4)
+        finally:
+            del llm.ort_decoder
+    assert len(tokens_pytorch) == 16 * 4
+    assert tokens_onnx == tokens_pytorch
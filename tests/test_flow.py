@@ -0,0 +1,57 @@
+import pytest
+torch = pytest.importorskip('torch')
+from cosyvoice.benchmark.models import build_tiny_model
+
+
+@pytest.fixture(scope='module')
+def tiny_v2():
+    return build_tiny_model('v2_tiny')
+
+
+@pytest.mark.parametrize('estimator_cache', [False, True])
+def test_incremental_flow_matches_streaming(tiny_v2, estimator_cache):
+    """incremental streaming with flow_cache equals streaming inference of the whole token prefix, with a prompt"""
+    flow = tiny_v2.model.flow
+    chunk_size, context_size = flow.encoder.static_chunk_size, flow.pre_lookahead_len
+    generator = torch.Generator().manual_seed(0)
+    token = torch.randint(0, flow.vocab_size, (1, 90), generator=generator)
+    # NOTE prompt of 17 tokens is not aligned to the chunk size
+    prompt_token = torch.randint(0, flow.vocab_size, (1, 17), generator=generator)
+    prompt_feat = torch.rand(1, 17 * flow.token_mel_ratio, 80, generator=generator)
+    prompt_token_len, prompt_feat_len = torch.tensor([prompt_token.shape[1]]), torch.tensor([prompt_feat.shape[1]])
+    embedding = tiny_v2.embedding
+    flow_cache = flow.init_flow_cache(estimator_cache=estimator_cache)
+    # NOTE as in CosyVoice2Model.tts, the first hop is padded so that prompt and first hop end at a multiple of chunk_size
+    i, hop = 0, chunk_size + (-prompt_token.shape[1] % chunk_size)
+    with torch.inference_mode():
+        while True:
+            finalize = i + hop + context_size >= token.shape[1]
+            this_token = token[:, :i + hop + context_size]
+            this_token_len = torch.tensor([this_token.shape[1]])
+            pred_gt, _ = flow.inference(this_token, this_token_len, prompt_token, prompt_token_len, prompt_feat, prompt_feat_len, embedding,
+                                        streaming=True, finalize=finalize)
+            pred_gt = pred_gt[:, :, i * flow.token_mel_ratio:]
+            pred_chunk, flow_cache = flow.inference(this_token, this_token_len, prompt_token, prompt_token_len, prompt_feat, prompt_feat_len, embedding,
+                                                    streaming=True, finalize=finalize, flow_cache=flow_cache)
+            assert pred_chunk.shape == pred_gt.shape
+            torch.testing.assert_close(pred_chunk, pred_gt, rtol=1e-4, atol=1e-4, msg='incremental flow mismatch at token offset {}'.format(i))
+            if finalize:
+                break
+            i, hop = i + hop, chunk_size
+
+
+@pytest.mark.parametrize('estimator_cache', [False, True])
+def test_incremental_flow_stream_tts(tiny_v2, estimator_cache):
+    """stream tts with incremental flow runs every hop and the remaining tokens through flow_cache"""
+    model = tiny_v2.model
+    model.load_incremental_flow(estimator_cache=estimator_cache)
+    try:
+        outputs = list(model.tts(text=tiny_v2.text(32), flow_embedding=tiny_v2.embedding, llm_embedding=tiny_v2.embedding, stream=True))
+    finally:
+        model.incremental_flow, model.flow_estimator_cache = False, False
+    assert len(outputs) > 1
+    assert 'stream_stats' in outputs[-1]
+    for output in outputs:
+        assert output['tts_speech'].shape[1] > 0
+        assert torch.isfinite(output['tts_speech']).all()
+    assert len(model.flow_cache_dict) == 0
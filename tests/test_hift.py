@@ -0,0 +1,46 @@
+import pytest
+torch = pytest.importorskip('torch')
+from cosyvoice.benchmark.models import build_tiny_model
+from cosyvoice.hifigan.generator import CounterNoise
+
+
+@pytest.fixture(scope='module')
+def causal_hift():
+    return build_tiny_model('v3_tiny').model.hift
+
+
+def test_counter_noise_is_chunking_invariant():
+    noise = CounterNoise(9, key=1)
+    noise_gt = noise(0, 300 * 480)
+    noise_chunk = torch.concat([noise(i, min(7000, 300 * 480 - i)) for i in range(0, 300 * 480, 7000)], dim=1)
+    assert torch.equal(noise_gt, noise_chunk)
+
+
+def test_chunked_inference_matches_full(causal_hift):
+    """inference of growing mel prefixes, as in CosyVoice3 streaming, equals full inference"""
+    hift, hop_len = causal_hift, int(causal_hift.f0_upsamp.scale_factor)
+    max_len, chunk_size, context_size = 300, 30, 8
+    mel = torch.rand(1, 80, max_len, generator=torch.Generator().manual_seed(0))
+    with torch.inference_mode():
+        pred_gt, _ = hift.inference(mel)
+        for i in range(0, max_len, chunk_size):
+            finalize = i + chunk_size + context_size >= max_len
+            pred_chunk, _ = hift.inference(mel[:, :, :i + chunk_size + context_size], finalize=finalize)
+            pred_chunk = pred_chunk[:, i * hop_len:]
+            torch.testing.assert_close(pred_chunk, pred_gt[:, i * hop_len:i * hop_len + pred_chunk.shape[1]], rtol=1e-4, atol=1e-5)
+
+
+def test_inference_chunk_matches_full(causal_hift):
+    """stateful stream inference, every call only gets the new mel frames, equals full inference"""
+    hift = causal_hift
+    max_len, chunk_size = 300, 30
+    mel = torch.rand(1, 80, max_len, generator=torch.Generator().manual_seed(0))
+    with torch.inference_mode():
+        pred_gt, _ = hift.inference(mel)
+        cache, pred_chunks = None, []
+        for i in range(0, max_len, chunk_size):
+            pred_chunk, cache = hift.inference_chunk(mel[:, :, i:i + chunk_size], cache=cache, finalize=i + chunk_size >= max_len)
+            pred_chunks.append(pred_chunk)
+    pred_chunk = torch.concat(pred_chunks, dim=1)
+    assert pred_chunk.shape == pred_gt.shape
+    torch.testing.assert_close(pred_chunk, pred_gt, rtol=1e-4, atol=1e-5)
@@ -0,0 +1,39 @@
+import pytest
+torch = pytest.importorskip('torch')
+from cosyvoice.benchmark.models import build_tiny_model
+from cosyvoice.cli.profiler import TTSProfiler
+
+
+def test_stream_tts_profile():
+    """every chunk records hop_wait, flow and hift, chunk events add up to the yielded speech"""
+    bm = build_tiny_model('v2_tiny')
+    profiler = TTSProfiler()
+    outputs = list(bm.model.tts(text=bm.text(32), flow_embedding=bm.embedding, llm_embedding=bm.embedding, stream=True, profiler=profiler))
+    summary = profiler.summary()
+    num_chunks = len(outputs)
+    assert num_chunks > 1
+    assert summary['chunks'] == num_chunks
+    assert summary['llm_prefill']['count'] == 1
+    assert summary['llm_decode']['count'] > 0
+    for stage in ['hop_wait', 'flow', 'hift']:
+        assert summary[stage]['count'] == num_chunks, stage
+        assert summary[stage]['total'] >= 0
+    speech_len = sum([i['tts_speech'].shape[1] for i in outputs]) / bm.sample_rate
+    assert summary['speech_len'] == pytest.approx(speech_len)
+    assert 0 < summary['first_chunk_latency'] <= summary['wall_time']
+    assert summary['rtf'] == pytest.approx(summary['wall_time'] / speech_len)
+    # NOTE the request is removed from the model once finished
+    assert len(bm.model.profiler_dict) == 0
+
+
+def test_summary_of_recorded_events():
+    profiler = TTSProfiler()
+    profiler.record('flow', 0.5)
+    profiler.record('flow', 0.25)
+    profiler.record('chunk', 0.0, speech_len=2.0)
+    profiler.record('pipeline', 1.0, overlap=1.5)
+    summary = profiler.summary()
+    assert summary['flow'] == {'total': 0.75, 'count': 2, 'mean': 0.375, 'max': 0.5}
+    assert 'chunk' not in summary and 'pipeline' not in summary
+    assert summary['chunks'] == 1 and summary['speech_len'] == 2.0
+    assert summary['pipeline_overlap'] == 1.5
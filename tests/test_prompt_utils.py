@@ -0,0 +1,24 @@
+import math
+import pytest
+torch = pytest.importorskip('torch')
+from cosyvoice.utils.prompt_utils import select_prompt_region
+
+
+def tone_with_pauses(units, sample_rate=16000, pause=0.4):
+    """units seconds of 220Hz tone separated by pause seconds of silence"""
+    parts = [torch.zeros(int(pause * sample_rate))]
+    for sec in units:
+        t = torch.arange(int(sec * sample_rate)) / sample_rate
+        parts += [0.3 * torch.sin(2 * math.pi * 220 * t), torch.zeros(int(pause * sample_rate))]
+    return torch.concat(parts).unsqueeze(0)
+
+
+def test_instruction_prefix_is_kept_and_not_aligned():
+    # 4 clauses of 5 characters, spoken as 4 runs of 1.5 seconds
+    speech, text = tone_with_pauses([1.5] * 4), '一二三四五，六七八九十，一二三四五，六七八九十。'
+    prefix = 'You are a helpful assistant.<|endofprompt|>'
+    region = select_prompt_region(speech, 16000, text, min_sec=3.0, max_sec=4.0)
+    region_prefix = select_prompt_region(speech, 16000, prefix + text, min_sec=3.0, max_sec=4.0)
+    assert region['aligned'] is True
+    assert region_prefix['prompt_text'] == prefix + region['prompt_text']
+    assert (region_prefix['start'], region_prefix['end']) == (region['start'], region['end'])
@@ -0,0 +1,28 @@
+import os
+
+import pytest
+from utils.resource_planner import ResourcePlanner
+
+
+def test_disabled_planner_does_not_allocate():
+    # 2 workers on 1 CPU can not be allocated, but must not fail while resources is disabled
+    planner = ResourcePlanner({"enable": False, "cpus": [0]}, num_tts_workers=2)
+    assert planner.enable is False
+    with pytest.raises(ValueError):
+        planner.plan("main")
+
+
+def test_allocation():
+    planner = ResourcePlanner({"enable": True, "cpus": list(range(8)), "components": {"main": {"cpus": 2}}}, num_tts_workers=3)
+    assert planner.allocation == {"main": [0, 1], "tts_workers": [2, 3, 4, 5, 6, 7]}
+    assert [i["cpus"] for i in planner.worker_plans()] == [[2, 3], [4, 5], [6, 7]]
+    assert planner.plan("main")["intra_op_num_threads"] == 2
+
+
+def test_planner_without_sched_getaffinity(monkeypatch):
+    # macOS/Windows没有sched_getaffinity，默认配置下构建规划器和应用规划不能报错
+    monkeypatch.delattr("os.sched_getaffinity", raising=False)
+    monkeypatch.delattr("os.sched_setaffinity", raising=False)
+    planner = ResourcePlanner({"enable": False, "cpus": None})
+    assert planner.cpus == list(range(os.cpu_count()))
+    assert planner.plan("main")["intra_op_num_threads"] == os.cpu_count()
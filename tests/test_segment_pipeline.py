@@ -0,0 +1,55 @@
+import threading
+import time
+
+import pytest
+pytest.importorskip('torch')
+from cosyvoice.cli.segment_pipeline import SegmentPipeline
+
+
+def job(segment):
+    for i in range(3):
+        time.sleep(0.01)
+        yield (segment, i)
+
+
+def test_outputs_in_order_and_stats_per_call():
+    pipeline = SegmentPipeline(depth=2)
+    results, stats = {}, {}
+
+    def call(name, segments):
+        stats[name] = {}
+        results[name] = list(pipeline.run(segments, job, stats[name]))
+
+    threads = [threading.Thread(target=call, args=(name, segments)) for name, segments in (('a', range(4)), ('b', range(2)))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert results['a'] == [(s, i) for s in range(4) for i in range(3)]
+    assert results['b'] == [(s, i) for s in range(2) for i in range(3)]
+    assert stats['a']['segments'] == 4
+    assert stats['b']['segments'] == 2
+    assert stats['a']['overlap'] > 1.0
+
+
+def test_depth_one_fills_stats():
+    stats = {}
+    assert list(SegmentPipeline(depth=1).run(range(3), job, stats)) == [(s, i) for s in range(3) for i in range(3)]
+    assert stats['segments'] == 3
+    assert stats['overlap'] == pytest.approx(1.0, abs=0.2)
+
+
+def test_slow_consumer_bounds_buffered_outputs():
+    produced = []
+
+    def long_job(segment):
+        for i in range(10):
+            produced.append((segment, i))
+            yield (segment, i)
+
+    outputs = SegmentPipeline(depth=2).run(range(2), long_job)
+    assert next(outputs) == (0, 0)
+    time.sleep(0.5)
+    # NOTE each of the 2 producers blocks once its queue holds depth outputs
+    assert len(produced) <= 1 + 2 * 3
+    outputs.close()
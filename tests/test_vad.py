@@ -0,0 +1,73 @@
+import pytest
+np = pytest.importorskip('numpy')
+sf = pytest.importorskip('soundfile')
+from asr.vad import SpeechSegmenter
+
+SAMPLE_RATE = 16000
+
+
+class FakeRecognizer:
+    """每段返回固定文本，并记录各段时长"""
+
+    def __init__(self):
+        self.durations = []
+
+    def recognize(self, audio_paths):
+        for audio_path in audio_paths:
+            self.durations.append(sf.info(audio_path).duration)
+        return ["你好"] * len(audio_paths)
+
+
+def write_wav(path, seconds):
+    """seconds: [(时长, 是否有声)]，有声部分为440Hz正弦"""
+    parts = []
+    for duration, voiced in seconds:
+        t = np.arange(int(duration * SAMPLE_RATE)) / SAMPLE_RATE
+        parts.append(0.5 * np.sin(2 * np.pi * 440 * t) if voiced else np.zeros_like(t))
+    sf.write(path, np.concatenate(parts).astype(np.float32), SAMPLE_RATE)
+    return str(path)
+
+
+def test_trims_leading_and_trailing_silence(tmp_path):
+    audio_path = write_wav(tmp_path / "a.wav", [(1.0, False), (2.0, True), (1.0, False)])
+    segmenter, recognizer = SpeechSegmenter(pad=0.2), FakeRecognizer()
+    assert segmenter.transcribe(audio_path, recognizer.recognize) == "你好"
+    speech, _ = sf.read(audio_path, dtype="float32")
+    segments = segmenter.split(speech, SAMPLE_RATE, audio_path)
+    assert len(segments) == 1
+    # 有声区间[1, 3)两侧各保留pad秒
+    assert segments[0][0] == pytest.approx(0.8, abs=0.05)
+    assert segments[0][1] == pytest.approx(3.2, abs=0.05)
+    assert recognizer.durations[0] == pytest.approx(2.4, abs=0.05)
+    stats = segmenter.get_stats()
+    assert stats["requests"] == 1 and stats["segments"] == 1
+    assert stats["removed_sec"] == pytest.approx(1.6, abs=0.05)
+
+
+def test_all_silence(tmp_path):
+    audio_path = write_wav(tmp_path / "a.wav", [(2.0, False)])
+    segmenter, recognizer = SpeechSegmenter(), FakeRecognizer()
+    assert segmenter.transcribe(audio_path, recognizer.recognize) == ""
+    assert recognizer.durations == []
+    stats = segmenter.get_stats()
+    assert stats["segments"] == 0
+    assert stats["removed_sec"] == pytest.approx(2.0)
+    assert stats["removed_ratio"] == pytest.approx(1.0)
+
+
+def test_short_tail_merged_into_previous_segment(monkeypatch):
+    # 能量随时间递减，长段总在[max_segment_sec/2, max_segment_sec]的末尾切开
+    speech = np.linspace(1.0, 0.01, 9 * SAMPLE_RATE).astype(np.float32)
+    segmenter = SpeechSegmenter(max_segment_sec=4.0, pad=0.0)
+    monkeypatch.setattr(segmenter, "detect", lambda audio_path, energy, zcr: [(0.2, 8.5)])
+    segments = segmenter.split(speech, SAMPLE_RATE, "")
+    # 在约4.2s和8.2s处切开，剩下约0.3s的尾段并入前一段
+    assert len(segments) == 2
+    assert segments[0][0] == pytest.approx(0.2)
+    assert segments[0][1] == pytest.approx(4.2, abs=0.05)
+    assert segments[1] == (segments[0][1], 8.5)
+
+    monkeypatch.setattr(segmenter, "detect", lambda audio_path, energy, zcr: [(0.2, 7.0)])
+    segments = segmenter.split(speech, SAMPLE_RATE, "")
+    assert len(segments) == 2
+    assert segments[1][1] - segments[1][0] == pytest.approx(2.8, abs=0.05)
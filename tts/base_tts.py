@@ -35,3 +35,7 @@ class BaseTTS(ABC):
             是否成功
         """
         pass
+    
+    def supports_bistream(self) -> bool:
+        """是否支持边接收文本边合成(见synthesize_bistream_sync)"""
+        return False
@@ -0,0 +1,212 @@
+"""CosyVoice多进程合成池"""
+import multiprocessing
+import os
+import queue
+import threading
+import uuid
+from multiprocessing import resource_tracker, shared_memory
+from typing import Any, Dict, Iterator, List, Optional
+
+import numpy as np
+
+from utils.resource_planner import apply_process_plan, available_cpus
+
+
+def split_cpus(num_workers: int) -> List[Optional[List[int]]]:
+    """把当前进程可用的CPU按编号连续均分给每个worker，CPU数少于worker数或平台不支持绑核(macOS/Windows)时不绑核"""
+    if not hasattr(os, 'sched_setaffinity'):
+        return [None] * num_workers
+    cpus = available_cpus()
+    cpus_per_worker = len(cpus) // num_workers
+    if cpus_per_worker == 0:
+        return [None] * num_workers
+    return [cpus[i * cpus_per_worker:(i + 1) * cpus_per_worker] for i in range(num_workers)]
+
+
+def _worker_main(worker_id, model_kwargs, plan, job_queue, result_queue, shm_name, num_slots, slot_samples, free_slots):
+    """worker进程：加载模型，循环处理合成任务，音频分块写入共享内存槽位后通知主进程"""
+    apply_process_plan(plan)
+    from cosyvoice.cli.cosyvoice import AutoModel
+    shm = shared_memory.SharedMemory(name=shm_name)
+    # 共享内存由主进程创建和释放，避免worker退出时被resource_tracker提前unlink
+    resource_tracker.unregister(shm._name, 'shared_memory')
+    buffers = np.ndarray((num_slots, slot_samples), dtype=np.float32, buffer=shm.buf)
+    try:
+        model = AutoModel(**model_kwargs)
+    except Exception as e:
+        result_queue.put(('error', None, worker_id, str(e)))
+        return
+    result_queue.put(('ready', None, worker_id, model.sample_rate))
+    slot = 0
+    while True:
+        job = job_queue.get()
+        if job is None:
+            break
+        job_id, text, prompt_text, prompt_wav, stream = job
+        # 通知主进程由哪个worker处理该任务，worker异常退出时只让它的任务失败
+        result_queue.put(('accepted', job_id, worker_id, None))
+        try:
+            for output in model.inference_zero_shot(text, prompt_text, prompt_wav, stream=stream):
+                speech = output['tts_speech'].squeeze(0).float().numpy()
+                # 超过槽位长度的音频拆成多块，主进程按顺序取走后释放槽位
+                for start in range(0, len(speech), slot_samples):
+                    piece = speech[start:start + slot_samples]
+                    free_slots.acquire()
+                    buffers[slot, :len(piece)] = piece
+                    result_queue.put(('chunk', job_id, worker_id, slot, len(piece)))
+                    slot = (slot + 1) % num_slots
+            result_queue.put(('done', job_id, worker_id, None))
+        except Exception as e:
+            result_queue.put(('done', job_id, worker_id, str(e)))
+    del buffers
+    shm.close()
+
+
+class CosyVoiceWorkerPool:
+    """CosyVoice多进程合成池
+
+    每个worker进程各自加载一份模型，使用mmap加载权重时同机进程共享只读权重页；
+    worker绑定各自的CPU和线程数，避免GIL、模型锁和intra-op线程互相争抢。
+    任务通过队列分发给空闲worker，合成的音频经每个worker的共享内存环形槽位流式传回主进程。
+    """
+
+    def __init__(
+        self,
+        model_kwargs: Dict[str, Any],
+        num_workers: int = 2,
+        num_threads: int = 0,
+        pin_cpu: bool = True,
+        num_slots: int = 4,
+        slot_seconds: float = 10.0,
+        max_sample_rate: int = 24000,
+        worker_plans: Optional[List[Dict[str, Any]]] = None
+    ):
+        """
+        Args:
+            model_kwargs: 传给AutoModel的参数
+            num_workers: worker进程数
+            num_threads: 每个worker的torch线程数，0表示绑核时使用分到的CPU数，不绑核时使用torch默认值
+            pin_cpu: 是否把可用CPU连续均分绑定到各worker
+            num_slots: 每个worker的共享内存槽位数，主进程来不及取走时worker等待空闲槽位
+            slot_seconds: 每个槽位可容纳的音频秒数
+            max_sample_rate: 用于计算槽位大小的最大采样率
+            worker_plans: 每个worker的线程规划(见utils.resource_planner)，给定时忽略num_threads和pin_cpu
+        """
+        ctx = multiprocessing.get_context('spawn')
+        self.num_slots = num_slots
+        self.slot_samples = int(slot_seconds * max_sample_rate)
+        self.job_queue = ctx.Queue()
+        self.result_queue = ctx.Queue()
+        # job_id -> 该任务的结果队列
+        self.jobs = {}
+        self.lock = threading.Lock()
+        self.shms, self.buffers, self.free_slots, self.workers = [], [], [], []
+        if worker_plans is None:
+            cpus = split_cpus(num_workers) if pin_cpu else [None] * num_workers
+            worker_plans = [{"cpus": cpus[i],
+                             "intra_op_num_threads": num_threads if num_threads > 0 or cpus[i] is None else len(cpus[i])}
+                            for i in range(num_workers)]
+        assert len(worker_plans) == num_workers, "worker_plans数量与num_workers不一致"
+        for i in range(num_workers):
+            shm = shared_memory.SharedMemory(create=True, size=self.num_slots * self.slot_samples * 4)
+            self.shms.append(shm)
+            self.buffers.append(np.ndarray((self.num_slots, self.slot_samples), dtype=np.float32, buffer=shm.buf))
+            self.free_slots.append(ctx.Semaphore(self.num_slots))
+            p = ctx.Process(target=_worker_main,
+                            args=(i, model_kwargs, worker_plans[i], self.job_queue, self.result_queue,
+                                  shm.name, self.num_slots, self.slot_samples, self.free_slots[i]),
+                            daemon=True)
+            p.start()
+            self.workers.append(p)
+        # 等待所有worker加载完模型，worker在发送ready前退出(如内存不足被杀)时报错，不无限等待
+        self.sample_rate = None
+        ready = set()
+        while len(ready) < num_workers:
+            try:
+                kind, _, worker_id, value = self.result_queue.get(timeout=1)
+            except queue.Empty:
+                dead = [i for i, p in enumerate(self.workers) if i not in ready and not p.is_alive()]
+                if len(dead) != 0:
+                    exitcode = self.workers[dead[0]].exitcode
+                    self.close()
+                    raise RuntimeError(f"worker {dead[0]} 加载模型时异常退出，退出码{exitcode}")
+                continue
+            if kind == 'error':
+                self.close()
+                raise RuntimeError(f"worker {worker_id} 模型加载失败: {value}")
+            ready.add(worker_id)
+            self.sample_rate = value
+        self.reader = threading.Thread(target=self._read_results, daemon=True)
+        self.reader.start()
+
+    def _read_results(self):
+        """从共享内存取出音频块，释放槽位后分发到对应任务"""
+        while True:
+            message = self.result_queue.get()
+            if message is None:
+                break
+            kind, job_id, worker_id = message[:3]
+            if kind == 'chunk':
+                slot, length = message[3], message[4]
+                value = self.buffers[worker_id][slot, :length].copy()
+                self.free_slots[worker_id].release()
+            elif kind == 'accepted':
+                value = worker_id
+            else:
+                value = message[3]
+            with self.lock:
+                job = self.jobs.get(job_id)
+            # 已放弃的任务直接丢弃剩余音频
+            if job is not None:
+                job.put((kind, value))
+
+    def synthesize_iter(self, text: str, prompt_text: str, prompt_wav: str, stream: bool = False) -> Iterator[np.ndarray]:
+        """提交zero-shot合成任务，按顺序返回float32音频块"""
+        job_id = uuid.uuid4().hex
+        job = queue.Queue()
+        with self.lock:
+            self.jobs[job_id] = job
+        self.job_queue.put((job_id, text, prompt_text, prompt_wav, stream))
+        # 处理该任务的worker，未被领取前为None
+        worker_id = None
+        try:
+            while True:
+                try:
+                    kind, value = job.get(timeout=1)
+                except queue.Empty:
+                    if worker_id is not None and not self.workers[worker_id].is_alive():
+                        raise RuntimeError(f"worker {worker_id} 进程异常退出，退出码{self.workers[worker_id].exitcode}")
+                    if worker_id is None and not any(p.is_alive() for p in self.workers):
+                        raise RuntimeError("worker进程全部异常退出")
+                    continue
+                if kind == 'accepted':
+                    worker_id = value
+                    continue
+                if kind == 'done':
+                    if value is not None:
+                        raise RuntimeError(value)
+                    break
+                yield value
+        finally:
+            with self.lock:
+                self.jobs.pop(job_id, None)
+
+    def synthesize(self, text: str, prompt_text: str, prompt_wav: str) -> np.ndarray:
+        """合成整句音频"""
+        chunks = list(self.synthesize_iter(text, prompt_text, prompt_wav))
+        return np.concatenate(chunks) if len(chunks) != 0 else np.zeros(0, dtype=np.float32)
+
+    def close(self):
+        """停止worker并释放共享内存"""
+        for _ in self.workers:
+            self.job_queue.put(None)
+        for p in self.workers:
+            p.join(timeout=10)
+            if p.is_alive():
+                p.terminate()
+        self.result_queue.put(None)
+        self.buffers = []
+        for shm in self.shms:
+            shm.close()
+            shm.unlink()
+        self.shms = []
@@ -1,9 +1,11 @@
 """CosyVoice TTS实现"""
 import asyncio
 from pathlib import Path
-from typing import Optional
-from cosyvoice.cli.cosyvoice import AutoModel
+from typing import Any, Callable, Dict, Iterator, List, Optional, Union
+from cosyvoice.cli.cosyvoice import AutoModel, CosyVoice2
+from cosyvoice.cli.profiler import TTSProfiler
 from .base_tts import BaseTTS
+from .cosyvoice_pool import CosyVoiceWorkerPool
 
 import sys
 sys.path.append('third_party/Matcha-TTS')
@@ -17,6 +19,38 @@ class CosyVoiceTTS(BaseTTS):
         prompt_text: str,
         speaker: str = "default",
         device: str = "cpu",
+        load_llm_batcher: bool = False,
+        llm_batch_size: int = 8,
+        load_flow_batcher: bool = False,
+        flow_batch_size: int = 4,
+        flow_steps: int = 10,
+        flow_solver: str = "euler",
+        flow_cfg_rate: Optional[float] = None,
+        flow_cfg_schedule: Optional[Union[int, List[float]]] = None,
+        load_ort: bool = False,
+        load_ort_llm: bool = False,
+        ort_intra_op_num_threads: int = 4,
+        ort_inter_op_num_threads: int = 1,
+        frontend_intra_op_num_threads: int = 1,
+        frontend_inter_op_num_threads: int = 1,
+        prompt_cache_size: int = 16,
+        quantize: Optional[str] = None,
+        quantize_hift: bool = False,
+        load_incremental_flow: bool = False,
+        flow_estimator_cache: bool = False,
+        load_mmap: bool = False,
+        safetensors_cache: bool = False,
+        load_static_cache: bool = False,
+        static_cache_len: int = 2048,
+        load_cpu_compile: bool = False,
+        pipeline_depth: int = 1,
+        num_workers: int = 0,
+        worker_num_threads: int = 0,
+        worker_pin_cpu: bool = True,
+        worker_plans: Optional[List[Dict[str, Any]]] = None,
+        bistream: bool = False,
+        prompt_max_sec: float = 0.0,
+        profile: bool = False,
         **kwargs
     ):
         super().__init__(**kwargs)
@@ -24,15 +58,133 @@ class CosyVoiceTTS(BaseTTS):
         self.speaker = speaker
         self.device = device
         self.prompt_text = prompt_text
+        # 参考音频超过prompt_max_sec秒时截取其中最佳的3~prompt_max_sec秒有声片段并对齐截取prompt_text，0为不截取
+        # 参考音频的语音token和梅尔帧会拼接进每一句的LLM prefill和每次flow计算，截短可直接降低每句的计算量
+        if prompt_max_sec > 0:
+            self.trim_prompt(prompt_max_sec)
+        # 并发合成时将多个请求的LLM解码合并为一次批量前向
+        self.load_llm_batcher = load_llm_batcher
+        self.llm_batch_size = llm_batch_size
+        # 并发合成时将多个请求的flow estimator前向合并为一个batch
+        self.load_flow_batcher = load_flow_batcher
+        self.flow_batch_size = flow_batch_size
+        # flow matching的ODE求解步数、求解器和CFG强度，步数越少合成越快，cfg_rate为None时使用模型默认值
+        # cfg_schedule为整数k时只在前k步做CFG，其余步estimator批大小由2降为1；也可为每步的CFG强度列表，0表示该步不做CFG
+        self.flow_conf = {'n_timesteps': flow_steps, 'solver': flow_solver, 'cfg_rate': flow_cfg_rate, 'cfg_schedule': flow_cfg_schedule}
+        # CPU上使用onnxruntime运行flow estimator和HiFT解码，需先用cosyvoice/bin/export_onnx.py导出onnx模型
+        self.load_ort = load_ort
+        # CPU上使用onnxruntime运行LLM的prefill和逐步解码，需先用cosyvoice/bin/export_onnx_llm.py导出
+        self.load_ort_llm = load_ort_llm
+        self.ort_intra_op_num_threads = ort_intra_op_num_threads
+        self.ort_inter_op_num_threads = ort_inter_op_num_threads
+        # 前端campplus和speech tokenizer的onnxruntime线程数
+        self.frontend_intra_op_num_threads = frontend_intra_op_num_threads
+        self.frontend_inter_op_num_threads = frontend_inter_op_num_threads
+        # 按音频内容缓存提示音频解码、重采样结果和提取的特征，相同提示音频重复合成时跳过前端计算，0表示不缓存
+        self.prompt_cache_size = prompt_cache_size
+        # CPU推理量化模式：int8为LLM和flow的Linear层动态int8量化(量化权重缓存在模型目录)，bf16为LLM和flow的bf16自动混合精度
+        # quantize_hift为True时HiFT声码器使用bf16自动混合精度(卷积层无法动态int8量化)
+        self.quantize = quantize
+        self.quantize_hift = quantize_hift
+        # 流式合成时flow只编码新增的token(仅CosyVoice2)，flow_estimator_cache同时缓存每个ODE步的estimator状态，只解码新增的梅尔帧，显存/内存随句长增长
+        self.load_incremental_flow = load_incremental_flow
+        self.flow_estimator_cache = flow_estimator_cache
+        # 构建模型时跳过参数随机初始化并以mmap方式加载权重，跳过随机初始化，同机多个进程共享只读权重页
+        # safetensors_cache为True时首次加载把.pt转换为.safetensors缓存在模型目录
+        self.load_mmap = load_mmap
+        self.safetensors_cache = safetensors_cache
+        # LLM逐步解码使用预分配的固定长度KV cache，不再每步拼接cache和构造注意力掩码(仅CosyVoice2/3)
+        self.load_static_cache = load_static_cache
+        self.static_cache_len = static_cache_len
+        # CPU推理时flow estimator和HiFT使用冻结的TorchScript图(按长度分桶)，开启static cache时LLM解码步使用torch.compile，编译结果缓存在模型目录
+        self.load_cpu_compile = load_cpu_compile
+        # 一次合成内多个文本分段的流水线深度，大于1时下一段的LLM解码与当前段的flow/HiFT并行，音频仍按顺序输出
+        self.pipeline_depth = pipeline_depth
+        # num_workers大于0时启用多进程合成池，每个worker进程加载一份模型(强制mmap加载以共享权重页)，音频经共享内存传回
+        # worker_num_threads为每个worker的torch线程数，0表示使用分到的CPU数；worker_pin_cpu为True时把CPU均分绑定到各worker
+        self.num_workers = num_workers
+        self.worker_num_threads = worker_num_threads
+        self.worker_pin_cpu = worker_pin_cpu
+        # 启用resources规划时由utils.resource_planner给出每个worker的绑核和线程数
+        self.worker_plans = worker_plans
+        # 双向流式合成：大模型输出的文本片段直接送入一次长时间运行的CosyVoice2/3合成，不再按句切分，首包更快(不支持合成池)
+        self.bistream = bistream
+        # 进程内合成时记录每次合成各阶段(前端、LLM prefill/解码、等待、flow、HiFT)的耗时并打印汇总
+        # 调用方需要汇总时传入profile字典，每次合成各自填写，并发请求互不覆盖
+        self.profile = profile
         self.model = None
+        self.pool = None
         self.load_model()
     
+    def trim_prompt(self, max_sec: float):
+        """截取参考音频的最佳有声片段，截取后的音频保存到临时目录，重启时按内容哈希复用"""
+        import hashlib
+        import os
+        import tempfile
+        import torchaudio
+        from cosyvoice.utils.prompt_utils import trim_prompt_wav
+
+        try:
+            with open(self.speaker, 'rb') as f:
+                key = hashlib.sha1(f.read() + f"{self.prompt_text}|{max_sec}".encode()).hexdigest()
+            output_path = os.path.join(tempfile.gettempdir(), f"cosyvoice_prompt_{key}.wav")
+            text_path = os.path.join(tempfile.gettempdir(), f"cosyvoice_prompt_{key}.txt")
+            if os.path.exists(output_path) and os.path.exists(text_path):
+                with open(text_path, 'r', encoding='utf-8') as f:
+                    prompt_text = f.read()
+                print(f"复用已截取的参考音频: {output_path}")
+                self.speaker, self.prompt_text = output_path, prompt_text
+                return
+            prompt_text, speech, sample_rate, region = trim_prompt_wav(self.prompt_text, self.speaker, min(3.0, max_sec), max_sec)
+            if not region['aligned']:
+                print(f"参考音频中没有与prompt_text标点对齐的{max_sec}秒内片段，只去除首尾静音")
+            torchaudio.save(output_path, speech, sample_rate)
+            # 文本最后写入，音频写到一半时进程退出不会被当作已截取
+            with open(text_path, 'w', encoding='utf-8') as f:
+                f.write(prompt_text)
+            print(f"参考音频从{region['prompt_sec']:.2f}秒截取为{speech.shape[1] / sample_rate:.2f}秒: {prompt_text}")
+            self.speaker, self.prompt_text = output_path, prompt_text
+        except Exception as e:
+            print(f"参考音频截取失败，使用原始参考音频: {e}")
+
     def load_model(self):
         """加载CosyVoice模型"""
         try:
             # CosyVoice模型加载逻辑
             # 这里需要根据实际的CosyVoice API进行调整
-            self.model = AutoModel(model_dir=str(self.model_path))
+            model_kwargs = dict(model_dir=str(self.model_path),
+                                load_llm_batcher=self.load_llm_batcher,
+                                llm_batch_size=self.llm_batch_size,
+                                load_flow_batcher=self.load_flow_batcher,
+                                flow_batch_size=self.flow_batch_size,
+                                flow_conf=self.flow_conf,
+                                load_ort=self.load_ort,
+                                load_ort_llm=self.load_ort_llm,
+                                ort_intra_op_num_threads=self.ort_intra_op_num_threads,
+                                ort_inter_op_num_threads=self.ort_inter_op_num_threads,
+                                frontend_intra_op_num_threads=self.frontend_intra_op_num_threads,
+                                frontend_inter_op_num_threads=self.frontend_inter_op_num_threads,
+                                prompt_cache_size=self.prompt_cache_size,
+                                quantize=self.quantize,
+                                quantize_hift=self.quantize_hift,
+                                load_incremental_flow=self.load_incremental_flow,
+                                flow_estimator_cache=self.flow_estimator_cache,
+                                load_mmap=self.load_mmap,
+                                safetensors_cache=self.safetensors_cache,
+                                load_static_cache=self.load_static_cache,
+                                static_cache_len=self.static_cache_len,
+                                load_cpu_compile=self.load_cpu_compile,
+                                pipeline_depth=self.pipeline_depth)
+            if self.num_workers > 0:
+                model_kwargs['load_mmap'] = True
+                self.pool = CosyVoiceWorkerPool(model_kwargs,
+                                                num_workers=self.num_workers,
+                                                num_threads=self.worker_num_threads,
+                                                pin_cpu=self.worker_pin_cpu,
+                                                worker_plans=self.worker_plans)
+                print(f"CosyVoice合成池启动成功: {self.model_path}，worker数：{self.num_workers}")
+                return
+            self.model = AutoModel(**model_kwargs)
             print(f"CosyVoice模型加载成功: {self.model_path}")
         except ImportError:
             print("CosyVoice未安装，将使用模拟模式")
@@ -40,17 +192,18 @@ class CosyVoiceTTS(BaseTTS):
         except Exception as e:
             print(f"CosyVoice模型加载失败: {e}")
             self.model = None
+            self.pool = None
     
-    async def synthesize(self, text: str, output_path: str) -> bool:
+    async def synthesize(self, text: str, output_path: str, profile: Optional[Dict[str, Any]] = None) -> bool:
         """异步语音合成"""
         # 在异步上下文中调用同步方法
         loop = asyncio.get_event_loop()
-        return await loop.run_in_executor(None, self.synthesize_sync, text, output_path)
+        return await loop.run_in_executor(None, self.synthesize_sync, text, output_path, profile)
     
-    def synthesize_sync(self, text: str, output_path: str) -> bool:
-        """同步语音合成"""
+    def synthesize_sync(self, text: str, output_path: str, profile: Optional[Dict[str, Any]] = None) -> bool:
+        """同步语音合成，进程内合成时profile不为None则填入本次合成的各阶段耗时汇总(见TTSProfiler.summary)"""
         print(f"开始合成: {text}")
-        if self.model is None:
+        if self.model is None and self.pool is None:
             print("CosyVoice模型未加载")
             return False
         
@@ -59,17 +212,76 @@ class CosyVoiceTTS(BaseTTS):
             # 这里需要根据实际的CosyVoice API进行调整
             import torchaudio
             
-            # 使用zero-shot模式
-            for i, j in enumerate(self.model.inference_zero_shot(text, self.prompt_text, self.speaker)):
-                # j是audio tensor
-                if i == 0:  # 只取第一个结果
-                    print(f"合成成功，保存音频: {text}， 音频文件：{output_path}")
-                    torchaudio.save(output_path, j['tts_speech'], 22050)
-                    break
+            if self.pool is not None:
+                # 合成池模式下由worker进程合成，本线程只等待共享内存中的音频
+                import torch
+                speech = self.pool.synthesize(text, self.prompt_text, self.speaker)
+                print(f"合成成功，保存音频: {text}， 音频文件：{output_path}")
+                torchaudio.save(output_path, torch.from_numpy(speech).unsqueeze(0), self.pool.sample_rate)
+                print(f"合成结束: {text}")
+                return True
+
+            # 使用zero-shot模式，与合成池模式一样拼接所有文本分段的音频，按模型采样率保存
+            import torch
+            profiler = TTSProfiler() if self.profile or profile is not None else None
+            speech = [j['tts_speech'] for j in self.model.inference_zero_shot(text, self.prompt_text, self.speaker, profiler=profiler)]
+            print(f"合成成功，保存音频: {text}， 音频文件：{output_path}")
+            torchaudio.save(output_path, torch.concat(speech, dim=1), self.model.sample_rate)
 
+            if profiler is not None:
+                self.report_profile(profiler, profile)
             print(f"合成结束: {text}")
             return True
             
         except Exception as e:
             print(f"CosyVoice合成失败: {e}")
             return False
+    
+    def supports_bistream(self) -> bool:
+        """CosyVoice2/3进程内合成时支持双向流式"""
+        return self.bistream and self.model is not None and isinstance(self.model, CosyVoice2)
+    
+    def synthesize_bistream_sync(self, text_generator: Iterator[str], get_output_path: Callable[[int], str],
+                                 on_audio: Callable[[str, int], None], profile: Optional[Dict[str, Any]] = None) -> int:
+        """边接收文本边流式合成，每个音频块保存为一个文件后回调
+        
+        Args:
+            text_generator: 文本片段生成器，如大模型的流式输出
+            get_output_path: 根据音频块序号(从1开始)返回输出音频文件路径
+            on_audio: 音频块保存后的回调，参数为音频文件路径和序号
+            profile: 不为None时填入本次合成的各阶段耗时汇总
+            
+        Returns:
+            音频块数
+        """
+        import torchaudio
+        
+        index = 0
+        profiler = TTSProfiler() if self.profile or profile is not None else None
+        for j in self.model.inference_zero_shot(text_generator, self.prompt_text, self.speaker, stream=True, profiler=profiler):
+            index += 1
+            output_path = get_output_path(index)
+            torchaudio.save(output_path, j['tts_speech'], self.model.sample_rate)
+            on_audio(output_path, index)
+        if profiler is not None:
+            self.report_profile(profiler, profile)
+        print(f"双向流式合成结束，共{index}个音频块")
+        return index
+    
+    def report_profile(self, profiler: TTSProfiler, profile: Optional[Dict[str, Any]] = None):
+        """汇总一次合成的各阶段耗时，填入调用方的profile字典，开启profile配置时打印"""
+        summary = profiler.summary()
+        if profile is not None:
+            profile.update(summary)
+        if not self.profile:
+            return
+        stages = ', '.join(f"{k} {v['total']:.3f}s/{v['count']}次" for k, v in summary.items() if isinstance(v, dict))
+        first_chunk_latency = summary['first_chunk_latency']
+        print(f"合成耗时: {stages}; 首包 {first_chunk_latency or 0:.3f}s, 总耗时 {summary['wall_time']:.3f}s, "
+              f"音频 {summary['speech_len']:.2f}s, RTF {summary['rtf'] or 0:.3f}")
+    
+    def close(self):
+        """关闭合成池"""
+        if self.pool is not None:
+            self.pool.close()
+            self.pool = None
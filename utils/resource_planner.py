@@ -0,0 +1,277 @@
+"""CPU线程与绑核规划"""
+import argparse
+import multiprocessing
+import os
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, List, Optional
+
+# 占用CPU的组件：main为主进程(ASR与进程内TTS共用torch线程池)，tts_workers为TTS合成池的worker进程
+CPU_COMPONENTS = ["main", "tts_workers"]
+
+
+def available_cpus() -> List[int]:
+    """当前进程可用的CPU编号，macOS/Windows没有sched_getaffinity时为全部CPU"""
+    if hasattr(os, "sched_getaffinity"):
+        return sorted(os.sched_getaffinity(0))
+    return list(range(os.cpu_count() or 1))
+
+
+def apply_process_plan(plan: Dict[str, Any]):
+    """把线程规划应用到当前进程，需在创建其它线程和加载模型前调用
+
+    Linux上绑核只作用于调用线程，之后创建的线程(包括torch线程池)会继承；没有sched_setaffinity的平台只设置线程数
+    """
+    if plan.get("cpus"):
+        if hasattr(os, "sched_setaffinity"):
+            os.sched_setaffinity(0, plan["cpus"])
+        else:
+            print("当前平台不支持绑核，跳过cpus设置")
+    import torch
+    if plan.get("intra_op_num_threads", 0) > 0:
+        torch.set_num_threads(plan["intra_op_num_threads"])
+    if plan.get("inter_op_num_threads", 0) > 0:
+        try:
+            torch.set_num_interop_threads(plan["inter_op_num_threads"])
+        except RuntimeError:
+            # inter-op线程池启动后无法再修改
+            print("torch inter-op线程池已启动，跳过inter_op_num_threads设置")
+
+
+class ResourcePlanner:
+    """CPU线程与绑核规划器
+
+    根据config.yaml的resources配置把CPU连续划分给主进程和TTS合成池，
+    再由各组件分到的CPU推导torch、onnxruntime和FunASR的intra/inter-op线程数，避免多个线程池超额订阅CPU。
+    组件配置cpus为具体核数时优先分配，cpus为0的组件均分剩余CPU；TTS合成池分到的CPU再在worker间均分。
+    """
+
+    def __init__(self, resources_config: Optional[Dict[str, Any]] = None, num_tts_workers: int = 0):
+        """
+        Args:
+            resources_config: config.yaml中的resources配置
+            num_tts_workers: TTS合成池worker数，0表示进程内合成
+        """
+        resources_config = resources_config or {}
+        self.enable = resources_config.get("enable", False)
+        self.components = resources_config.get("components", {}) or {}
+        cpus = resources_config.get("cpus")
+        self.cpus = sorted(cpus) if cpus else available_cpus()
+        self.num_tts_workers = num_tts_workers
+        # 首次使用规划时才分配，未启用resources时CPU不足也不影响启动
+        self._allocation = None
+
+    @property
+    def allocation(self) -> Dict[str, List[int]]:
+        if self._allocation is None:
+            self._allocation = self._allocate()
+        return self._allocation
+
+    def _conf(self, name: str) -> Dict[str, Any]:
+        return self.components.get(name, {}) or {}
+
+    def _allocate(self) -> Dict[str, List[int]]:
+        """按编号连续分配CPU，先分配指定核数的组件，cpus为0的组件均分剩余CPU"""
+        active = ["main"] + (["tts_workers"] if self.num_tts_workers > 0 else [])
+        requested = {name: self._conf(name).get("cpus", 0) for name in active}
+        rest = len(self.cpus) - sum(requested.values())
+        if rest < 0:
+            raise ValueError(f"组件分配的CPU数{sum(requested.values())}超过可用CPU数{len(self.cpus)}")
+        shared = [name for name in active if requested[name] == 0]
+        if len(shared) > rest:
+            raise ValueError(f"剩余{rest}个CPU不足以分给{shared}")
+        allocation, start = {}, 0
+        for name in active:
+            if requested[name] > 0:
+                count = requested[name]
+            else:
+                index = shared.index(name)
+                count = rest // len(shared) + (1 if index < rest % len(shared) else 0)
+            allocation[name] = self.cpus[start:start + count]
+            start += count
+        if self.num_tts_workers > 0 and len(allocation["tts_workers"]) < self.num_tts_workers:
+            raise ValueError(f"TTS合成池分到的CPU少于worker数{self.num_tts_workers}")
+        return allocation
+
+    def plan(self, name: str) -> Dict[str, Any]:
+        """主进程或单个TTS合成池worker的线程规划"""
+        assert name in CPU_COMPONENTS, f"不支持的组件: {name}"
+        conf = self._conf(name)
+        cpus = self.allocation.get(name, [])
+        if name == "tts_workers":
+            cpus = cpus[:len(cpus) // max(self.num_tts_workers, 1)]
+        return {
+            "cpus": cpus if conf.get("pin", name == "tts_workers") else None,
+            "intra_op_num_threads": conf.get("intra_op_num_threads", 0) or len(cpus),
+            "inter_op_num_threads": conf.get("inter_op_num_threads", 1),
+        }
+
+    def worker_plans(self) -> List[Dict[str, Any]]:
+        """TTS合成池每个worker的线程规划，CPU在worker间连续均分"""
+        if self.num_tts_workers == 0:
+            return []
+        plan = self.plan("tts_workers")
+        cpus = self.allocation["tts_workers"]
+        cpus_per_worker = len(cpus) // self.num_tts_workers
+        return [dict(plan, cpus=cpus[i * cpus_per_worker:(i + 1) * cpus_per_worker] if plan["cpus"] else None)
+                for i in range(self.num_tts_workers)]
+
+    def ort_plan(self, name: str) -> Dict[str, Any]:
+        """onnxruntime会话的线程规划，线程数为0时使用所在进程的intra_op线程数"""
+        conf = self._conf(name)
+        owner = self.plan("tts_workers" if self.num_tts_workers > 0 else "main")
+        return {
+            "intra_op_num_threads": conf.get("intra_op_num_threads", 0) or owner["intra_op_num_threads"],
+            "inter_op_num_threads": conf.get("inter_op_num_threads", 1),
+        }
+
+    def asr_kwargs(self) -> Dict[str, Any]:
+        """ASR模型参数，FunASR会按ncpu全局设置torch线程数"""
+        return {"ncpu": self.plan("main")["intra_op_num_threads"]}
+
+    def tts_kwargs(self) -> Dict[str, Any]:
+        """CosyVoice TTS参数"""
+        ort, frontend = self.ort_plan("ort"), self.ort_plan("tts_frontend")
+        kwargs = {
+            "ort_intra_op_num_threads": ort["intra_op_num_threads"],
+            "ort_inter_op_num_threads": ort["inter_op_num_threads"],
+            "frontend_intra_op_num_threads": frontend["intra_op_num_threads"],
+            "frontend_inter_op_num_threads": frontend["inter_op_num_threads"],
+        }
+        if self.num_tts_workers > 0:
+            kwargs["worker_plans"] = self.worker_plans()
+        return kwargs
+
+    def summary(self) -> str:
+        lines = [f"main: {self.plan('main')}"]
+        for i, plan in enumerate(self.worker_plans()):
+            lines.append(f"tts_worker{i}: {plan}")
+        lines.append(f"ort: {self.ort_plan('ort')}")
+        lines.append(f"tts_frontend: {self.ort_plan('tts_frontend')}")
+        return "\n".join(lines)
+
+
+def candidate_splits(num_cpus: int, max_workers: int, with_asr: bool) -> List[tuple]:
+    """(主进程核数, TTS worker数)候选，worker数为0表示进程内合成，主进程使用全部CPU"""
+    main_options = sorted({max(1, num_cpus // 4), max(1, num_cpus // 2)}) if with_asr else [max(1, num_cpus // 8)]
+    candidates = [(num_cpus, 0)]
+    for main_cpus in main_options:
+        for num_workers in range(1, max_workers + 1):
+            if (num_cpus - main_cpus) // num_workers >= 1:
+                candidates.append((main_cpus, num_workers))
+    return candidates
+
+
+def run_candidate(args, resources, num_workers, result_queue):
+    """在独立进程中按规划加载ASR和TTS，并发合成与识别，统计吞吐"""
+    from utils.config_loader import ConfigLoader
+    from asr.asr_factory import ASRFactory
+    from tts.cosyvoice_tts import CosyVoiceTTS
+
+    config = ConfigLoader(args.config)
+    planner = ResourcePlanner(resources, num_tts_workers=num_workers)
+    apply_process_plan(planner.plan("main"))
+    print(planner.summary())
+
+    asr_model = None
+    if args.asr_audio:
+        asr_config = dict(config.get(f"asr.models.{args.asr_type}", {}))
+        asr_config["model_path"] = config.get_abs_path(asr_config["model_path"])
+        asr_config.update(planner.asr_kwargs())
+        asr_model = ASRFactory.create_asr(args.asr_type, asr_config)
+    tts_config = dict(config.get("tts.models.cosyvoice", {}))
+    tts_config["model_path"] = config.get_abs_path(tts_config["model_path"])
+    tts_config["num_workers"] = num_workers
+    tts_config.update(planner.tts_kwargs())
+    tts_model = CosyVoiceTTS(**tts_config)
+
+    texts = [args.text] * args.num_requests
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        # 预热
+        tts_model.synthesize_sync(args.text, os.path.join(tmp_dir, "warmup.wav"))
+
+        def synthesize(i):
+            start_time = time.time()
+            tts_model.synthesize_sync(texts[i], os.path.join(tmp_dir, f"{i}.wav"))
+            return time.time() - start_time
+
+        def transcribe():
+            latencies = []
+            for _ in range(args.asr_repeat):
+                start_time = time.time()
+                asr_model.transcribe(args.asr_audio)
+                latencies.append(time.time() - start_time)
+            return latencies
+
+        start_time = time.time()
+        with ThreadPoolExecutor(max_workers=args.num_requests + 1) as executor:
+            asr_future = executor.submit(transcribe) if asr_model is not None else None
+            tts_latencies = list(executor.map(synthesize, range(args.num_requests)))
+            asr_latencies = asr_future.result() if asr_future is not None else []
+        total_time = time.time() - start_time
+    tts_model.close()
+    result_queue.put({
+        "total_time": total_time,
+        "tts_throughput": args.num_requests / total_time,
+        "tts_latency": sum(tts_latencies) / len(tts_latencies),
+        "asr_latency": sum(asr_latencies) / len(asr_latencies) if asr_latencies else 0.0,
+    })
+
+
+def sweep(args):
+    """扫描主进程核数与TTS worker数的划分，找出当前机器吞吐最高的配置"""
+    cpus = available_cpus()
+    ctx = multiprocessing.get_context("spawn")
+    results = []
+    for main_cpus, num_workers in candidate_splits(len(cpus), args.max_workers, bool(args.asr_audio)):
+        resources = {
+            "enable": True,
+            "components": {
+                "main": {"cpus": main_cpus if num_workers > 0 else 0, "pin": True},
+                "tts_workers": {"cpus": 0, "pin": True},
+            },
+        }
+        result_queue = ctx.Queue()
+        # 每个候选使用新进程，避免线程池和绑核状态相互影响
+        p = ctx.Process(target=run_candidate, args=(args, resources, num_workers, result_queue))
+        p.start()
+        p.join()
+        if result_queue.empty():
+            print(f"候选(主进程{main_cpus}核, {num_workers}个worker)运行失败")
+            continue
+        results.append((main_cpus, num_workers, resources, result_queue.get()))
+
+    print("主进程核数\tTTS worker数\t总耗时(s)\tTTS吞吐(句/s)\tTTS平均延迟(s)\tASR平均延迟(s)")
+    for main_cpus, num_workers, _, result in results:
+        print(f"{main_cpus}\t{num_workers}\t{result['total_time']:.2f}\t{result['tts_throughput']:.3f}\t"
+              f"{result['tts_latency']:.2f}\t{result['asr_latency']:.2f}")
+    if results:
+        main_cpus, num_workers, resources, _ = max(results, key=lambda x: x[3]["tts_throughput"])
+        print(f"最优划分：主进程{main_cpus}核，TTS合成池{num_workers}个worker")
+        print(f"config.yaml: tts.models.cosyvoice.num_workers: {num_workers}, resources.components: {resources['components']}")
+
+
+def get_args():
+    parser = argparse.ArgumentParser(description="CPU线程与绑核规划，--sweep扫描当前机器的最优划分")
+    parser.add_argument("--config", type=str, default="config.yaml", help="配置文件路径")
+    parser.add_argument("--sweep", action="store_true", help="扫描主进程核数与TTS worker数的划分")
+    parser.add_argument("--text", type=str, default="收到好友从远方寄来的生日礼物，那份意外的惊喜与深深的祝福让我心中充满了甜蜜的快乐。",
+                        help="并发合成的文本")
+    parser.add_argument("--num_requests", type=int, default=8, help="每个候选并发合成的句数")
+    parser.add_argument("--max_workers", type=int, default=4, help="最大TTS worker数")
+    parser.add_argument("--asr_type", type=str, default="sensevoice", help="与TTS同时运行的ASR类型")
+    parser.add_argument("--asr_audio", type=str, default="", help="ASR测试音频，为空时只测试TTS")
+    parser.add_argument("--asr_repeat", type=int, default=8, help="每个候选ASR识别次数")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = get_args()
+    if args.sweep:
+        sweep(args)
+    else:
+        from utils.config_loader import ConfigLoader
+        config = ConfigLoader(args.config)
+        planner = ResourcePlanner(config.get("resources", {}), num_tts_workers=config.get("tts.models.cosyvoice.num_workers", 0))
+        print(planner.summary())